@@ -0,0 +1,84 @@
+"""
+Benchmark of the CheckSeqs GUI (sequence categorization) for sessions with many series.
+
+usage: python bench_checkseqs_grid.py [repetitions]
+
+For 50, 200 and 1000 synthetic series the time to build the window (including the first paint), the number of
+native controls in the window and the time of a single folder edit are reported. Needs a display (e.g. xvfb-run).
+"""
+
+import os
+import sys
+import time
+
+import wx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyBIDSconv import CheckSeqs
+
+
+def synthetic_session(nrseries):
+    # a repeating protocol of anat, func, fmap, dwi and localizer series
+    protocol = [('t1_mprage', 'anat', 0, 'T1w', 'M'), ('ep2d_bold', 'func', 0, 'bold', 'M'),
+                ('gre_field_mapping', 'fmap', 0, '', 'M'), ('gre_field_mapping', 'fmap', 0, '', 'P'),
+                ('ep2d_diff', 'dwi', 0, 'dwi', 'M'), ('localizer', '', 1, '', 'M')]
+    un_seq, scantype_list, exclusion_array, label_list, it_list2 = [], [], [], [], []
+    for i in range(nrseries):
+        name, scantype, excluded, label, imagetype = protocol[i % len(protocol)]
+        un_seq.append('%s_%d' % (name, i))
+        scantype_list.append(scantype)
+        exclusion_array.append(excluded)
+        label_list.append(label)
+        it_list2.append(imagetype)
+    return {'un_seq': un_seq, 'scantype_list': scantype_list, 'exclusion_array': exclusion_array,
+            'nrvols_array': [1] * nrseries, 'acq_name_list': [''] * nrseries, 'rec_name_list': [''] * nrseries,
+            'label_list': label_list, 'it_list2': it_list2, 'acq_time': [''] * nrseries, 'un_echo': [''] * nrseries}
+
+
+def count_windows(window):
+    return 1 + sum(count_windows(child) for child in window.GetChildren())
+
+
+def build(session):
+    frame = CheckSeqs(session['un_seq'], list(session['scantype_list']), session['exclusion_array'],
+                      session['nrvols_array'], 1, '', '', '', session['acq_name_list'], session['rec_name_list'],
+                      session['label_list'], [], '', '', session['it_list2'], session['acq_time'], {},
+                      session['un_echo'])
+    frame.Update()
+    wx.SafeYield()
+    return frame
+
+
+def main():
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    app = wx.App(False)
+
+    for nrseries in [50, 200, 1000]:
+        session = synthetic_session(nrseries)
+        buildtimes = []
+        edittimes = []
+        for rep in range(repetitions):
+            t0 = time.time()
+            frame = build(session)
+            buildtimes.append(time.time() - t0)
+            nrwindows = count_windows(frame)
+
+            # change the folder of the last series, as a combo box selection in the grid would
+            row = nrseries - 1
+            t0 = time.time()
+            frame.table.SetValue(row, frame.table.columns.index('folder'), 'anat')
+            frame.refreshrow(row)
+            frame.Update()
+            edittimes.append(time.time() - t0)
+            frame.Destroy()
+            wx.SafeYield()
+
+        print("%5d series: build %.3f s (best of %d), %d windows, folder edit %.1f ms" %
+              (nrseries, min(buildtimes), repetitions, nrwindows, 1000 * min(edittimes)))
+
+    app.Destroy()
+
+
+if __name__ == '__main__':
+    main()
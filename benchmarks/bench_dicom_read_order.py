@@ -0,0 +1,67 @@
+"""
+Benchmark of the dicom header scan of pyBIDSconv with a cold page cache for the different read orders
+(directory order, inode order, physical extent order).
+
+usage: python bench_dicom_read_order.py <dicom folder> [repetitions]
+
+The page cache is dropped before each run via /proc/sys/vm/drop_caches (needs root) or, if that is not possible,
+by evicting the dicom files with posix_fadvise(DONTNEED).
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyBIDSconv import scan_dicom_headers
+
+
+def drop_caches(filelist):
+    try:
+        os.system('sync')
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+        return 'drop_caches'
+    except (IOError, OSError):
+        pass
+
+    if not hasattr(os, 'posix_fadvise'):
+        return 'none (warm cache!)'
+
+    for filename in filelist:
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    return 'fadvise'
+
+
+def main():
+    pathdicom = sys.argv[1]
+    repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    list_dicom_files = []
+    for dirName, subdirList, fileList in os.walk(pathdicom):
+        for filename in fileList:
+            if ".dcm" in filename.lower():
+                list_dicom_files.append(os.path.join(dirName, filename))
+
+    print("%d dicom files in %s" % (len(list_dicom_files), pathdicom))
+
+    for readorder in ['', 'inode', 'extent']:
+        times = []
+        for rep in range(repetitions):
+            method = drop_caches(list_dicom_files)
+            t0 = time.time()
+            scan_dicom_headers(list_dicom_files, readorder)
+            times.append(time.time() - t0)
+
+        best = min(times)
+        print("read order %-8s: best %.2f s, mean %.2f s, %.0f files/s (cache dropped by %s)" %
+              (readorder or 'walk', best, sum(times) / len(times), len(list_dicom_files) / best, method))
+
+
+if __name__ == '__main__':
+    main()
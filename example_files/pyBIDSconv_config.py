@@ -7,3 +7,68 @@ ExclusionsBySequenceDescriptionContent = ['aah', 'scout', 'phoenix']
 
 ExclusionsBySequenceDescriptionEnd = [ 'Localizer', '_fa', '_trace', '_colfa', '_tracew', '_adc']
 
+
+# read dicom files in disk order ('inode', 'extent' or '' for directory order) to reduce seeking on spinning disks
+DicomReadOrder = 'inode'
+
+# keep a snapshot of the dicom folder, so a rescan only reads new or changed files
+IncrementalRescan = True
+
+# low memory mode for sessions with very many files (compact path/header storage, grouping spills to disk above the
+# memory budget in MB)
+LowMemoryMode = False
+MemoryBudgetMB = 2000
+
+# number of worker processes for reading the dicom headers
+ScanWorkers = 1
+
+# number of series decisions kept in the categorization cache
+CategorizationCacheSize = 10000
+
+# record the decisions of the check sequences GUI as protocol template (code/pyBIDSconv_protocols.json in the BIDS
+# folder) and convert subjects matching a template without GUI (ProtocolTolerance: number of extra repeated series)
+ProtocolReplay = False
+ProtocolTolerance = 1
+
+# task names of func sequences by substring of the sequence description (default: placeholder TasknameN)
+TaskNameBySequenceDescriptionSubstring = {'rest': 'rest'}
+
+# convert without GUI if every sequence is categorized with a confidence >= AutoAcceptThreshold (0-1), checks:
+# single rule match, expected number of files, unique series number, single scan date, unique output filename with
+# task name and fmap references (ExpectedFileCountBySequenceDescription: number of files per sequence description)
+AutoAccept = False
+AutoAcceptThreshold = 1.0
+ExpectedFileCountBySequenceDescription = {}
+
+# number of dcm2niix conversions run in the background for already decided anat/dwi sequences while the check
+# sequences GUI is open (0: off)
+SpeculativeJobs = 2
+
+# number of subjects converted at the same time (further confirmed subjects wait in the conversion queue) and number
+# of dicom directories scanned ahead in the subject queue (Tools menu)
+ConversionSlots = 2
+QueueScanAhead = 2
+
+# thumbnail column (middle slice of each series) in the check sequences GUI, decoded in the background for the rows
+# in view and cached by SeriesInstanceUID in ~/.pyBIDSconv/thumbnails (ThumbnailSize in pixels)
+Thumbnails = False
+ThumbnailSize = 48
+
+# seconds without heartbeat after which the claim of a job in the shared work queue (pyBIDSconv.py submit/worker) or
+# the lock of the dataset level files (participants.tsv, CHANGES, scans.tsv) is taken over by another worker
+QueueTimeout = 300
+
+# dcm2niix processes run at the same time (0: number of CPUs) and memory budget in MB for their estimated peak memory
+# (0: half of the physical memory); the largest series are converted first
+Dcm2niixJobs = 0
+Dcm2niixMemoryMB = 0
+
+# choose the number of parallel header readers and dcm2niix processes at runtime from the measured throughput (files/s,
+# MB/s) and CPU utilization; ScanWorkers above 1 and Dcm2niixJobs are the upper limits. The chosen levels and the
+# measurements are written to the run report of each subject (code/pyBIDSconv_reports in the BIDS folder)
+AdaptiveWorkers = False
+
+# folder for the dicom copies and the dcm2niix output during the conversion, e.g. /dev/shm or a local NVMe scratch
+# ('': temp folders in the subject folder); the results are moved to the BIDS folder (copied and synced across file
+# systems) and the free space is checked before each series is staged
+StagingRoot = ''
@@ -45,7 +45,26 @@ import json
 import pandas as pd
 import webbrowser
 import re
+import struct
+import time
+import hashlib
+import difflib
+import tempfile
+import multiprocessing
+import threading
+import subprocess
+import atexit
+import argparse
+import socket
+import signal
+import errno
+import traceback
+import zipfile
+import tarfile
+import itertools
+from collections import namedtuple, OrderedDict
 import wx
+import wx.grid
 import wx.lib.scrolledpanel
 # import gzip
 import io
@@ -55,6 +74,11 @@ try:
 except:
     import dicom as pydicom
 
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
+
 
 # #####################################################################################################################
 # #####################################################################################################################
@@ -143,6 +167,10 @@ class GetInput(wx.Frame):
         self.configfile = []
         self.outputdir = []
         self.new = []
+
+        # background scan of the dicom directory
+        self.prescan = DicomPrescan()
+        self.queue = None
         
         # menubar
         # -----------------------------
@@ -168,6 +196,7 @@ class GetInput(wx.Frame):
                                                'Create pyBIDSconv_defaults.py')
         self.create_config_item = toolmenu.Append(wx.ID_ANY, '&Create/Edit pyBIDSconv config file',
                                                'Create/Edit pyBIDSconv config file')
+        self.queueitem = toolmenu.Append(wx.ID_ANY, '&Subject queue', 'Review and convert several subjects')
 
         # menubar.Append(filemenu, '&File')
         menubar.Append(helpmenu, '&Help')
@@ -185,6 +214,7 @@ class GetInput(wx.Frame):
         self.Bind(wx.EVT_MENU, self.onedit_ds, self.DSedititem)
         self.Bind(wx.EVT_MENU, self.create_def, self.create_def_item)
         self.Bind(wx.EVT_MENU, self.create_conf, self.create_config_item)
+        self.Bind(wx.EVT_MENU, self.onqueue, self.queueitem)
 
         self.Bind(wx.EVT_MENU, self.onabout_pybidsconv, self.aboutitem2)
 
@@ -198,7 +228,8 @@ class GetInput(wx.Frame):
         text01.SetFont(textfontdef)
         text01.SetForegroundColour(bluecolor)
 
-        text1 = wx.StaticText(panel, -1, label="Subjects dicom directory:", pos=(20, 10+pp))
+        text1 = wx.StaticText(panel, -1, label="Subjects dicom directory (or .zip/.tar.gz archive):",
+                              pos=(20, 10+pp))
         text1.SetFont(textfontdef)
         text1.SetForegroundColour(fontcolor)
         self.inputdir = wx.TextCtrl(panel, pos=(20, 30+pp), size=(300, 25), name='inputdir')
@@ -209,6 +240,7 @@ class GetInput(wx.Frame):
         self.button1.SetForegroundColour(fontcolor)
         self.button1.SetBackgroundColour(buttonbackgroundcolor)
         self.button1.Bind(wx.EVT_BUTTON, self.onbutton1)
+        self.inputdir.Bind(wx.EVT_KILL_FOCUS, self.onpathchange)
 
         text2 = wx.StaticText(panel, -1, label="Subject number:", pos=(20, 75+pp))
         text2.SetFont(textfontdef)
@@ -265,6 +297,7 @@ class GetInput(wx.Frame):
         self.button4.SetForegroundColour(fontcolor)
         self.button4.SetBackgroundColour(buttonbackgroundcolor)
         self.button4.Bind(wx.EVT_BUTTON, self.onbutton4)
+        self.cfgfile.Bind(wx.EVT_KILL_FOCUS, self.onpathchange)
 
         text7 = wx.StaticText(panel, -1, label="Categorization file:", pos=(20, 280+pp))
         text7.SetFont(textfontdef)
@@ -299,6 +332,16 @@ class GetInput(wx.Frame):
             pd1 = dialog.GetPath()
             dialog.Destroy()
             self.inputdir.SetValue(pd1)
+            self.startprescan()
+
+    def onpathchange(self, event):
+        # (re)start the background scan when the dicom directory or config field is left, not while typing (a
+        # partial path like / would be scanned)
+        self.startprescan()
+        event.Skip()
+
+    def startprescan(self):
+        self.prescan.start(self.inputdir.GetValue(), self.cfgfile.GetValue())
 
     def onbutton2(self, _):
         # app = wx.App()
@@ -323,6 +366,7 @@ class GetInput(wx.Frame):
             od = dialog.GetPath()
             dialog.Destroy()
             self.cfgfile.SetValue(od)
+            self.startprescan()
 
     def onbuttonok(self, _):
         pathdicom = self.inputdir.GetValue()
@@ -342,7 +386,8 @@ class GetInput(wx.Frame):
 
         # self.Close()
 
-        CheckSubject(pathdicom, subjectnumber, subjectgroup, sessionnumber, categorizationfile, configfile, outputdir)
+        CheckSubject(pathdicom, subjectnumber, subjectgroup, sessionnumber, categorizationfile, configfile, outputdir,
+                     prescan=self.prescan)
 
     @staticmethod
     def onquit(self, _):
@@ -383,9 +428,180 @@ class GetInput(wx.Frame):
     def create_conf(_):
         CreateConfigFile()
 
+    def onqueue(self, _):
+        if self.queue is None or not self.queue:
+            self.queue = SubjectQueue(self)
+        self.queue.Raise()
+
     @staticmethod
     def on_main_help(_):
         AboutMainHelp()
+
+
+def bids_subject(subjectnumber, subjectgroup, sessionnumber):
+    # relative BIDS folder of a subject (and session) as created by Convert2BIDS
+    subjnum = bids_subjnum(subjectnumber, subjectgroup)
+    if sessionnumber == "":
+        return os.path.join("sub-" + subjnum)
+    return os.path.join("sub-" + subjnum, "ses-" + str(sessionnumber))
+
+
+class SubjectQueue(wx.Frame):
+    # Queue of subjects: the input of the main window is added as queue entry. The dicom directories are scanned ahead
+    # in the background (QueueScanAhead at a time), the subjects are reviewed one after the other and each confirmed
+    # subject is converted in the ConversionQueue while the next subject is already reviewed.
+
+    def __init__(self, maininput):
+        wx.Frame.__init__(self, None, size=(860, 400))
+        self.SetTitle('pyBIDSconv - Subject queue')
+        self.maininput = maininput
+        self.entries = []
+        self.reviewing = None
+
+        panel = wx.Panel(self)
+        self.table = wx.ListCtrl(panel, style=wx.LC_REPORT)
+        for col, (label, width) in enumerate([('Nr', 40), ('Dicom directory', 340), ('Subject', 160), ('Scan', 80),
+                                              ('Review', 80), ('Conversion', 100)]):
+            self.table.InsertColumn(col, label, width=width)
+
+        self.addbutton = wx.Button(panel, -1, "Add input of main window")
+        self.addbutton.Bind(wx.EVT_BUTTON, self.onadd)
+        self.reviewbutton = wx.Button(panel, -1, "Review next subject")
+        self.reviewbutton.Bind(wx.EVT_BUTTON, self.onreview)
+
+        buttons = wx.BoxSizer(wx.HORIZONTAL)
+        buttons.Add(self.addbutton, 0, wx.ALL, 5)
+        buttons.Add(self.reviewbutton, 0, wx.ALL, 5)
+        sizer = wx.BoxSizer(wx.VERTICAL)
+        sizer.Add(self.table, 1, wx.EXPAND | wx.ALL, 5)
+        sizer.Add(buttons, 0, wx.ALIGN_RIGHT)
+        panel.SetSizer(sizer)
+
+        ConversionQueue.listeners.append(self.refresh)
+        ConversionQueue.quiet = True
+
+        self.Bind(wx.EVT_CLOSE, self.onclosewindow)
+        self.timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.ontimer, self.timer)
+        self.timer.Start(1000)
+        self.Show(True)
+
+    def onadd(self, _):
+        g = self.maininput
+        entry = {'pathdicom': g.inputdir.GetValue(), 'subjectnumber': g.subjnum.GetValue(),
+                 'subjectgroup': g.group.GetValue(), 'sessionnumber': g.sessnum.GetValue(),
+                 'categorizationfile': g.catfile.GetValue(), 'configfile': g.cfgfile.GetValue(),
+                 'outputdir': g.bidsdir.GetValue(), 'prescan': DicomPrescan(), 'scanstarted': False,
+                 'review': 'waiting'}
+
+        try:
+            entry['subject'] = bids_subject(entry['subjectnumber'], entry['subjectgroup'], entry['sessionnumber'])
+        except ValueError:
+            entry['subject'] = None
+        if not os.path.exists(entry['pathdicom']) or entry['subject'] is None:
+            d = wx.MessageDialog(None, "Please specify an existing dicom directory and a subject number!",
+                                 "INPUT ERROR!", wx.OK)
+            d.ShowModal()
+            d.Destroy()
+            return
+        if [e for e in self.entries if e['subject'] == entry['subject'] and e['outputdir'] == entry['outputdir']]:
+            d = wx.MessageDialog(None, entry['subject'] + " is already in the queue!", "INPUT ERROR!", wx.OK)
+            d.ShowModal()
+            d.Destroy()
+            return
+
+        ii = len(self.entries)
+        self.entries.append(entry)
+        self.table.InsertItem(ii, str(ii))
+        self.table.SetItem(ii, 1, entry['pathdicom'])
+        self.table.SetItem(ii, 2, entry['subject'])
+        self.refresh()
+
+    def scanahead(self):
+        # background scans of the next waiting subjects
+        running = len([e for e in self.entries if self.scanstate(e) == 'scanning'])
+        for entry in self.entries:
+            if entry['review'] != 'waiting' or entry['scanstarted']:
+                continue
+            try:
+                ahead = load_config(entry['configfile']).QueueScanAhead
+            except Exception:
+                ahead = 2
+            if running >= ahead:
+                break
+            entry['scanstarted'] = True
+            entry['prescan'].start(entry['pathdicom'], entry['configfile'])
+            running += 1
+
+    @staticmethod
+    def scanstate(entry):
+        prescan = entry['prescan']
+        if entry['review'] != 'waiting':
+            return 'done'
+        if prescan.thread is None:
+            return 'failed' if entry['scanstarted'] else 'waiting'
+        if prescan.thread.is_alive():
+            return 'scanning'
+        return 'ready'
+
+    @staticmethod
+    def subjectjobs(entry):
+        return [job for job in ConversionQueue.jobs if job['subject'] == entry['subject']]
+
+    def conversionstate(self, entry):
+        # state of the conversion started by the review of this entry
+        jobs = self.subjectjobs(entry)[entry.get('jobcount', 0):]
+        if entry['review'] == 'waiting' or not jobs:
+            return ''
+        return jobs[-1]['state']
+
+    def refresh(self):
+        if not self:
+            return
+        self.scanahead()
+        for ii, entry in enumerate(self.entries):
+            conversion = self.conversionstate(entry)
+            if entry['review'] == 'open' and conversion:
+                # confirmed in CheckSeqs (or converted without GUI)
+                entry['review'] = 'done'
+            self.table.SetItem(ii, 3, self.scanstate(entry))
+            self.table.SetItem(ii, 4, entry['review'])
+            self.table.SetItem(ii, 5, conversion)
+
+        if self.reviewing is not None and self.reviewing['review'] == 'done':
+            self.reviewing = None
+            self.reviewnext()
+
+    def ontimer(self, _):
+        self.refresh()
+
+    def onreview(self, _):
+        if self.reviewing is not None:
+            # review closed without conversion
+            self.reviewing['review'] = 'skipped'
+            self.reviewing = None
+        self.reviewnext()
+
+    def reviewnext(self):
+        waiting = [e for e in self.entries if e['review'] == 'waiting']
+        if not waiting:
+            return
+        entry = waiting[0]
+        entry['review'] = 'open'
+        entry['jobcount'] = len(self.subjectjobs(entry))
+        self.reviewing = entry
+        self.refresh()
+        CheckSubject(entry['pathdicom'], entry['subjectnumber'], entry['subjectgroup'], entry['sessionnumber'],
+                     entry['categorizationfile'], entry['configfile'], entry['outputdir'], prescan=entry['prescan'])
+
+    def onclosewindow(self, _):
+        self.timer.Stop()
+        for entry in self.entries:
+            if entry['review'] == 'waiting':
+                entry['prescan'].cancel()
+        ConversionQueue.listeners.remove(self.refresh)
+        ConversionQueue.quiet = False
+        self.Destroy()
     
 
 # #####################################################################################################################
@@ -396,25 +612,33 @@ class GetInput(wx.Frame):
 # #####################################################################################################################
 # #####################################################################################################################
 
+def load_config(configfile):
+    # import a pyBIDSconv config file as module
+    p, f = os.path.split(configfile)
+
+    # os.chdir(p)
+    if p in sys.path:
+        sys.path.remove(p)
+    sys.path.insert(0, p)
+
+    try:
+        mname = f[:-3]
+        cfg = __import__(mname, fromlist=[''])
+    except:
+        cfg = __import__(f, fromlist=[''])
+    return cfg
+
+
 class CheckSubject:
     # This class creates the main GUI for pyBIDSconv
 
     def __init__(self, pathdicom, subjectnumber, subjectgroup, sessionnumber, 
-                 categorizationfile, configfile, outputdir):
+                 categorizationfile, configfile, outputdir, prescan=None):
 
         # Check if subject already exists
         # -----------------------------------
 
-        if int(float(subjectnumber)) > 99:
-            subjnum = str(subjectnumber)
-        else:
-            if int(float(subjectnumber)) > 9:
-                subjnum = "0" + str(subjectnumber)
-            else:
-                subjnum = "00" + str(subjectnumber)
-
-        if subjectgroup:
-            subjnum = subjectgroup + subjnum
+        subjnum = bids_subjnum(subjectnumber, subjectgroup)
 
         subject = "sub-" + subjnum
         subjectfolder = os.path.join(outputdir, subject)
@@ -467,7 +691,7 @@ class CheckSubject:
                                            " from the BIDS directory: " + outputdir + " \n\n"
 
                             GetDCMinfo(pathdicom, subjectnumber, subjectgroup, sessionnumber, categorizationfile, 
-                                       configfile, outputdir, subjtext2log)
+                                       configfile, outputdir, subjtext2log, prescan=prescan)
 
                         except OSError as ex:
                             print(ex)
@@ -535,7 +759,7 @@ class CheckSubject:
                                                str(sessionnumber) + " from the BIDS directory: " + outputdir + " \n\n"
 
                                 GetDCMinfo(pathdicom, subjectnumber, subjectgroup, sessionnumber, categorizationfile, 
-                                           configfile, outputdir, subjtext2log)
+                                           configfile, outputdir, subjtext2log, prescan=prescan)
 
                             except OSError as ex:
                                 print(ex)
@@ -543,553 +767,2072 @@ class CheckSubject:
                     else:  # if session subfolder does not exist
 
                         GetDCMinfo(pathdicom, subjectnumber, subjectgroup, sessionnumber, categorizationfile, 
-                                   configfile, outputdir, subjtext2log)
+                                   configfile, outputdir, subjtext2log, prescan=prescan)
 
         else:
             # if subject does not exist simply go ahead
             # ----------------------------------------------
             GetDCMinfo(pathdicom, subjectnumber, subjectgroup, sessionnumber, categorizationfile, configfile, 
-                       outputdir, subjtext2log)
-
+                       outputdir, subjtext2log, prescan=prescan)
 
-class GetDCMinfo:
-    def __init__(self, pathdicom, subjectnumber, subjectgroup, sessionnumber, categorizationfile, configfile,
-                 outputdir, subjtext2log):
-
-        # ---------------------------
-        # import config file
-        # ---------------------------
-        cwd = os.getcwd()
 
-        p, f = os.path.split(configfile)
+# #####################################################################################################################
+# #####################################################################################################################
+#
+# Dicom header scan
+#
+# #####################################################################################################################
+# #####################################################################################################################
 
-        # os.chdir(p)
-        sys.path.insert(0, p)
+# header values of one dicom file needed for grouping and categorization
+DicomHeader = namedtuple('DicomHeader', ['seriesnumber', 'seriesdescription', 'imagetype', 'acqtime', 'acqdate',
+                                         'echotime', 'echonumber', 'sequencename', 'acqtype', 'dti', 'patage',
+                                         'patsex'])
+
+
+def read_dicom_header(dcmfile):
+    # read the header of a dicom file (filename or open file object) and return a DicomHeader
+    # only the header is read (stop_before_pixels), the pixel data is never used for the categorization
+
+    dcm = pydicom.read_file(dcmfile, stop_before_pixels=True)
+
+    try:
+        patage = str(int(re.sub("Y", "", dcm.PatientAge)))
+        patsex = str(dcm.PatientSex)
+    except:
+        patage = ''
+        patsex = ''
+
+    try:
+        a1 = dcm.AcquisitionDate
+        a2 = dcm.AcquisitionTime
+        acqtime = a1[0:4] + "-" + a1[4:6] + "-" + a1[6:8] + "T" + a2[0:2] + ":" + a2[2:4] + ":" + a2[4:6]
+        acqdate = a1[0:4] + "-" + a1[4:6] + "-" + a1[6:8]
+    except:
+        acqtime = "n/a"
+        acqdate = "n/a"
+
+    try:
+        echotime = float(dcm.EchoTime)
+    except:
+        echotime = ""
+    try:
+        echonumber = int(dcm.EchoNumber)
+    except:
+        echonumber = ""
+    try:
+        sequencename = str(dcm.SequenceName)
+    except:
+        sequencename = " "
+    try:
+        acqtype = str(dcm.MRAcquisitionType)
+    except:
+        acqtype = " "
+
+    # diffusion info in private tags of the different manufacturers, one value per file (the former per file
+    # appends to dti_array added two or three values for each file; un_dti is not read by the categorization)
+    dti = 0
+    try:
+        if dcm.Manufacturer == "SIEMENS":
+            if dcm[0x0019, 0x100C]:
+                dti = 1
+        elif dcm.Manufacturer == "PHILIPS":
+            if dcm[0x0018, 0x9089]:
+                dti = 1
+            elif dcm[0x2001, 0x1004]:
+                dti = 1
+        elif dcm.Manufacturer == "GE":
+            if dcm[0x0019, 0x10BC]:
+                dti = 1
+    except:
+        pass
+
+    return DicomHeader(float(dcm.SeriesNumber), str(dcm.SeriesDescription), [str(x) for x in dcm.ImageType],
+                       acqtime, acqdate, echotime, echonumber, sequencename, acqtype, dti, patage, patsex)
+
+
+def pybidsconv_cachedir():
+    # folder for the persistent caches of pyBIDSconv
+    cachedir = os.path.join(os.path.expanduser('~'), '.pyBIDSconv')
+    if not os.path.exists(cachedir):
+        os.makedirs(cachedir)
+    return cachedir
+
+
+def check_cancelled(cancelled):
+    # stop a scan (raise ScanCancelled) once the cancelled event is set
+    if cancelled is not None and cancelled.is_set():
+        raise ScanCancelled()
+
+
+def find_dicom_files(pathdicom, cancelled=None):
+    # list the dicom files of a subject folder or a .zip/.tar(.gz) archive
+
+    if DicomArchive.isarchive(pathdicom):
+        return DicomArchive.get(pathdicom).paths()
+
+    list_dicom_files = []  # create an empty list
+    for dirName, subdirList, fileList in os.walk(pathdicom):
+        check_cancelled(cancelled)
+        for filename in fileList:
+            if ".dcm" in filename.lower():  # check whether the file's DICOM
+                list_dicom_files.append(os.path.join(dirName, filename))
+    return list_dicom_files
+
+
+def copy_dicom_file(src, dst):
+    # copy a dicom file (or extract an archive member) to dst (file or folder)
+    if DicomArchive.separator in src:
+        DicomArchive.extract([src], dst)
+    else:
+        shutil.copy2(src, dst)
+
+
+class DicomArchive:
+    # Read access to the dicom files in a .zip or .tar(.gz/.bz2) archive without extracting the archive.
+    # Members are addressed as "<archive>::<member>". The archive is indexed once (the index and the headers read so
+    # far are cached in the pyBIDSconv cache folder), headers are read from the first bytes of each member only and
+    # extraction writes only the requested members. The archive stays open for all reads of a scan or an extraction
+    # (opening a zip file reads its whole central directory), shared by the threads under a lock.
+
+    separator = '::'
+    headerprefix = 65536
+    extensions = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2')
+    archives = {}
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        st = os.stat(self.path)
+        self.stamp = [st.st_size, st.st_mtime]
+        self.iszip = self.path.lower().endswith('.zip')
+        self.members = []
+        self.offsets = {}
+        self.records = {}
+        self.changed = False
+        self.handle = None
+        self.lock = threading.RLock()
+        self.cachefile = os.path.join(pybidsconv_cachedir(),
+                                      'archive_' + hashlib.md5(self.path.encode('utf-8')).hexdigest() + '.json')
 
         try:
-            mname = f[:-3]
-            cfg = __import__(mname, fromlist=[''])
-        except:
-            cfg = __import__(f, fromlist=[''])
+            with open(self.cachefile) as f:
+                cache = json.load(f)
+            if cache['stamp'] != self.stamp:
+                raise ValueError
+            self.members = cache['members']
+            self.offsets = dict((k, tuple(v)) for k, v in cache['offsets'].items())
+            self.records = dict((k, DicomHeader(*v)) for k, v in cache['records'].items())
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            self.index()
+
+    @classmethod
+    def isarchive(cls, path):
+        return os.path.isfile(path) and path.lower().endswith(cls.extensions)
+
+    @classmethod
+    def get(cls, path):
+        path = os.path.abspath(path)
+        if path not in cls.archives:
+            cls.archives[path] = DicomArchive(path)
+        return cls.archives[path]
+
+    @classmethod
+    def split(cls, filename):
+        archivepath, member = filename.split(cls.separator, 1)
+        return cls.get(archivepath), member
 
-        # os.chdir(cwd)
-
-        # -------------------------------------------------
-        # get decision rules from categorization file
-        # -------------------------------------------------
-        rule_seq_type = []
-        rule_seq_act = []
-        rule_seq_desc = []
-        rule_seq_name = []
-        rule_label = []
-
-        # with open('/media/michael/SSD/DICOM_to_BIDS_test/CINNrules_DCM2BIDS.txt') as infile:
-        with open(categorizationfile) as infile:
-            for line in infile:
-                tsplit = line.split("\t")
-                rule_seq_type.append(tsplit[0])
-                rule_seq_name.append(tsplit[1])
-                rule_seq_act.append(tsplit[2])
-                rule_seq_desc.append(tsplit[3])
-                rule_label.append(tsplit[4])
-
-        # get uniques of columns in categorization file
-        unique_seq_name = list(set(rule_seq_name))
-        unique_seq_act = list(set(rule_seq_act))
-        unique_seq_desc = list(set(rule_seq_desc))
-
-        # create empty dict
-        dictname = {}
-        dictact = {}
-        dictdesc = {}
-
-        # create dictionaries of indices
-        for ii in range(len(unique_seq_name)):
-            indices = [i for i, x in enumerate(rule_seq_name) if x == unique_seq_name[ii]]
-            # Fill in the entries one by one
-            dictname[unique_seq_name[ii]] = indices
-
-        for ii in range(len(unique_seq_act)):
-            indices = [i for i, x in enumerate(rule_seq_act) if x == unique_seq_act[ii]]
-            # Fill in the entries one by one
-            dictact[unique_seq_act[ii]] = indices
-
-        for ii in range(len(unique_seq_desc)):
-            indices = [i for i, x in enumerate(rule_seq_desc) if x == unique_seq_desc[ii]]
-            # Fill in the entries one by one
-            dictdesc[unique_seq_desc[ii]] = indices
-
-        # ----------------------
-        # get dicom info
-        # ----------------------
-        list_dicom_files = []  # create an empty list
-        for dirName, subdirList, fileList in os.walk(pathdicom):
-            for filename in fileList:
-                if ".dcm" in filename.lower():  # check whether the file's DICOM
-                    list_dicom_files.append(os.path.join(dirName, filename))
-
-        nr_dcm_files = len(list_dicom_files)
-        if nr_dcm_files == 0:
-            # f1 = wx.App()
-            winfo = "No dicom files found in : " + pathdicom + " \nPlease check if your input was correct!! \n"
-            d = wx.MessageDialog(
-                None, winfo, 
-                "Warning", wx.OK | wx.ICON_QUESTION)
-            d.ShowModal()
-            d.Destroy()
+    @staticmethod
+    def headercomplete(data):
+        # the header is complete if the pixel data element (7FE0,0010) starts within data
+        return b'\xe0\x7f\x10\x00' in data
+
+    def index(self):
+        # list the dicom members; tar archives can only be read as a stream, so their headers are read in the same
+        # single pass
+        if self.iszip:
+            with zipfile.ZipFile(self.path) as zf:
+                for info in zf.infolist():
+                    if not info.filename.endswith('/') and ".dcm" in os.path.basename(info.filename).lower():
+                        self.members.append(info.filename)
+        else:
+            tf = tarfile.open(self.path, 'r|*')
+            for member in tf:
+                if member.isfile() and ".dcm" in os.path.basename(member.name).lower():
+                    self.members.append(member.name)
+                    self.offsets[member.name] = (member.offset_data, member.size)
+                    f = tf.extractfile(member)
+                    data = f.read(self.headerprefix)
+                    if not self.headercomplete(data):
+                        data = data + f.read()
+                    self.records[member.name] = read_dicom_header(io.BytesIO(data))
+            tf.close()
+        self.changed = True
+        self.save()
+
+    def save(self):
+        if not self.changed:
             return
+        cache = {'stamp': self.stamp, 'members': self.members, 'offsets': self.offsets,
+                 'records': dict((k, list(v)) for k, v in self.records.items())}
+        try:
+            with open(self.cachefile, 'w') as f:
+                json.dump(cache, f)
+            self.changed = False
+        except (IOError, OSError):
+            pass
 
-        sn_array = np.array([])
-        seq_array = np.array([])
-        seqname_array = np.array([])
-        act_array = np.array([])
-        acq_time_list = []
-        acq_date_list = []
-        it_val_list = []
-        it_len_array = np.array([])
-        echotime_array = np.array([])
-        echonumber_array = np.array([])
-
-        # multiband_array = np.array([])
-        dti_array = np.array([])
-
-        patinfo = [''] * 2
-
-        print('Load dicom file info\n')
-        # ------------------------------------------
-        # Loop over dicom files
-        # ------------------------------------------
-        for ii in range(len(list_dicom_files)):
-            self.progress(ii, nr_dcm_files)
+    def paths(self):
+        return [self.path + self.separator + m for m in self.members]
 
-            dcm = pydicom.read_file(list_dicom_files[ii])
+    def openarchive(self):
+        # (with lock) the open zip or tar file
+        if self.handle is None:
+            if self.iszip:
+                self.handle = zipfile.ZipFile(self.path)
+            else:
+                self.handle = tarfile.open(self.path, 'r:*')
+        return self.handle
+
+    def close(self):
+        with self.lock:
+            if self.handle is not None:
+                self.handle.close()
+                self.handle = None
+
+    def header(self, member):
+        if member not in self.records:
+            with self.lock:
+                f = self.openarchive().open(member)
+                data = f.read(self.headerprefix)
+                if not self.headercomplete(data):
+                    data = data + f.read()
+                f.close()
+            self.records[member] = read_dicom_header(io.BytesIO(data))
+            self.changed = True
+        return self.records[member]
+
+    def readmembers(self, members):
+        # yield (member, data) for the given members; tar members are read in archive order in one forward pass
+        if self.iszip:
+            for member in members:
+                with self.lock:
+                    data = self.openarchive().read(member)
+                yield member, data
+        else:
+            for member in sorted(members, key=lambda m: self.offsets[m][0]):
+                offset, size = self.offsets[member]
+                with self.lock:
+                    fileobj = self.openarchive().fileobj
+                    fileobj.seek(offset)
+                    data = fileobj.read(size)
+                yield member, data
+
+    @classmethod
+    def readheader(cls, filename):
+        archive, member = cls.split(filename)
+        return archive.header(member)
+
+    @classmethod
+    def extract(cls, filenames, dst):
+        # write the given archive members to dst (folder, or filename for a single member)
+        bymember = {}
+        for filename in filenames:
+            archive, member = cls.split(filename)
+            bymember.setdefault(archive.path, []).append(member)
+
+        for archivepath, members in bymember.items():
+            for member, data in cls.get(archivepath).readmembers(members):
+                if os.path.isdir(dst):
+                    dest = os.path.join(dst, os.path.basename(member))
+                else:
+                    dest = dst
+                with open(dest, 'wb') as f:
+                    f.write(data)
+            cls.get(archivepath).close()
+
+
+class DicomDirIndex:
+    # Discovery of the series and files of a session from its DICOMDIR (e.g. CD/DVD exports).
+    # The series number, description and file list come from the directory records. The remaining header values are
+    # read from one representative file per series; the echo times of a series are sampled at its first, second,
+    # middle and last file and all files of the series are only read if these differ (multi echo series).
+
+    def __init__(self, dicomdirfile):
+        self.root = os.path.dirname(dicomdirfile)
+        self.series = []
+
+        dcmdir = pydicom.read_file(dicomdirfile, stop_before_pixels=True)
+
+        # directory records are stored depth first (patient > study > series > image)
+        current = None
+        for rec in dcmdir.DirectoryRecordSequence:
+            rectype = rec.DirectoryRecordType
+            if rectype == "SERIES":
+                current = {'seriesnumber': rec.get('SeriesNumber', ''),
+                           'seriesdescription': rec.get('SeriesDescription', None),
+                           'files': []}
+                self.series.append(current)
+            elif rectype == "IMAGE" and current is not None:
+                fileid = rec.ReferencedFileID
+                if hasattr(fileid, "strip"):
+                    fileid = [fileid]
+                current['files'].append(os.path.join(self.root, *[str(x) for x in fileid]))
+
+        self.series = [se for se in self.series if se['files']]
 
-            if patinfo[0] == '':
+    @staticmethod
+    def find(pathdicom):
+        if not os.path.isdir(pathdicom):
+            return None
+        for filename in os.listdir(pathdicom):
+            if filename.upper() == "DICOMDIR":
                 try:
-                    patinfo[0] = str(int(re.sub("Y", "", dcm.PatientAge)))
-                    patinfo[1] = dcm.PatientSex
-                except:
-                    pass
-
-            sn_array = np.append(sn_array, dcm.SeriesNumber)
-            seq_array = np.append(seq_array, dcm.SeriesDescription)
-            it_val_list.append(dcm.ImageType)
-            it_len_array = np.append(it_len_array, len(dcm.ImageType))
+                    return DicomDirIndex(os.path.join(pathdicom, filename))
+                except Exception as ex:
+                    print("DICOMDIR could not be read, scanning all files instead: " + str(ex))
+                    return None
+        return None
+
+    def files(self):
+        return [f for se in self.series for f in se['files']]
+
+    def scan(self, progress=None):
+        records = []
+        for ii, se in enumerate(self.series):
+            if progress is not None:
+                progress(ii, len(self.series))
+
+            files = se['files']
+            rep = read_dicom_header(files[0])
+            if se['seriesnumber'] != '':
+                rep = rep._replace(seriesnumber=float(se['seriesnumber']))
+            if se['seriesdescription'] is not None:
+                rep = rep._replace(seriesdescription=str(se['seriesdescription']))
+
+            samples = [rep] + [read_dicom_header(files[k]) for k in sorted(set([1, len(files) // 2, len(files) - 1]))
+                               if 0 < k < len(files)]
+            if all(r.echotime == rep.echotime for r in samples):
+                records.extend([rep] * len(files))
+            else:
+                records.append(rep)
+                for filename in files[1:]:
+                    r = read_dicom_header(filename)
+                    records.append(rep._replace(echotime=r.echotime, echonumber=r.echonumber))
 
-            try:
-                a1 = dcm.AcquisitionDate
-                a2 = dcm.AcquisitionTime
-                dat = a1[0:4] + "-" + a1[4:6] + "-" + a1[6:8] + "T" + a2[0:2] + ":" + a2[2:4] + ":" + a2[4:6]
-                acq_time_list.append(dat)
-                dat2 = a1[0:4] + "-" + a1[4:6] + "-" + a1[6:8]
-                acq_date_list.append(dat2)
-            except:
-                acq_time_list.append("n/a")
-                acq_date_list.append("n/a")
+        return records
 
-            try:
-                echotime_array = np.append(echotime_array, dcm.EchoTime)
-            except:
-                echotime_array = np.append(echotime_array, "")
-            try:
-                echonumber_array = np.append(echonumber_array, dcm.EchoNumber)
-            except:
-                echonumber_array = np.append(echonumber_array, "")
 
-            try:
-                seqname_array = np.append(seqname_array, dcm.SequenceName)
-            except:
-                seqname_array = np.append(seqname_array, " ")
-            try:
-                act_array = np.append(act_array, dcm.MRAcquisitionType)
-            except:
-                act_array = np.append(act_array, " ")
+class DicomFolderSnapshot:
+    # Snapshot of a subject dicom folder (mtime, entry count, subfolders and the header records of the dicom files
+    # of each directory) stored in the pyBIDSconv cache folder. A rescan lists only directories whose mtime changed
+    # and reads only new or modified files (size or mtime changed, files rewritten in place leave the mtime of the
+    # directory unchanged), the records of all other files are taken from the snapshot.
 
-            if dcm.Manufacturer == "SIEMENS":
-                # try:
-                # if dcm[0x0019, 0x1029]:
-                # multiband_array = np.append(multiband_array, 1)
-                # else:
-                # multiband_array = np.append(multiband_array, 0)
-                # except:
-                # multiband_array = np.append(multiband_array, 0)
+    # directories and files modified this close (s) to the time of the snapshot are always read again (coarse mtimes)
+    racywindow = 2.0
 
+    def __init__(self, pathdicom, cancelled=None):
+        self.root = os.path.abspath(pathdicom)
+        self.cancelled = cancelled
+        self.cachefile = os.path.join(pybidsconv_cachedir(),
+                                      'snapshot_' + hashlib.md5(self.root.encode('utf-8')).hexdigest() + '.json')
+        try:
+            with open(self.cachefile) as f:
+                old = json.load(f)
+            self.olddirs = old['dirs']
+            self.oldtime = old['time']
+        except (IOError, OSError, ValueError, KeyError):
+            self.olddirs = {}
+            self.oldtime = 0
+
+        self.dirs = {}
+        self.snaptime = time.time()
+        self.relfiles = []  # (reldir, filename) in os.walk order
+        self.nrlisted = 0
+        self.walk('')
+
+    def walk(self, reldir):
+        check_cancelled(self.cancelled)
+        path = os.path.join(self.root, reldir)
+        mtime = os.stat(path).st_mtime
+        old = self.olddirs.get(reldir)
+
+        if old is not None and old['mtime'] == mtime and mtime < self.oldtime - self.racywindow:
+            # same entries, stat the files only
+            snap = old
+            for entry in list(snap['order']):
+                check_cancelled(self.cancelled)
                 try:
-                    if dcm[0x0019, 0x100C]:
-                        dti_array = np.append(dti_array, 1)
-                    else:
-                        dti_array = np.append(dti_array, 0)
-                except:
-                    dti_array = np.append(dti_array, 0)
+                    st = os.stat(os.path.join(path, entry))
+                except OSError:
+                    snap['order'].remove(entry)
+                    del snap['files'][entry]
+                    continue
+                snap['files'][entry] = self.filerecord(st, snap['files'][entry])
+        else:
+            self.nrlisted += 1
+            entries = os.listdir(path)
+            snap = {'mtime': mtime, 'nentries': len(entries), 'subdirs': [], 'files': {}, 'order': []}
+            oldfiles = old['files'] if old is not None else {}
+            for entry in entries:
+                check_cancelled(self.cancelled)
+                full = os.path.join(path, entry)
+                if os.path.isdir(full):
+                    snap['subdirs'].append(entry)
+                elif ".dcm" in entry.lower():
+                    st = os.stat(full)
+                    snap['order'].append(entry)
+                    snap['files'][entry] = self.filerecord(st, oldfiles.get(entry))
+
+        self.dirs[reldir] = snap
+        for entry in snap['order']:
+            self.relfiles.append((reldir, entry))
+        for subdir in snap['subdirs']:
+            self.walk(os.path.join(reldir, subdir))
+
+    def filerecord(self, st, oldrec):
+        # [size, mtime, header record]; the header is read again (None) if the file changed
+        if (oldrec is not None and oldrec[0] == st.st_size and oldrec[1] == st.st_mtime and
+                st.st_mtime < self.oldtime - self.racywindow):
+            return oldrec
+        return [st.st_size, st.st_mtime, None]
+
+    def files(self):
+        return [os.path.join(self.root, reldir, entry) for reldir, entry in self.relfiles]
+
+    def scan(self, readorder='', progress=None):
+        # merge cached records with fresh reads of new/changed files and store the new snapshot
+        files = self.files()
+        records = [None] * len(files)
+        missing = []
+        for ii, (reldir, entry) in enumerate(self.relfiles):
+            cached = self.dirs[reldir]['files'][entry][2]
+            if cached is None:
+                missing.append(ii)
+            else:
+                records[ii] = DicomHeader(*cached)
 
-            elif dcm.Manufacturer == "PHILIPS":
-                # try:
-                # if dcm[0x0019, 0x1029]:  # #################################### needs to be adjusted
-                # multiband_array = np.append(multiband_array, 1)
-                # else:
-                # multiband_array = np.append(multiband_array, 0)
-                # except:
-                # multiband_array = np.append(multiband_array, 0)
+        print("Rescan: %d of %d directories listed, %d of %d files read" %
+              (self.nrlisted, len(self.dirs), len(missing), len(files)))
 
-                try:
-                    if dcm[0x0018, 0x9089]:
-                        dti_array = np.append(dti_array, 1)
-                    else:
-                        dti_array = np.append(dti_array, 0)
-                except:
-                    dti_array = np.append(dti_array, 0)
-                try:
-                    if dcm[0x2001, 0x1004]:
-                        dti_array = np.append(dti_array, 1)
-                    else:
-                        dti_array = np.append(dti_array, 0)
-                except:
-                    dti_array = np.append(dti_array, 0)
+        fresh = scan_dicom_headers([files[ii] for ii in missing], readorder, progress, cancelled=self.cancelled)
+        for ii, record in zip(missing, fresh):
+            records[ii] = record
+            reldir, entry = self.relfiles[ii]
+            self.dirs[reldir]['files'][entry][2] = list(record)
 
-            elif dcm.Manufacturer == "GE":
-                # try:
-                # if dcm[0x0019, 0x1029]:  # #################################### needs to be adjusted
-                # multiband_array = np.append(multiband_array, 1)
-                # else:
-                # multiband_array = np.append(multiband_array, 0)
-                # except:
-                # multiband_array = np.append(multiband_array, 0)
+        try:
+            with open(self.cachefile, 'w') as f:
+                json.dump({'time': self.snaptime, 'dirs': self.dirs}, f)
+        except (IOError, OSError):
+            pass
 
-                try:
-                    if dcm[0x0019, 0x10BC]:
-                        dti_array = np.append(dti_array, 1)
-                    else:
-                        dti_array = np.append(dti_array, 0)
-                except:
-                    dti_array = np.append(dti_array, 0)
+        return records
 
-            try:
-                if dcm.Manufacturer == "SIEMENS":
-                    if dcm[0x0019, 0x100C]:
-                        dti_array = np.append(dti_array, 1)
-                    else:
-                        dti_array = np.append(dti_array, 0)
-                elif dcm.Manufacturer == "PHILIPS":
-                    if dcm[0x0018, 0x9089]:
-                        dti_array = np.append(dti_array, 1)
-                    elif dcm[0x2001, 0x1004]:
-                        dti_array = np.append(dti_array, 1)
-                    else:
-                        dti_array = np.append(dti_array, 0)
-                elif dcm.Manufacturer == "GE":
-                    if dcm[0x0019, 0x10BC]:
-                        dti_array = np.append(dti_array, 1)
-                    else:
-                        dti_array = np.append(dti_array, 0)
-            except:
-                dti_array = np.append(dti_array, 0)
 
-            # try:
-            # if dcm.Private_0019_1029:
-            # dti_array = np.append(dtiname_array, 1)
-            # else:
-            # dti_array = np.append(dtiname_array, 0)
-            # except:
-            # dti_array = np.append(dtiname_array, 0)
+# fixed width record of one dicom file written by the scan workers into shared memory (strings as ids into the
+# string table of the worker), flags: 1 = dti, 2 = EchoTime present, 4 = EchoNumber present, 8 = read error
+shared_header_dtype = np.dtype([('sn', np.float64), ('echotime', np.float64), ('echonumber', np.int32),
+                                ('flags', np.uint8), ('seqdesc', np.int32), ('seqname', np.int32),
+                                ('acqtype', np.int32), ('imagetype', np.int32), ('acqtime', np.int32),
+                                ('acqdate', np.int32), ('patage', np.int32), ('patsex', np.int32)])
+shared_header_strings = ('seqdesc', 'seqname', 'acqtype', 'imagetype', 'acqtime', 'acqdate', 'patage', 'patsex')
 
-        it_len_array = it_len_array.astype(int)
+# shared buffer of a scan worker process (set by shared_scan_init)
+shared_scan_buffer = None
 
-        # ----------------------
-        # check acq dates
-        # ----------------------
-        acq_date_list_red = list(filter(lambda l: l != "n/a", acq_date_list))
-        x = list(set(acq_date_list_red))
-        if not all(cx == acq_date_list_red[0] for cx in acq_date_list_red):
-            winfo1 = "Folder: \n" + pathdicom + "\n"
-            winfo2 = "contains data from two different scan sessions/dates:\n"
-            winfo3 = ""
-            for ii in range(len(x)):
-                winfo3 = winfo3 + str(ii+1) + ": " + x[ii] + "\n"
-            winfo3 = winfo3 + "\n"
-            winfo4 = "It is recommended to store the two scan dates as two sessions! \n\n"
-            winfo5 = "Press YES, to go further to store both scan dates in one session\n"
-            winfo6 = "or press NO to seperate the scan dates and start again. "
-            d = wx.MessageDialog(
-                None, winfo1 + winfo2 + winfo3 + winfo4 + winfo5 + winfo6,
-                "Warning", wx.YES_NO | wx.NO_DEFAULT | wx.ICON_QUESTION)
-            answer = d.ShowModal()
-            d.Destroy()
 
-            if answer == wx.ID_YES:
-                # for ii in
-                for nn in range(1, len(x)):
-                    fidx = np.asarray([i for i, e in enumerate(acq_date_list) if e == x[nn]])
-                    sn_array[fidx] = sn_array[fidx]+nn*100
+def shared_scan_init(buf):
+    global shared_scan_buffer
+    if isinstance(buf, str):
+        from multiprocessing import shared_memory
+        shared_scan_buffer = shared_memory.SharedMemory(name=buf)
+    else:
+        shared_scan_buffer = buf
 
-            elif answer == wx.ID_NO:
 
-                winfo = "Should pyBIDSconv seperate the scans for you? \n(If YES, new directories with copies of the data will created"
-                d = wx.MessageDialog(
-                    None, winfo,
-                    "Warning", wx.YES_NO | wx.ICON_QUESTION)
-                answer2 = d.ShowModal()
-                d.Destroy()
+def shared_scan_chunk(args):
+    # scan worker: read the headers of files[start:stop] and write them to the shared records
+    start, files, readorder = args
+    startbytes = read_bytes()
+    buf = shared_scan_buffer.buf if hasattr(shared_scan_buffer, 'buf') else shared_scan_buffer
+    rows = np.frombuffer(buf, dtype=shared_header_dtype)
 
-                if answer2 == wx.ID_YES:
-                    dialog = wx.DirDialog(None, "Choose output path for the directories of the separated scans:",
-                                          style=wx.DD_DEFAULT_STYLE | wx.DD_NEW_DIR_BUTTON)
-                    if dialog.ShowModal() == wx.ID_OK:
-                        newdir = dialog.GetPath()
+    strings = {}
+    errors = []
+    for jj, filename in DicomIOScheduler(files, readorder):
+        row = rows[start + jj]
+        try:
+            r = read_dicom_header(filename)
+        except Exception as ex:
+            row['flags'] = 8
+            errors.append(filename + ": " + str(ex))
+            continue
+        values = [r.seriesdescription, r.sequencename, r.acqtype, '\\'.join(r.imagetype), r.acqtime, r.acqdate,
+                  r.patage, r.patsex]
+        for field, value in zip(shared_header_strings, values):
+            row[field] = strings.setdefault(value, len(strings))
+        row['sn'] = r.seriesnumber
+        row['flags'] = r.dti
+        if r.echotime != "":
+            row['echotime'] = r.echotime
+            row['flags'] |= 2
+        if r.echonumber != "":
+            row['echonumber'] = r.echonumber
+            row['flags'] |= 4
+    del rows
+
+    stringlist = [''] * len(strings)
+    for value, sid in strings.items():
+        stringlist[sid] = value
+    nbytes = read_bytes() - startbytes if startbytes is not None else 0
+    return start, len(files), stringlist, errors, nbytes
+
+
+class SharedHeaderScan:
+    # Parallel header scan: worker processes write fixed width records (shared_header_dtype) directly into a shared
+    # memory buffer (multiprocessing.shared_memory, or a RawArray where that is not available) and only send their
+    # string tables back. The parent maps the string ids to a global table and builds the DicomHeaderTable on a
+    # zero copy view of the buffer. With a controller (AdaptiveConcurrency) only controller.level chunks are read at
+    # the same time.
+
+    chunksize = 256
+
+    def __init__(self, list_dicom_files, workers, readorder='', controller=None):
+        self.files = list_dicom_files
+        self.workers = workers
+        self.readorder = readorder
+        self.controller = controller
+
+    def run(self, progress=None):
+        n = len(self.files)
+        nbytes = max(1, n * shared_header_dtype.itemsize)
+        try:
+            from multiprocessing import shared_memory
+            shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            buf, initarg = shm.buf, shm.name
+        except ImportError:
+            shm = multiprocessing.RawArray('b', nbytes)
+            buf, initarg = shm, shm
+
+        table = None
+        try:
+            rows = np.frombuffer(buf, dtype=shared_header_dtype, count=n)
+            rows[:] = np.zeros(1, dtype=shared_header_dtype)
+
+            tasks = [(start, list(self.files[start:start + self.chunksize]), self.readorder)
+                     for start in range(0, n, self.chunksize)]
+            pool = multiprocessing.Pool(self.workers, initializer=shared_scan_init, initargs=(initarg,))
+            strings = {}
+            errors = []
+            done = 0
+            try:
+                for start, count, stringlist, chunkerrors, _ in self.results(pool, tasks):
+                    # map the worker string ids to global ids
+                    mapping = np.array([strings.setdefault(value, len(strings)) for value in stringlist] or [0],
+                                       dtype=np.int32)
+                    chunk = rows[start:start + count]
+                    for field in shared_header_strings:
+                        chunk[field] = mapping[chunk[field]]
+                    errors.extend(chunkerrors)
+                    done += count
+                    if progress is not None:
+                        progress(done, n)
+            except BaseException:
+                # cancelled or failed: the remaining chunks are not read
+                pool.terminate()
+                pool.join()
+                raise
+            pool.close()
+            pool.join()
+
+            if errors:
+                raise IOError("Could not read dicom files:\n" + "\n".join(errors[:10]))
+
+            stringlist = [''] * len(strings)
+            for value, sid in strings.items():
+                stringlist[sid] = value
+
+            table = DicomHeaderTable.fromshared(rows, stringlist)
+            table.shm = shm
+        finally:
+            # the segment is unlinked in any case; the mapping of this process stays valid until table.close()
+            rows = chunk = None
+            if hasattr(shm, 'unlink'):
+                shm.unlink()
+                if table is None:
+                    shm.close()
+        return table
+
+    def results(self, pool, tasks):
+        # chunk results as they are finished
+        if self.controller is None:
+            for result in pool.imap_unordered(shared_scan_chunk, tasks):
+                yield result
+            return
+        pending = list(tasks)
+        running = []
+        while pending or running:
+            while pending and len(running) < self.controller.level:
+                running.append(pool.apply_async(shared_scan_chunk, (pending.pop(0),)))
+            finished = [r for r in running if r.ready()]
+            if not finished:
+                running[0].wait(0.01)
+                continue
+            for r in finished:
+                running.remove(r)
+                result = r.get()
+                self.controller.done(result[1], result[4])
+                yield result
+
+
+class HeaderInterner:
+    # Low memory mode: shares equal strings between header records and replaces ImageType by a code into
+    # self.imagetypes
+
+    stringfields = ('seriesdescription', 'acqtime', 'acqdate', 'sequencename', 'acqtype', 'patage', 'patsex')
 
-                        for nn in range(len(x)):
-                            directory = os.path.join(newdir, x[nn])
-                            if not os.path.exists(directory):
-                                os.makedirs(directory)
+    def __init__(self):
+        self.strings = {}
+        self.imagetypes = []
+        self.imagetypecodes = {}
 
-                            fidx = np.asarray([i for i, e in enumerate(acq_date_list) if e == x[nn]])
-                            for ii in range(len(fidx)):
-                                file = list_dicom_files[fidx[ii]]
-                                filename = os.path.basename(file)
-                                dst = os.path.join(directory, filename)
-                                shutil.copyfile(file, dst)
+    def __call__(self, record):
+        values = dict((field, self.strings.setdefault(getattr(record, field), getattr(record, field)))
+                      for field in self.stringfields)
+        it = tuple(record.imagetype)
+        if it not in self.imagetypecodes:
+            self.imagetypecodes[it] = len(self.imagetypes)
+            self.imagetypes.append(list(it))
+        values['imagetype'] = self.imagetypecodes[it]
+        return record._replace(**values)
 
-                    winfo = "Data copied!\n\nPlease press OK to close pyBIDSconv and start again."
-                    d = wx.MessageDialog(
-                        None, winfo,
-                        "Warning", wx.OK | wx.ICON_QUESTION)
-                    answer3 = d.ShowModal()
-                    d.Destroy()
 
-                    if answer3 == wx.ID_OK:
-                        quit()
+class ImageTypeList:
+    # list like view of ImageType values stored as codes
+    def __init__(self, codes, imagetypes):
+        self.codes = codes
+        self.imagetypes = imagetypes
 
-                elif answer2 == wx.ID_NO:
-                    quit()
+    def __len__(self):
+        return len(self.codes)
 
-        # --------------------------
-        # duplicate series numbers
-        # --------------------------
+    def __getitem__(self, ii):
+        return self.imagetypes[self.codes[ii]]
 
-        for oo in np.unique(sn_array):
-            idx = np.where(sn_array == oo)
 
-            nr_unique_seqnames = len(np.unique(seq_array[idx]))
-            unique_seqnames = np.unique(seq_array[idx])
+class StringCodeList:
+    # list like view of a string column stored as codes into its distinct values (acquisition date and time in low
+    # memory mode)
+    def __init__(self, codes, values):
+        self.codes = codes
+        self.values = values
 
-            if nr_unique_seqnames > 1:
+    @staticmethod
+    def fromvalues(values):
+        codes = {}
+        array = np.fromiter((codes.setdefault(v, len(codes)) for v in values), dtype=np.int32)
+        distinct = [None] * len(codes)
+        for v, code in codes.items():
+            distinct[code] = v
+        return StringCodeList(array, distinct)
 
-                winfo1 = "Folder: \n" + pathdicom + "\n"
-                winfo2 = "contains duplicate series number of two different scans:\n"
-                winfo3 = ""
-                for ii in range(len(unique_seqnames)):
-                    winfo3 = winfo3 + str(ii + 1) + ": " + unique_seqnames[ii] + "\n"
-                winfo3 = winfo3 + "\n"
-                winfo4 = "Please check if the data is correct! \n\n"
-                winfo5 = "Press YES, to go further to store all scans in one session\n"
-                winfo6 = "(Session with double numbers will be added at the end of the GUI list). "
-                winfo7 = "or press NO to correct the raw data folder and start again. "
+    def __len__(self):
+        return len(self.codes)
 
-                d = wx.MessageDialog(
-                    None, winfo1 + winfo2 + winfo3 + winfo4 + winfo5 + winfo6 + winfo7,
-                    "Warning", wx.YES_NO | wx.NO_DEFAULT | wx.ICON_QUESTION)
-                answer = d.ShowModal()
-                d.Destroy()
+    def __getitem__(self, ii):
+        return self.values[self.codes[ii]]
 
-                if answer == wx.ID_YES:
+    def __iter__(self):
+        for code in self.codes:
+            yield self.values[code]
 
-                    for uu in range(nr_unique_seqnames):
-                        print(uu)
-                        idx2 = np.where(seq_array[idx] == unique_seqnames[uu])
 
-                        for yy in range(len(idx2[0])):
-                            sn_array[idx[0][idx2[0][yy]]] = sn_array[idx[0][idx2[0][yy]]] + uu * 101
+class DicomPathTable:
+    # Low memory storage of the dicom file paths: a common root, a list of the (shared) relative directories, a
+    # directory index per file and the file names in one numpy byte string array. Behaves like a list of paths.
 
-                elif answer == wx.ID_NO:
-                    quit()
+    def __init__(self, root):
+        self.root = root
+        self.dirs = []
+        self.dirindex = np.zeros(0, dtype=np.int32)
+        self.names = np.zeros(0, dtype='S1')
 
-        # get uniques
-        # ----------------------
-        uniques = np.unique(sn_array)
+    @staticmethod
+    def fromwalk(pathdicom, cancelled=None):
+        table = DicomPathTable(pathdicom)
+        dirindex = []
+        names = []
+        for dirName, subdirList, fileList in os.walk(pathdicom):
+            check_cancelled(cancelled)
+            files = [f if isinstance(f, bytes) else f.encode('utf-8') for f in fileList if ".dcm" in f.lower()]
+            if files:
+                dirindex.append(np.zeros(len(files), dtype=np.int32) + len(table.dirs))
+                names.append(np.array(files))
+                table.dirs.append(os.path.relpath(dirName, pathdicom))
+        if names:
+            table.dirindex = np.concatenate(dirindex)
+            table.names = np.concatenate(names)
+        return table
 
-        # ----------------------
-        # get info from uniques
-        # ----------------------
-        firstval_array = np.array([])
-        nrvols_array = np.array([])
-        itl_array = np.array([])
-        it_list = []
-        it_list2 = []
-        it_list_all = []
-
-        # loop over unique sequences and get values for each
-        for ii in range(len(uniques)):
-            fv = np.nonzero(sn_array == uniques[ii])[0][0]
-            firstval_array = np.append(firstval_array, fv)
-            a = np.where(sn_array == uniques[ii])
-            nrvols_array = np.append(nrvols_array, len(a[0]))
-            itl_array = np.append(itl_array, it_len_array[fv])
-            it_list.append(it_val_list[fv][int(it_len_array[fv])-1])
-            it_list2.append(it_val_list[fv][2])
-            it_list_all.append(it_val_list[fv])
-
-        # itl_array = itl_array.astype(int)
-        firstval_array = firstval_array.astype(int)
-        nrvols_array = nrvols_array.astype(int)
-        un_seq = []
-        un_seqname = []
-        un_act = []
-        un_sn = []
-        acq_time = []
-        # un_mb = []
-        un_dti = []
-
-        for ii in range(len(firstval_array)):
-            un_seq.append(seq_array[firstval_array[ii]])
-            un_seqname.append(seqname_array[firstval_array[ii]])
-            un_act.append(act_array[firstval_array[ii]])
-            un_sn.append(sn_array[firstval_array[ii]])
-            acq_time.append(acq_time_list[firstval_array[ii]])
-            # un_mb.append(multiband_array[firstval_array[ii]])
-            un_dti.append(dti_array[firstval_array[ii]])
-
-        sn_array = sn_array.astype(int)
-
-        # print(un_mb)
-        # print(un_dti)
-
-        sn = sn_array.tolist()
-
-        un_sn = map(int, un_sn)
-
-        # Create list of filenames for each sequence
-        dcmfiles = [''] * len(un_sn)
-        un_echo = [''] * len(un_sn)
+    @staticmethod
+    def fromlist(filelist):
+        if len(filelist) == 0:
+            return DicomPathTable('')
+        table = DicomPathTable(os.path.dirname(os.path.commonprefix(list(filelist))))
+        dircodes = {}
+        dirindex = np.zeros(len(filelist), dtype=np.int32)
+        names = []
+        for ii, filename in enumerate(filelist):
+            d, f = os.path.split(os.path.relpath(filename, table.root))
+            if d not in dircodes:
+                dircodes[d] = len(table.dirs)
+                table.dirs.append(d)
+            dirindex[ii] = dircodes[d]
+            names.append(f if isinstance(f, bytes) else f.encode('utf-8'))
+        table.dirindex = dirindex
+        table.names = np.array(names)
+        return table
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, ii):
+        if isinstance(ii, slice):
+            return [self[jj] for jj in range(*ii.indices(len(self)))]
+        return os.path.normpath(os.path.join(self.root, self.dirs[self.dirindex[ii]],
+                                             self.names[ii].decode('utf-8')))
+
+    def __iter__(self):
+        for ii in range(len(self)):
+            yield self[ii]
+
+
+class SeriesFileList:
+    # list like view of the files of one series in a DicomPathTable
+    def __init__(self, paths, indices):
+        self.paths = paths
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, ii):
+        if isinstance(ii, slice):
+            return [self.paths[jj] for jj in self.indices[ii]]
+        return self.paths[self.indices[ii]]
+
+    def __iter__(self):
+        for ii in range(len(self)):
+            yield self[ii]
+
+
+def group_files_by_series(sn_array, budget):
+    # Return {series number: array of file indices} (indices in file order). If sorting in memory would exceed
+    # budget (bytes), the (series number, index) pairs are sorted in chunks spilled to temporary files, merged and
+    # the result kept in a memory mapped temporary file.
+
+    pairdtype = np.dtype([('sn', np.int64), ('idx', np.int64)])
+    n = len(sn_array)
+    keys = np.asarray(sn_array).astype(np.int64)
+
+    if n * 3 * pairdtype.itemsize <= budget:
+        order = np.argsort(keys, kind='mergesort')
+    else:
+        chunksize = max(1, budget // (3 * pairdtype.itemsize))
+        tempdir = tempfile.mkdtemp(prefix='pyBIDSconv_sort_')
+        chunks = []
+        for start in range(0, n, chunksize):
+            pairs = np.zeros(min(chunksize, n - start), dtype=pairdtype)
+            pairs['sn'] = keys[start:start + chunksize]
+            pairs['idx'] = np.arange(start, start + len(pairs))
+            pairs.sort(order=['sn', 'idx'])
+            chunkfile = os.path.join(tempdir, 'chunk%d.npy' % len(chunks))
+            np.save(chunkfile, pairs)
+            chunks.append(np.load(chunkfile, mmap_mode='r'))
+            del pairs
+
+        # merge the sorted chunks block wise: all pairs up to the smallest last pair of the loaded blocks are
+        # loaded, sorted together and written out
+        order = np.memmap(os.path.join(tempdir, 'order.dat'), dtype=np.int64, mode='w+', shape=(n,))
+        blocksize = max(1, chunksize // (len(chunks) + 1))
+        positions = [0] * len(chunks)
+        done = 0
+        while done < n:
+            blocks = [(cc, chunk[p:p + blocksize]) for cc, (chunk, p) in enumerate(zip(chunks, positions))
+                      if p < len(chunk)]
+            bound = min((int(block['sn'][-1]), int(block['idx'][-1])) for _, block in blocks)
+            parts = []
+            for cc, block in blocks:
+                upto = (block['sn'] < bound[0]) | ((block['sn'] == bound[0]) & (block['idx'] <= bound[1]))
+                count = int(np.count_nonzero(upto))
+                parts.append(block[:count])
+                positions[cc] += count
+            merged = np.concatenate(parts)
+            merged.sort(order=['sn', 'idx'])
+            order[done:done + len(merged)] = merged['idx']
+            done += len(merged)
+        order.flush()
+        del chunks
+        print("Grouping spilled to temporary files in " + tempdir)
+        # the memory map stays valid after removing its file (POSIX), elsewhere the files stay in the temp folder
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+    sortedkeys = keys[order]
+    bounds = np.nonzero(np.diff(sortedkeys))[0] + 1
+    starts = np.concatenate(([0], bounds))
+    stops = np.concatenate((bounds, [n]))
+    return dict((int(sortedkeys[a]), order[a:b]) for a, b in zip(starts, stops) if b > a)
+
+
+def peak_rss_mb():
+    # peak resident memory of this process in MB (None where not available)
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / 1024.0 / 1024.0
+    return rss / 1024.0
+
+
+def physical_memory():
+    # physical memory of this node in bytes (4 GB where not available)
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return 4 * 1024 ** 3
+
+
+def cpu_times():
+    # (busy, iowait, total) time of all CPUs of the node (Linux /proc/stat), elsewhere the CPU time of this process
+    # and its children
+    try:
+        with open('/proc/stat') as f:
+            values = [float(x) for x in f.readline().split()[1:9]]
+        return sum(values) - values[3] - values[4], values[4], sum(values)
+    except (IOError, OSError, ValueError, IndexError):
+        t = os.times()
+        return t[0] + t[1] + t[2] + t[3], 0.0, t[4] * multiprocessing.cpu_count()
+
+
+def read_bytes():
+    # bytes read by this process so far (Linux /proc/self/io), None where not available
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+class AdaptiveConcurrency:
+    # AIMD controller of the number of parallel workers of a pool (header scan, dcm2niix). Throughput (files/s and
+    # MB/s, rate: the one that decides) and CPU utilization of the node are measured over windows of at least window
+    # seconds. While the throughput grows by more than 5% the level goes up by one; a drop by more than 10% or a
+    # saturated CPU halves it; an increase without gain is taken back; on a plateau the level is kept and probed one
+    # level up after three windows. Measurements and decisions are kept for the run report.
+
+    # reports of the last header scan by dicom folder
+    scanreports = {}
+
+    def __init__(self, name, maximum, minimum=1, start=None, window=2.0, rate='files'):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.level = min(self.maximum, start or minimum)
+        self.window = window
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.starttime = time.time()
+        self.history = []
+        self.previous = None
+        self.lastaction = None
+        self.holds = 0
+        self.reset()
+
+    def reset(self):
+        self.files = 0
+        self.bytes = 0
+        self.windowstart = time.time()
+        self.cpustart = cpu_times()
+
+    def done(self, files, nbytes=0):
+        # a unit of work finished, returns the level
+        with self.lock:
+            self.files += files
+            self.bytes += nbytes
+            elapsed = time.time() - self.windowstart
+            if elapsed >= self.window:
+                self.adapt(elapsed)
+            return self.level
+
+    def adapt(self, elapsed):
+        # (lock held) decision at the end of a window
+        busy, iowait, total = cpu_times()
+        busy0, iowait0, total0 = self.cpustart
+        cpu = (busy - busy0) / (total - total0) if total > total0 else 0.0
+        io = (iowait - iowait0) / (total - total0) if total > total0 else 0.0
+        filerate = self.files / elapsed
+        mbrate = self.bytes / elapsed / 1024.0 ** 2
+        rate = mbrate if self.rate == 'bytes' else filerate
+
+        level = self.level
+        if cpu > 0.95:
+            action = 'decrease'
+        elif self.previous is not None and rate < 0.9 * self.previous:
+            action = 'decrease'
+        elif self.lastaction == 'increase' and rate <= 1.05 * self.previous:
+            action = 'revert'
+        elif self.previous is None or rate > 1.05 * self.previous or self.holds >= 3:
+            action = 'increase'
+        else:
+            action = 'hold'
+
+        if action == 'increase' and level < self.maximum:
+            level += 1
+        elif action == 'decrease' and level > self.minimum:
+            level = max(self.minimum, level // 2)
+        elif action == 'revert' and level > self.minimum:
+            level -= 1
+        else:
+            action = 'hold'
+        self.holds = self.holds + 1 if action == 'hold' else 0
+
+        self.history.append(OrderedDict([('time', round(time.time() - self.starttime, 1)), ('level', self.level),
+                                         ('files_s', round(filerate, 1)), ('mb_s', round(mbrate, 1)),
+                                         ('cpu', round(cpu, 2)), ('iowait', round(io, 2)), ('action', action),
+                                         ('next', level)]))
+        self.previous = rate
+        self.lastaction = action
+        self.level = level
+        self.reset()
+
+    def report(self, since=None):
+        # chosen level and the measurements behind it (windows after the time since)
+        with self.lock:
+            history = [h for h in self.history if since is None or self.starttime + h['time'] >= since]
+            return OrderedDict([('pool', self.name), ('minimum', self.minimum), ('maximum', self.maximum),
+                                ('level', self.level), ('windows', history)])
+
+    def summary(self, since=None):
+        report = self.report(since)
+        levels = [h['level'] for h in report['windows']] or [self.level]
+        rates = [h['mb_s' if self.rate == 'bytes' else 'files_s'] for h in report['windows']]
+        unit = 'MB/s' if self.rate == 'bytes' else 'files/s'
+        best = " (best %.1f %s)" % (max(rates), unit) if rates else ""
+        return "%s: level %d (range %d-%d over %d windows)%s" % (self.name, self.level, min(levels), max(levels),
+                                                                len(report['windows']), best)
+
+
+class DicomIOScheduler:
+    # Orders the reading of dicom files by their position on disk to avoid seeking on spinning disks.
+    # readorder: 'inode' sorts by inode number, 'extent' by the physical start of the first extent (Linux FIEMAP,
+    # falls back to inode) and '' keeps the original order. Iterating yields (index, filename), where index refers
+    # to the position in the original file list, so the downstream series grouping is not affected.
+
+    FS_IOC_FIEMAP = 0xC020660B
+    prefetch = 8
+
+    def __init__(self, filelist, readorder='inode', cancelled=None):
+        self.filelist = filelist
+        self.readorder = readorder
 
-        for ii in range(len(un_sn)):
-            index = [i for i, j in enumerate(sn) if j == un_sn[ii]]
+        keys = []
+        if readorder in ['extent', 'inode']:
+            key = self.extentkey if readorder == 'extent' else self.inodekey
+            for f in filelist:
+                check_cancelled(cancelled)
+                keys.append(key(f))
+        else:
+            keys = list(range(len(filelist)))
+        self.order = sorted(range(len(filelist)), key=lambda i: keys[i])
 
-            ff = [''] * len(index)
+    @staticmethod
+    def inodekey(filename):
+        try:
+            st = os.stat(filename)
+            return st.st_dev, st.st_ino
+        except OSError:
+            return 0, 0
 
-            for nn in range(len(index)):
-                ff[nn] = list_dicom_files[index[nn]]
+    def extentkey(self, filename):
+        try:
+            import fcntl
+            fd = os.open(filename, os.O_RDONLY)
+            try:
+                # struct fiemap asking for the first extent only
+                buf = struct.pack('=QQLLLL', 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + b'\0' * 56
+                res = fcntl.ioctl(fd, self.FS_IOC_FIEMAP, buf)
+                if struct.unpack('=L', res[20:24])[0] > 0:
+                    return os.fstat(fd).st_dev, struct.unpack('=Q', res[40:48])[0]
+            finally:
+                os.close(fd)
+        except (ImportError, IOError, OSError):
+            pass
+        return self.inodekey(filename)
 
-            dcmfiles[ii] = [x.encode('UTF8') for x in ff]
+    @staticmethod
+    def advise(filename, sequential=False):
+        # give the kernel a read ahead hint for a file (no-op where posix_fadvise is not available)
+        if not hasattr(os, 'posix_fadvise'):
+            return
+        try:
+            fd = os.open(filename, os.O_RDONLY)
+            try:
+                if sequential:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
 
-            ect = echotime_array[index]
-            un_echo[ii] = np.unique(ect)
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        if self.readorder:
+            for jj in self.order[:self.prefetch]:
+                self.advise(self.filelist[jj])
+        for nn in range(len(self.order)):
+            if self.readorder and nn + self.prefetch < len(self.order):
+                self.advise(self.filelist[self.order[nn + self.prefetch]], sequential=True)
+            ii = self.order[nn]
+            yield ii, self.filelist[ii]
+
+
+def scan_dicom_headers(list_dicom_files, readorder='', progress=None, compact=None, cancelled=None):
+    # read the headers of all files (in disk order if readorder is set) and return them in the original order
+    # (compact: optional HeaderInterner applied to each record)
+
+    records = [None] * len(list_dicom_files)
+    count = 0
+    for ii, filename in DicomIOScheduler(list_dicom_files, readorder, cancelled):
+        check_cancelled(cancelled)
+        if progress is not None:
+            progress(count, len(list_dicom_files))
+        if DicomArchive.separator in filename:
+            records[ii] = DicomArchive.readheader(filename)
+        else:
+            records[ii] = read_dicom_header(filename)
+        if compact is not None:
+            records[ii] = compact(records[ii])
+        count += 1
+
+    for archive in DicomArchive.archives.values():
+        archive.save()
+        archive.close()
+
+    return records
+
+
+class DicomHeaderTable:
+    # column wise arrays of the header values of all dicom files of a subject (in file list order)
+    # With an interner (low memory mode) the records are compacted by HeaderInterner, the string columns are object
+    # arrays of shared strings and ImageType is stored as small codes.
+
+    def __init__(self, records, interner=None):
+        self.sn_array = np.array([r.seriesnumber for r in records], dtype=float)
+        if interner is None:
+            self.seq_array = np.array([r.seriesdescription for r in records])
+            self.seqname_array = np.array([r.sequencename for r in records])
+            self.act_array = np.array([r.acqtype for r in records])
+            self.it_val_list = [r.imagetype for r in records]
+            self.it_len_array = np.array([len(r.imagetype) for r in records], dtype=int)
+        else:
+            self.seq_array = np.array([r.seriesdescription for r in records], dtype=object)
+            self.seqname_array = np.array([r.sequencename for r in records], dtype=object)
+            self.act_array = np.array([r.acqtype for r in records], dtype=object)
+            self.it_val_list = ImageTypeList(np.array([r.imagetype for r in records], dtype=np.int16),
+                                             interner.imagetypes)
+            self.it_len_array = np.array([len(it) for it in interner.imagetypes], dtype=int)[self.it_val_list.codes]
+        if interner is None:
+            self.acq_time_list = [r.acqtime for r in records]
+            self.acq_date_list = [r.acqdate for r in records]
+        else:
+            self.acq_time_list = StringCodeList.fromvalues(r.acqtime for r in records)
+            self.acq_date_list = StringCodeList.fromvalues(r.acqdate for r in records)
+        self.shm = None
+        # mixed values (missing echo times) end up as string array like before
+        self.echotime_array = np.array([r.echotime for r in records])
+        self.echonumber_array = np.array([r.echonumber for r in records])
+        self.dti_array = np.array([r.dti for r in records])
+
+        self.patinfo = [''] * 2
+        for r in records:
+            if r.patage != '':
+                self.patinfo = [r.patage, r.patsex]
+                break
 
-        # ----------------------
-        # categorize sequences
-        # ----------------------
+    @staticmethod
+    def fromshared(rows, strings):
+        # table on the shared records of SharedHeaderScan (numeric columns are views of the shared buffer)
+        table = DicomHeaderTable([])
+        values = np.array(strings, dtype=object)
+
+        table.sn_array = rows['sn']
+        table.seq_array = values[rows['seqdesc']]
+        table.seqname_array = values[rows['seqname']]
+        table.act_array = values[rows['acqtype']]
+        table.acq_time_list = StringCodeList(rows['acqtime'], strings)
+        table.acq_date_list = StringCodeList(rows['acqdate'], strings)
+        imagetypes = [str(v).split('\\') for v in strings]
+        table.it_val_list = ImageTypeList(rows['imagetype'], imagetypes)
+        table.it_len_array = np.array([len(it) for it in imagetypes], dtype=int)[rows['imagetype']]
+        table.dti_array = rows['flags'] & 1
+
+        if np.all(rows['flags'] & 2):
+            table.echotime_array = rows['echotime']
+        else:
+            table.echotime_array = np.array([e if f & 2 else "" for e, f in zip(rows['echotime'], rows['flags'])])
+        table.echonumber_array = np.array([e if f & 4 else "" for e, f in zip(rows['echonumber'], rows['flags'])])
+
+        withage = np.nonzero(values[rows['patage']] != '')[0]
+        if len(withage):
+            table.patinfo = [values[rows['patage'][withage[0]]], values[rows['patsex'][withage[0]]]]
+        return table
+
+    def close(self):
+        # release the shared memory of SharedHeaderScan: the columns on it are dropped, no other view of them may
+        # be left
+        shm, self.shm = self.shm, None
+        if shm is not None and hasattr(shm, 'close'):
+            self.sn_array = self.echotime_array = self.it_val_list = None
+            self.acq_time_list = self.acq_date_list = None
+            shm.close()
+
+
+def scan_dicom_folder(pathdicom, cfg, progress=None, cancelled=None):
+    # Find the dicom files of a subject (folder, DICOMDIR or archive) and read their headers as set in the config.
+    # Returns the file list and the DicomHeaderTable (None if no dicom files were found). Setting the cancelled event
+    # stops the file discovery and the scan with ScanCancelled.
+    try:
+        incremental = cfg.IncrementalRescan
+    except AttributeError:
+        incremental = False
+    try:
+        lowmemory = cfg.LowMemoryMode
+    except AttributeError:
+        lowmemory = False
+    interner = HeaderInterner() if lowmemory else None
+
+    snapshot = None
+    dicomdir = DicomDirIndex.find(pathdicom)
+    if dicomdir is not None:
+        list_dicom_files = dicomdir.files()
+    elif incremental and os.path.isdir(pathdicom):
+        snapshot = DicomFolderSnapshot(pathdicom, cancelled)
+        list_dicom_files = snapshot.files()
+    elif lowmemory and os.path.isdir(pathdicom):
+        list_dicom_files = DicomPathTable.fromwalk(pathdicom, cancelled)
+    else:
+        list_dicom_files = find_dicom_files(pathdicom, cancelled)
+
+    if len(list_dicom_files) == 0:
+        return list_dicom_files, None
+
+    # ------------------------------------------
+    # Loop over dicom files
+    # ------------------------------------------
+    try:
+        readorder = cfg.DicomReadOrder
+    except AttributeError:
+        readorder = ''
+
+    try:
+        scanworkers = cfg.ScanWorkers
+    except AttributeError:
+        scanworkers = 1
+
+    # number of readers chosen at runtime, ScanWorkers above 1 is the upper limit
+    controller = None
+    if getattr(cfg, 'AdaptiveWorkers', False):
+        if scanworkers <= 1:
+            scanworkers = 2 * multiprocessing.cpu_count()
+        controller = AdaptiveConcurrency('scan', scanworkers, window=1.0)
+
+    if lowmemory and not isinstance(list_dicom_files, DicomPathTable):
+        list_dicom_files = DicomPathTable.fromlist(list_dicom_files)
+
+    if dicomdir is None and snapshot is None and scanworkers > 1 and not DicomArchive.isarchive(pathdicom):
+        table = SharedHeaderScan(list_dicom_files, scanworkers, readorder, controller).run(progress)
+        if controller is not None:
+            AdaptiveConcurrency.scanreports[pathdicom] = controller.report()
+            print(controller.summary())
+    else:
+        if dicomdir is not None:
+            records = dicomdir.scan(progress)
+        elif snapshot is not None:
+            records = snapshot.scan(readorder, progress)
+        else:
+            records = scan_dicom_headers(list_dicom_files, readorder, progress, interner, cancelled)
+        if lowmemory:
+            for ii in range(len(records)):
+                if not isinstance(records[ii].imagetype, int):
+                    records[ii] = interner(records[ii])
+        table = DicomHeaderTable(records, interner)
+        del records
+
+    return list_dicom_files, table
+
+
+class ScanCancelled(Exception):
+    # raised by a progress callback to stop a header scan
+    pass
+
+
+def folder_signature(pathdicom, cancelled=None):
+    # digest of the mtime of all folders and of size and mtime of all files below pathdicom (size and mtime of an
+    # archive or DICOMDIR file): changes when files or series are added, removed or rewritten anywhere in the tree
+    if not os.path.isdir(pathdicom):
+        st = os.stat(pathdicom)
+        return st.st_size, st.st_mtime
+    digest = hashlib.md5()
+    for dirName, subdirList, fileList in os.walk(pathdicom):
+        check_cancelled(cancelled)
+        subdirList.sort()
+        digest.update(repr((os.path.relpath(dirName, pathdicom), os.stat(dirName).st_mtime)).encode('utf-8'))
+        for name in sorted(fileList):
+            try:
+                st = os.stat(os.path.join(dirName, name))
+            except OSError:
+                continue
+            digest.update(repr((name, st.st_size, st.st_mtime)).encode('utf-8'))
+    return digest.hexdigest()
 
-        # create empty lists
-        scantype_list = ["None"] * len(uniques)
-        label_list = [''] * len(uniques)
 
-        acq_name_list = [''] * len(uniques)
-        rec_name_list = [''] * len(uniques)
+class DicomPrescan:
+    # Speculative header scan of the subject folder in a background thread, started by GetInput when a dicom
+    # directory is chosen or its field is left. A changed path or config cancels the running scan (file discovery,
+    # ordering and header reads check the cancelled event) and starts a new one. GetDCMinfo takes the result if path
+    # and config still match and the folder_signature taken before the scan is unchanged (files added, removed or
+    # rewritten in any subfolder or archive since then discard the result).
 
-        # create lower case versions of lists
-        un_seq_l = [item.lower() for item in un_seq]
-        un_seqname_l = [item.lower() for item in un_seqname]
-        un_act_l = [item.lower() for item in un_act]
-        # rule_seq_name_l = [item.lower() for item in rule_seq_name]
-        # rule_seq_act_l = [item.lower() for item in rule_seq_act]
-        # rule_seq_desc_l = [item.lower() for item in rule_seq_desc]
+    def __init__(self):
+        self.key = None
+        self.thread = None
+        self.cancelled = None
+        self.outcome = None
+        self.config = (None, None)
 
-        # loop over unique sequences
-        # --------------------------------------
-        for ii in range(len(un_seqname_l)):
+    @staticmethod
+    def makekey(pathdicom, configfile):
+        if not pathdicom or not os.path.exists(pathdicom) or not os.path.isfile(configfile):
+            return None
+        return os.path.abspath(pathdicom), os.path.abspath(configfile)
+
+    def start(self, pathdicom, configfile):
+        key = self.makekey(pathdicom, configfile)
+        if key is not None and key == self.key:
+            return
+        self.cancel()
+        if key is None:
+            return
+        configkey = (key[1], os.stat(configfile).st_mtime)
+        if self.config[0] == configkey:
+            cfg = self.config[1]
+        else:
+            try:
+                cfg = load_config(configfile)
+            except Exception as ex:
+                print("Background scan not started, config file could not be loaded: " + str(ex))
+                return
+            self.config = (configkey, cfg)
 
-            # specify acq label of found multiband scans
-            # if un_mb[ii] == 1.0:
-            #     acq_name_list[ii] = "Grappa"
+        self.key = key
+        self.cancelled = threading.Event()
+        self.outcome = {}
+        self.thread = threading.Thread(target=self.run, args=(pathdicom, cfg, self.cancelled, self.outcome))
+        self.thread.daemon = True
+        self.thread.start()
 
-            # print(un_seqname_l[ii])
-            # print(un_seq_l[ii])
+    @staticmethod
+    def run(pathdicom, cfg, cancelled, outcome):
+        def progress(count, total):
+            check_cancelled(cancelled)
 
-            x = [value for key, value in dictname.items() if key.lower() in un_seqname_l[ii]]
-            res = [j for i in x for j in i]
-            print(res)
+        try:
+            outcome['signature'] = folder_signature(pathdicom, cancelled)
+            outcome['result'] = scan_dicom_folder(pathdicom, cfg, progress, cancelled)
+        except ScanCancelled:
+            pass
+        except Exception as ex:
+            print("Background scan of " + pathdicom + " failed: " + str(ex))
+
+    def cancel(self):
+        if self.cancelled is not None:
+            self.cancelled.set()
+        if self.outcome and self.outcome.get('result') and self.outcome['result'][1] is not None:
+            # finished but not used: release the shared memory of its table
+            self.outcome['result'][1].close()
+        self.key = None
+        self.thread = None
+        self.cancelled = None
+        self.outcome = None
+
+    def result(self, pathdicom, configfile, cancelled=None):
+        # file list and header table of the background scan (waits for it to finish) or None; a result is only
+        # used once, as GetDCMinfo modifies the table. Setting cancelled while waiting stops the background scan
+        # with ScanCancelled.
+        if self.thread is None or self.makekey(pathdicom, configfile) != self.key:
+            self.cancel()
+            return None
+        while self.thread.is_alive():
+            if cancelled is not None and cancelled.is_set():
+                self.cancel()
+                raise ScanCancelled()
+            self.thread.join(0.1)
+        outcome = self.outcome
+        self.key = None
+        self.thread = None
+        self.cancelled = None
+        self.outcome = None
+        result = outcome.get('result')
+        if result is not None and folder_signature(pathdicom, cancelled) != outcome['signature']:
+            print("Background scan discarded, " + pathdicom + " changed since")
+            if result[1] is not None:
+                result[1].close()
+            return None
+        return result
 
-            if len(res) > 1:
-                x = [value for key, value in dictact.items() if key.lower() in un_act_l[ii].lower()]
-                res2 = [j for i in x for j in i]
-                res = [value for value in res if value in res2]
 
-            print(res)
-            if len(res) > 1:
-                x = [value for key, value in dictdesc.items() if key.lower() in un_seq_l[ii].lower()]
-                res2 = [j for i in x for j in i]
-                res = [value for value in res if value in res2]
+# #####################################################################################################################
+# #####################################################################################################################
+#
+# Categorization
+#
+# #####################################################################################################################
+# #####################################################################################################################
 
-            print(res)
+class CategorizationRules:
+    # Rules of a categorization file (tab separated: folder, sequence name, acquisition type, description, label).
+    # A series is matched by sequence name (substring); ties are resolved by acquisition type and then by
+    # description. Only a single remaining rule categorizes the series.
 
-            if len(res) == 1:
-                label_list[ii] = rule_label[res[0]]
-                scantype_list[ii] = rule_seq_type[res[0]]
-            else:
-                label_list[ii] = '0'
-                scantype_list[ii] = '0'
+    def __init__(self, categorizationfile):
+        self.rule_seq_type = []
+        self.rule_seq_act = []
+        self.rule_seq_desc = []
+        self.rule_seq_name = []
+        self.rule_label = []
 
-        print(scantype_list)
-        print(label_list)
+        with open(categorizationfile) as infile:
+            content = infile.read()
+        self.hash = hashlib.md5(content.encode('utf-8') if not isinstance(content, bytes) else content).hexdigest()
+
+        for line in content.splitlines(True):
+            tsplit = line.split("\t")
+            self.rule_seq_type.append(tsplit[0])
+            self.rule_seq_name.append(tsplit[1])
+            self.rule_seq_act.append(tsplit[2])
+            self.rule_seq_desc.append(tsplit[3])
+            self.rule_label.append(tsplit[4])
+
+        # dictionaries of rule indices of the unique column entries
+        self.dictname = self.indexdict(self.rule_seq_name)
+        self.dictact = self.indexdict(self.rule_seq_act)
+        self.dictdesc = self.indexdict(self.rule_seq_desc)
 
-        # create reconstruction and exclude vector
-        # --------------------------------------------
-        exclusion_array = np.zeros(len(uniques))
-        exclusion_array = exclusion_array.astype(int)
-
-        # Check if specific reconstructions are obvious
-        for ii in range(len(cfg.ReconstructionInfoInImageType)):
-            for jj in range(len(it_list_all)):
-                c = [i for i, item in enumerate(it_list_all[jj]) if cfg.ReconstructionInfoInImageType[ii] in item]
-                for cc in range(len(c)):
-                    rec_name_list[jj] = cfg.ReconstructionInfoInImageType[ii]
-
-        # Check for phase encoding directions in filenames
+    @staticmethod
+    def indexdict(column):
+        d = {}
+        for i, x in enumerate(column):
+            d.setdefault(x, []).append(i)
+        return d
+
+    def signature(self):
+        return self.hash
+
+    def match(self, seqname, act, desc):
+        # indices of the matching rules
+        x = [value for key, value in self.dictname.items() if key.lower() in seqname.lower()]
+        res = [j for i in x for j in i]
+
+        if len(res) > 1:
+            x = [value for key, value in self.dictact.items() if key.lower() in act.lower()]
+            res2 = [j for i in x for j in i]
+            res = [value for value in res if value in res2]
+
+        if len(res) > 1:
+            x = [value for key, value in self.dictdesc.items() if key.lower() in desc.lower()]
+            res2 = [j for i in x for j in i]
+            res = [value for value in res if value in res2]
+
+        return res
+
+    def categorize(self, seqname, act, desc):
+        # (scantype, label) of a series, ('0', '0') if not exactly one rule matches
+        res = self.match(seqname, act, desc)
+        if len(res) == 1:
+            return self.rule_seq_type[res[0]], self.rule_label[res[0]]
+        return '0', '0'
+
+
+class CategorizationCache:
+    # Persistent LRU cache of categorization decisions (scantype, label, acq, rec, excluded) keyed by the series
+    # signature (SequenceName, MRAcquisitionType, SeriesDescription, ImageType) and a hash of the categorization
+    # file and config lists. Hit and miss counts are kept per run and in total. Conversions in other threads and
+    # processes use the same file: save merges the entries used in this run into the file on disk (under a lock of
+    # the cache folder) and replaces it atomically.
+
+    def __init__(self, rulesignature, maxentries=10000):
+        self.rulehash = hashlib.md5(rulesignature.encode('utf-8')).hexdigest()
+        self.maxentries = maxentries
+        self.cachefile = os.path.join(pybidsconv_cachedir(), 'categorization_cache.json')
+        self.hits = 0
+        self.misses = 0
+        self.saved = [0, 0]
+        self.used = OrderedDict()
+        self.changed = False
+        self.entries, self.totals = self.load()
+
+    def load(self):
+        entries = OrderedDict()
+        totals = [0, 0]
         try:
-            for ii in range(len(un_seq_l)):
-                if scantype_list[ii] == "fmap":
-                    s = un_seq_l[ii]
-                    for jj in range(len(cfg.PhaseInfoForFmapsBySequenceDescriptionSubstring)):
-                        if cfg.PhaseInfoForFmapsBySequenceDescriptionSubstring[jj] in s.lower():
-                            acq_name_list[ii] = cfg.PhaseInfoForFmapsBySequenceDescriptionSubstring[jj][1:]
-        except:
+            with open(self.cachefile) as f:
+                cache = json.load(f)
+            for key, value in cache['entries']:
+                entries[key] = value
+            totals = cache['totals']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
             pass
+        return entries, totals
+
+    def key(self, signature):
+        return json.dumps([self.rulehash] + list(signature))
+
+    def get(self, signature):
+        key = self.key(signature)
+        value = self.entries.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return None
+        # move to the end (most recently used)
+        self.entries[key] = value
+        self.used.pop(key, None)
+        self.used[key] = True
+        self.hits += 1
+        self.changed = True
+        return value
+
+    def put(self, signature, decision):
+        key = self.key(signature)
+        self.entries[key] = decision
+        self.used.pop(key, None)
+        self.used[key] = True
+        while len(self.entries) > self.maxentries:
+            self.entries.popitem(last=False)
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        try:
+            with DatasetLock(os.path.dirname(self.cachefile), 60):
+                entries, totals = self.load()
+                for key in self.used:
+                    if key in self.entries:
+                        entries.pop(key, None)
+                        entries[key] = self.entries[key]
+                while len(entries) > self.maxentries:
+                    entries.popitem(last=False)
+                totals = [totals[0] + self.hits - self.saved[0], totals[1] + self.misses - self.saved[1]]
+                write_atomic(self.cachefile, json.dumps({'entries': list(entries.items()), 'totals': totals}))
+            self.entries = entries
+            self.totals = [totals[0] - self.hits, totals[1] - self.misses]
+            self.saved = [self.hits, self.misses]
+            self.used = OrderedDict()
+            self.changed = False
+        except (IOError, OSError):
+            pass
+
+    def report(self):
+        n = self.hits + self.misses
+        hits = self.totals[0] + self.hits
+        total = hits + self.totals[1] + self.misses
+        return ("Categorization cache: %d of %d series from cache (%.0f%%), all runs: %d of %d (%.0f%%)" %
+                (self.hits, n, 100.0 * self.hits / max(n, 1), hits, total, 100.0 * hits / max(total, 1)))
+
+
+class ConfigRules:
+    # The lists of a pyBIDSconv config file compiled to one regular expression each. Every list item is an optional
+    # lookahead with its own group, so one match of a string tells which items occur in it. As in the item by item
+    # loops these replace, the last matching item of a list wins:
+    # - rec: ReconstructionInfoInImageType item contained in one of the ImageType values
+    # - acq: ExclusionsBySequenceDescriptionEnd item > ExclusionsBySequenceDescriptionContent item > fmap phase info
+    # - exclusion: any ExclusionsBySequenceDescriptionContent or ExclusionsBySequenceDescriptionEnd match
+    # Sequence descriptions are compared in lower case (end items are lower cased as well).
+
+    def __init__(self, cfg):
+        self.recitems = list(getattr(cfg, 'ReconstructionInfoInImageType', []))
+        self.phaseitems = list(getattr(cfg, 'PhaseInfoForFmapsBySequenceDescriptionSubstring', []))
+        self.contentitems = list(getattr(cfg, 'ExclusionsBySequenceDescriptionContent', []))
+        self.enditems = list(getattr(cfg, 'ExclusionsBySequenceDescriptionEnd', []))
+
+        self.recre = self.compile(self.recitems, '')
+        self.phasere = self.compile(self.phaseitems, '')
+        self.contentre = self.compile(self.contentitems, '')
+        self.endre = self.compile([x.lower() for x in self.enditems], '$')
+
+    def signature(self):
+        return repr([self.recitems, self.phaseitems, self.contentitems, self.enditems])
+
+    @staticmethod
+    def compile(items, anchor):
+        return re.compile(''.join('(?:(?=.*?(' + re.escape(item) + ')' + anchor + '))?' for item in items), re.S)
+
+    @staticmethod
+    def lastmatch(regex, string):
+        # index of the last list item found in string (-1 if none)
+        groups = regex.match(string).groups()
+        for ii in range(len(groups) - 1, -1, -1):
+            if groups[ii] is not None:
+                return ii
+        return -1
+
+    def apply(self, un_seq, it_list_all, scantype_list):
+        # return exclusion mask, acq and rec name lists for the series; each distinct description is matched once
+        un_seq_l = np.array([item.lower() for item in un_seq] or [''], dtype=object)
+        descs, inverse = np.unique(un_seq_l, return_inverse=True)
+
+        content = np.array([self.lastmatch(self.contentre, d) for d in descs])[inverse]
+        end = np.array([self.lastmatch(self.endre, d) for d in descs])[inverse]
+        phase = np.array([self.lastmatch(self.phasere, d) for d in descs])[inverse]
+
+        # ImageType values joined by a separator that can not occur in a list item
+        rec = [self.lastmatch(self.recre, '\x00'.join(it)) for it in it_list_all]
+
+        exclusion_array = np.zeros(len(un_seq), dtype=int)
+        acq_name_list = [''] * len(un_seq)
+        rec_name_list = [''] * len(un_seq)
+        for ii in range(len(un_seq)):
+            if rec[ii] >= 0:
+                rec_name_list[ii] = self.recitems[rec[ii]]
+            if end[ii] >= 0:
+                exclusion_array[ii] = 1
+                acq_name_list[ii] = self.enditems[end[ii]]
+                print(un_seq_l[ii] + " > " + self.enditems[end[ii]].lower())
+            elif content[ii] >= 0:
+                exclusion_array[ii] = 1
+                acq_name_list[ii] = self.contentitems[content[ii]]
+            elif phase[ii] >= 0 and scantype_list[ii] == "fmap":
+                acq_name_list[ii] = self.phaseitems[phase[ii]][1:]
+
+        return exclusion_array, acq_name_list, rec_name_list
+
+
+def scan_dates(acq_date_list):
+    # distinct acquisition dates of the files of a subject
+    return sorted(set(d for d in acq_date_list if d != "n/a"))
+
+
+def split_scan_dates(sn_array, acq_date_list, dates):
+    # keep the data of several scan dates in one session: series numbers of the nth date are moved by n*100
+    for nn in range(1, len(dates)):
+        fidx = np.asarray([i for i, e in enumerate(acq_date_list) if e == dates[nn]])
+        sn_array[fidx] = sn_array[fidx]+nn*100
+
+
+def duplicate_series_numbers(sn_array, seq_array):
+    # (series number, descriptions) of the series numbers shared by series with different descriptions
+    duplicates = []
+    for oo in np.unique(sn_array):
+        idx = np.where(sn_array == oo)
+        unique_seqnames = np.unique(seq_array[idx])
+        if len(unique_seqnames) > 1:
+            duplicates.append((oo, unique_seqnames))
+    return duplicates
+
+
+def split_series_number(sn_array, seq_array, oo, unique_seqnames):
+    # give each description of a shared series number its own number (+101 per description), returns the new numbers
+    dupseries = []
+    idx = np.where(sn_array == oo)
+    for uu in range(len(unique_seqnames)):
+        dupseries.append(oo + uu * 101)
+        idx2 = np.where(seq_array[idx] == unique_seqnames[uu])
+
+        for yy in range(len(idx2[0])):
+            sn_array[idx[0][idx2[0][yy]]] = sn_array[idx[0][idx2[0][yy]]] + uu * 101
+    return dupseries
+
+
+def series_info(list_dicom_files, table, sn_array, lowmemory=False, memorybudget=2000 * 1024 * 1024):
+    # Group the files of a subject into series (by series number) and take the values of the first file of each
+    # series. Returns a dict of per series lists (un_seq, un_seqname, un_act, un_sn, acq_time, un_dti, nrvols_array,
+    # it_list2, it_list_all, dcmfiles, un_echo).
+    seq_array = table.seq_array
+    seqname_array = table.seqname_array
+    act_array = table.act_array
+    acq_time_list = table.acq_time_list
+    it_val_list = table.it_val_list
+    echotime_array = table.echotime_array
+    dti_array = table.dti_array
+
+    # get uniques
+    # ----------------------
+    uniques = np.unique(sn_array)
+
+    # ----------------------
+    # get info from uniques
+    # ----------------------
+    firstval_array = np.array([])
+    nrvols_array = np.array([])
+    it_list2 = []
+    it_list_all = []
+
+    # loop over unique sequences and get values for each
+    for ii in range(len(uniques)):
+        fv = np.nonzero(sn_array == uniques[ii])[0][0]
+        firstval_array = np.append(firstval_array, fv)
+        a = np.where(sn_array == uniques[ii])
+        nrvols_array = np.append(nrvols_array, len(a[0]))
+        it_list2.append(it_val_list[fv][2])
+        it_list_all.append(it_val_list[fv])
+
+    firstval_array = firstval_array.astype(int)
+    nrvols_array = nrvols_array.astype(int)
+    un_seq = []
+    un_seqname = []
+    un_act = []
+    un_sn = []
+    acq_time = []
+    un_dti = []
+
+    for ii in range(len(firstval_array)):
+        un_seq.append(seq_array[firstval_array[ii]])
+        un_seqname.append(seqname_array[firstval_array[ii]])
+        un_act.append(act_array[firstval_array[ii]])
+        un_sn.append(sn_array[firstval_array[ii]])
+        acq_time.append(acq_time_list[firstval_array[ii]])
+        un_dti.append(dti_array[firstval_array[ii]])
+
+    sn_array = sn_array.astype(int)
+    sn = sn_array.tolist()
+    un_sn = list(map(int, un_sn))
+
+    # Create list of filenames for each sequence
+    dcmfiles = [''] * len(un_sn)
+    un_echo = [''] * len(un_sn)
+
+    if lowmemory:
+        # files are not copied per series but referenced in the path table
+        groups = group_files_by_series(sn_array, memorybudget)
+        for ii in range(len(un_sn)):
+            index = groups[un_sn[ii]]
+            dcmfiles[ii] = SeriesFileList(list_dicom_files, index)
+            un_echo[ii] = np.unique(echotime_array[np.asarray(index)])
+    else:
+        for ii in range(len(un_sn)):
+            index = [i for i, j in enumerate(sn) if j == un_sn[ii]]
+
+            ff = [''] * len(index)
+
+            for nn in range(len(index)):
+                ff[nn] = list_dicom_files[index[nn]]
+
+            dcmfiles[ii] = [x.encode('UTF8') for x in ff]
+
+            ect = echotime_array[index]
+            un_echo[ii] = np.unique(ect)
+
+    peak = peak_rss_mb()
+    if peak is not None:
+        print("Peak memory (RSS) after scan: %.0f MB" % peak)
+
+    return {'un_seq': un_seq, 'un_seqname': un_seqname, 'un_act': un_act, 'un_sn': un_sn, 'acq_time': acq_time,
+            'un_dti': un_dti, 'nrvols_array': nrvols_array, 'it_list2': it_list2, 'it_list_all': it_list_all,
+            'dcmfiles': dcmfiles, 'un_echo': un_echo}
+
+
+def categorize_series(series, rules, cfg):
+    # BIDS categorization of the series (see series_info) by the categorization cache, the categorization rules and
+    # the config. Returns a dict with scantype_list, label_list, acq_name_list, rec_name_list, exclusion_array and
+    # the series signatures.
+    un_seq = series['un_seq']
+    un_seqname = series['un_seqname']
+    un_act = series['un_act']
+    it_list_all = series['it_list_all']
+    nrseries = len(un_seq)
+
+    # create empty lists
+    scantype_list = ["None"] * nrseries
+    label_list = [''] * nrseries
+    acq_name_list = [''] * nrseries
+    rec_name_list = [''] * nrseries
+    exclusion_array = np.zeros(nrseries, dtype=int)
+
+    configrules = ConfigRules(cfg)
+    try:
+        cachesize = cfg.CategorizationCacheSize
+    except AttributeError:
+        cachesize = 10000
+    cache = CategorizationCache(rules.signature() + configrules.signature(), cachesize)
+
+    # take decisions for known series signatures from the cache
+    # -------------------------------------------------------------
+    signatures = [(un_seqname[ii], un_act[ii], un_seq[ii], list(it_list_all[ii])) for ii in range(nrseries)]
+    misses = []
+    for ii in range(nrseries):
+        decision = cache.get(signatures[ii])
+        if decision is None:
+            misses.append(ii)
+        else:
+            scantype_list[ii], label_list[ii], acq_name_list[ii], rec_name_list[ii], exclusion_array[ii] = decision
+
+    # categorize the other sequences by rules and config
+    # -----------------------------------------------------
+    if misses:
+        for ii in misses:
+            scantype_list[ii], label_list[ii] = rules.categorize(un_seqname[ii], un_act[ii], un_seq[ii])
+
+        # create reconstruction and exclude vector
+        exc, acq, rec = configrules.apply([un_seq[ii] for ii in misses], [it_list_all[ii] for ii in misses],
+                                          [scantype_list[ii] for ii in misses])
+        for nn, ii in enumerate(misses):
+            exclusion_array[ii] = exc[nn]
+            acq_name_list[ii] = acq[nn]
+            rec_name_list[ii] = rec[nn]
+            cache.put(signatures[ii], [scantype_list[ii], label_list[ii], acq_name_list[ii], rec_name_list[ii],
+                                       int(exclusion_array[ii])])
+
+    cache.save()
+    print(cache.report())
+
+    return {'scantype_list': scantype_list, 'label_list': label_list, 'acq_name_list': acq_name_list,
+            'rec_name_list': rec_name_list, 'exclusion_array': exclusion_array, 'signatures': signatures}
+
+
+class GetDCMinfo:
+    def __init__(self, pathdicom, subjectnumber, subjectgroup, sessionnumber, categorizationfile, configfile,
+                 outputdir, subjtext2log, prescan=None):
+
+        # ---------------------------
+        # import config file
+        # ---------------------------
+        cfg = load_config(configfile)
+
+        # -------------------------------------------------
+        # get decision rules from categorization file
+        # -------------------------------------------------
+        rules = CategorizationRules(categorizationfile)
+
+        # ----------------------
+        # get dicom info
+        # ----------------------
+        try:
+            lowmemory = cfg.LowMemoryMode
+        except AttributeError:
+            lowmemory = False
+        try:
+            memorybudget = cfg.MemoryBudgetMB * 1024 * 1024
+        except AttributeError:
+            memorybudget = 2000 * 1024 * 1024
+
+        self.pathdicom = pathdicom
+        self.subjectnumber = subjectnumber
+        self.subjectgroup = subjectgroup
+        self.sessionnumber = sessionnumber
+        self.outputdir = outputdir
+        self.subjtext2log = subjtext2log
+        self.cfg = cfg
+        self.rules = rules
+        self.lowmemory = lowmemory
+        self.memorybudget = memorybudget
+
+        # scan in a worker thread, the rest runs on the main thread when the scan is done
+        self.cancelled = threading.Event()
+        self.dialog = None
+        self.timer = None
+        self.starttime = time.time()
+        self.lastupdate = 0
+        if wx.GetApp() is None:
+            self.onscandone(self.scan(pathdicom, configfile, cfg, prescan))
+        else:
+            self.dialog = wx.ProgressDialog("pyBIDSconv - Load dicom file info", "Searching dicom files ...",
+                                            maximum=1000, style=wx.PD_CAN_ABORT | wx.PD_ELAPSED_TIME | wx.PD_SMOOTH)
+            self.timer = wx.Timer()
+            self.timer.Bind(wx.EVT_TIMER, self.onpulse)
+            self.timer.Start(250)
+            thread = threading.Thread(target=self.scanworker, args=(pathdicom, configfile, cfg, prescan))
+            thread.daemon = True
+            thread.start()
+
+    def scan(self, pathdicom, configfile, cfg, prescan):
+        scanned = None
+        if prescan is not None:
+            scanned = prescan.result(pathdicom, configfile, self.cancelled)
+            if scanned is not None:
+                print('Dicom file info taken from background scan\n')
+        if scanned is None:
+            print('Load dicom file info\n')
+            scanned = scan_dicom_folder(pathdicom, cfg, self.progress, self.cancelled)
+        return scanned
+
+    def scanworker(self, pathdicom, configfile, cfg, prescan):
+        try:
+            scanned = self.scan(pathdicom, configfile, cfg, prescan)
+        except ScanCancelled:
+            wx.CallAfter(self.onscanfailed, None)
+            return
+        except Exception as ex:
+            wx.CallAfter(self.onscanfailed, "Reading the dicom files in " + pathdicom + " failed:\n" + str(ex))
+            return
+        wx.CallAfter(self.onscandone, scanned)
+
+    def onscanfailed(self, message):
+        self.closedialog()
+        if message is not None:
+            d = wx.MessageDialog(None, message, "Warning", wx.OK | wx.ICON_QUESTION)
+            d.ShowModal()
+            d.Destroy()
+
+    def closedialog(self):
+        if self.timer is not None:
+            self.timer.Stop()
+            self.timer = None
+        if self.dialog is not None:
+            self.dialog.Destroy()
+            self.dialog = None
+
+    def onpulse(self, _):
+        # (main thread) file discovery and the wait for a background scan send no progress: the dialog pulses and
+        # its Cancel button still works
+        if self.dialog is None or self.cancelled.is_set() or time.time() - self.lastupdate < 0.5:
+            return
+        if not self.dialog.Pulse()[0]:
+            self.cancelled.set()
+
+    def onprogress(self, count, total):
+        # (main thread) progress, throughput and remaining time of the scan
+        if self.dialog is None or self.cancelled.is_set():
+            return
+        elapsed = max(time.time() - self.starttime, 1e-6)
+        rate = count / elapsed
+        message = "Read %d of %d dicom files (%.0f files/s)" % (count, total, rate)
+        if 0 < rate and count < total:
+            message += ", about %d s left" % ((total - count) / rate)
+        cont = self.dialog.Update(min(int(1000.0 * count / max(total, 1)), 999), message)[0]
+        if not cont:
+            self.cancelled.set()
+
+    def onscandone(self, scanned):
+        # (main thread) checks of the scan result, categorization and CheckSeqs
+        self.closedialog()
+        pathdicom = self.pathdicom
+        subjectnumber = self.subjectnumber
+        subjectgroup = self.subjectgroup
+        sessionnumber = self.sessionnumber
+        outputdir = self.outputdir
+        subjtext2log = self.subjtext2log
+        cfg = self.cfg
+        rules = self.rules
+        lowmemory = self.lowmemory
+        memorybudget = self.memorybudget
+
+        list_dicom_files, table = scanned
+
+        if table is None:
+            # f1 = wx.App()
+            winfo = "No dicom files found in : " + pathdicom + " \nPlease check if your input was correct!! \n"
+            d = wx.MessageDialog(
+                None, winfo, 
+                "Warning", wx.OK | wx.ICON_QUESTION)
+            d.ShowModal()
+            d.Destroy()
+            return
+
+        sn_array = table.sn_array
+        seq_array = table.seq_array
+        acq_date_list = table.acq_date_list
+        patinfo = table.patinfo
+
+        # ----------------------
+        # check acq dates
+        # ----------------------
+        x = scan_dates(acq_date_list)
+        multidate = len(x) > 1
+        if multidate:
+            winfo1 = "Folder: \n" + pathdicom + "\n"
+            winfo2 = "contains data from two different scan sessions/dates:\n"
+            winfo3 = ""
+            for ii in range(len(x)):
+                winfo3 = winfo3 + str(ii+1) + ": " + x[ii] + "\n"
+            winfo3 = winfo3 + "\n"
+            winfo4 = "It is recommended to store the two scan dates as two sessions! \n\n"
+            winfo5 = "Press YES, to go further to store both scan dates in one session\n"
+            winfo6 = "or press NO to seperate the scan dates and start again. "
+            d = wx.MessageDialog(
+                None, winfo1 + winfo2 + winfo3 + winfo4 + winfo5 + winfo6,
+                "Warning", wx.YES_NO | wx.NO_DEFAULT | wx.ICON_QUESTION)
+            answer = d.ShowModal()
+            d.Destroy()
+
+            if answer == wx.ID_YES:
+                split_scan_dates(sn_array, acq_date_list, x)
+
+            elif answer == wx.ID_NO:
+
+                winfo = "Should pyBIDSconv seperate the scans for you? \n(If YES, new directories with copies of the data will created"
+                d = wx.MessageDialog(
+                    None, winfo,
+                    "Warning", wx.YES_NO | wx.ICON_QUESTION)
+                answer2 = d.ShowModal()
+                d.Destroy()
+
+                if answer2 == wx.ID_YES:
+                    dialog = wx.DirDialog(None, "Choose output path for the directories of the separated scans:",
+                                          style=wx.DD_DEFAULT_STYLE | wx.DD_NEW_DIR_BUTTON)
+                    if dialog.ShowModal() == wx.ID_OK:
+                        newdir = dialog.GetPath()
+
+                        for nn in range(len(x)):
+                            directory = os.path.join(newdir, x[nn])
+                            if not os.path.exists(directory):
+                                os.makedirs(directory)
+
+                            fidx = np.asarray([i for i, e in enumerate(acq_date_list) if e == x[nn]])
+                            for ii in range(len(fidx)):
+                                file = list_dicom_files[fidx[ii]]
+                                filename = os.path.basename(file)
+                                dst = os.path.join(directory, filename)
+                                copy_dicom_file(file, dst)
+
+                    winfo = "Data copied!\n\nPlease press OK to close pyBIDSconv and start again."
+                    d = wx.MessageDialog(
+                        None, winfo,
+                        "Warning", wx.OK | wx.ICON_QUESTION)
+                    answer3 = d.ShowModal()
+                    d.Destroy()
+
+                    if answer3 == wx.ID_OK:
+                        quit()
+
+                elif answer2 == wx.ID_NO:
+                    quit()
+
+        # --------------------------
+        # duplicate series numbers
+        # --------------------------
+
+        dupseries = []
+        for oo, unique_seqnames in duplicate_series_numbers(sn_array, seq_array):
+
+            winfo1 = "Folder: \n" + pathdicom + "\n"
+            winfo2 = "contains duplicate series number of two different scans:\n"
+            winfo3 = ""
+            for ii in range(len(unique_seqnames)):
+                winfo3 = winfo3 + str(ii + 1) + ": " + unique_seqnames[ii] + "\n"
+            winfo3 = winfo3 + "\n"
+            winfo4 = "Please check if the data is correct! \n\n"
+            winfo5 = "Press YES, to go further to store all scans in one session\n"
+            winfo6 = "(Session with double numbers will be added at the end of the GUI list). "
+            winfo7 = "or press NO to correct the raw data folder and start again. "
+
+            d = wx.MessageDialog(
+                None, winfo1 + winfo2 + winfo3 + winfo4 + winfo5 + winfo6 + winfo7,
+                "Warning", wx.YES_NO | wx.NO_DEFAULT | wx.ICON_QUESTION)
+            answer = d.ShowModal()
+            d.Destroy()
 
-        # define exclusions based on sequence name parts
-        for ii in range(len(cfg.ExclusionsBySequenceDescriptionContent)):
-            c = [i for i, item in enumerate(un_seq_l) if cfg.ExclusionsBySequenceDescriptionContent[ii] in item]
-            for cc in range(len(c)):
-                exclusion_array[c[cc]] = 1
-                acq_name_list[c[cc]] = cfg.ExclusionsBySequenceDescriptionContent[ii]
-
-        print(exclusion_array)
-
-        # define exclusions based on sequence name end
-        for ii in range(len(cfg.ExclusionsBySequenceDescriptionEnd)):
-            c = []
-            for sco in range(len(un_seq_l)):
-                a = un_seq_l[sco].lower()
-                b = cfg.ExclusionsBySequenceDescriptionEnd[ii].lower()
+            if answer == wx.ID_YES:
+                dupseries += split_series_number(sn_array, seq_array, oo, unique_seqnames)
 
-                if a.endswith(b):
-                    c.append(sco)
-                    print(a + " > " + b)
-            # c = [i for i, item in enumerate(un_seq_l) if cfg.ExclusionsBySequenceDescriptionEnd[ii] in item]
-            for cc in range(len(c)):
-                exclusion_array[c[cc]] = 1
-                acq_name_list[c[cc]] = cfg.ExclusionsBySequenceDescriptionEnd[ii]
+            elif answer == wx.ID_NO:
+                quit()
 
-        exclusion_array = exclusion_array.astype(int)
+        # series and their categorization
+        # ----------------------
+        series = series_info(list_dicom_files, table, sn_array, lowmemory, memorybudget)
+        del sn_array, acq_date_list
+        table.close()
+        un_seq = series['un_seq']
+        un_sn = series['un_sn']
+        acq_time = series['acq_time']
+        nrvols_array = series['nrvols_array']
+        it_list2 = series['it_list2']
+        dcmfiles = series['dcmfiles']
+        un_echo = series['un_echo']
+
+        categories = categorize_series(series, rules, cfg)
+        scantype_list = categories['scantype_list']
+        label_list = categories['label_list']
+        acq_name_list = categories['acq_name_list']
+        rec_name_list = categories['rec_name_list']
+        exclusion_array = categories['exclusion_array']
+        signatures = categories['signatures']
 
+        print(scantype_list)
+        print(label_list)
         print(exclusion_array)
 
+        # replay the decisions of a matching protocol template
+        # ---------------------------------------------------------
+        if getattr(cfg, 'ProtocolReplay', False):
+            rows = ProtocolTemplates(outputdir).match(signatures, getattr(cfg, 'ProtocolTolerance', 1))
+            if rows is not None:
+                try:
+                    conv = grid2conv(rows, un_seq, un_echo, acq_time)
+                except ValueError as ex:
+                    print("Protocol template not applicable: " + str(ex))
+                    conv = None
+                if conv is not None and not conv['warnings']:
+                    print("Series match a protocol template, converting without GUI")
+                    subjtext2log = subjtext2log + "\t- Categorization taken from protocol template\n\n"
+                    Convert2BIDS(pathdicom, subjectnumber, subjectgroup, sessionnumber, subjtext2log, outputdir,
+                                 dcmfiles, conv['folder2conv'], conv['folderindex'], conv['task2conv'],
+                                 conv['run2conv'], conv['acq2conv'], conv['rec2conv'], conv['label2conv'],
+                                 conv['fmapref'], un_seq, acq_time, patinfo, conv['echo2conv'],
+                                 conv['scantime2conv'], cfg=cfg)
+                    return
+
+        # convert without GUI if all sequences are categorized with high confidence
+        # ---------------------------------------------------------------------------
+        if getattr(cfg, 'AutoAccept', False):
+            rows = default_gridstate(un_seq, scantype_list, exclusion_array, acq_name_list, rec_name_list, label_list,
+                                     it_list2, signatures, cfg)
+            scores = confidence_scores(rows, nrvols_array, un_seq, multidate,
+                                       [ii for ii in range(len(un_sn)) if un_sn[ii] in dupseries], cfg)
+            threshold = getattr(cfg, 'AutoAcceptThreshold', 1.0)
+            lowconf = [ii for ii in range(len(scores)) if scores[ii][0] < threshold]
+            for ii in lowconf:
+                print("Low confidence (%.2f) for sequence %d %s: %s" %
+                      (scores[ii][0], ii, un_seq[ii], ', '.join(scores[ii][1])))
+            if not lowconf:
+                try:
+                    conv = grid2conv(rows, un_seq, un_echo, acq_time)
+                except ValueError as ex:
+                    print("Auto accept not possible: " + str(ex))
+                    conv = None
+                if conv is not None and not conv['warnings']:
+                    print("All sequences categorized with high confidence, converting without GUI")
+                    subjtext2log = subjtext2log + "\t- Categorization auto accepted (confidence >= " + \
+                        str(threshold) + ")\n\n"
+                    Convert2BIDS(pathdicom, subjectnumber, subjectgroup, sessionnumber, subjtext2log, outputdir,
+                                 dcmfiles, conv['folder2conv'], conv['folderindex'], conv['task2conv'],
+                                 conv['run2conv'], conv['acq2conv'], conv['rec2conv'], conv['label2conv'],
+                                 conv['fmapref'], un_seq, acq_time, patinfo, conv['echo2conv'],
+                                 conv['scantime2conv'], cfg=cfg)
+                    return
+
         # go to next step
         # x = wx.App()
         frame = CheckSeqs(un_seq, scantype_list, exclusion_array, nrvols_array, subjectnumber, subjectgroup,
                           sessionnumber, subjtext2log, acq_name_list, rec_name_list, label_list, dcmfiles, pathdicom,
-                          outputdir, it_list2, acq_time, patinfo, un_echo)
+                          outputdir, it_list2, acq_time, patinfo, un_echo, cfg=cfg, signatures=signatures)
         frame.Show(True)
 
 
     def progress(self, count, total):
+        # (scan thread) cancel at the next file, progress to the dialog at most 10 times per second
+        if self.cancelled.is_set():
+            raise ScanCancelled()
+
         bar_len = 70
         filled = int(round(bar_len * count / float(total)))
 
@@ -1099,6 +2842,11 @@ class GetDCMinfo:
         sys.stdout.write('[%s] %s%s\r' % (bar, percents, '%'))
         # sys.stdout.flush()
 
+        now = time.time()
+        if self.dialog is not None and (now - self.lastupdate > 0.1 or count == total):
+            self.lastupdate = now
+            wx.CallAfter(self.onprogress, count, total)
+
 # #####################################################################################################################
 # #####################################################################################################################
 #
@@ -1108,8 +2856,726 @@ class GetDCMinfo:
 # #####################################################################################################################
 
 
+def bids_subjnum(subjectnumber, subjectgroup=''):
+    # subject label: group and zero padded subject number
+    if int(float(subjectnumber)) > 99:
+        subjnum = str(subjectnumber)
+    else:
+        if int(float(subjectnumber)) > 9:
+            subjnum = "0" + str(subjectnumber)
+        else:
+            subjnum = "00" + str(subjectnumber)
+
+    if subjectgroup:
+        subjnum = subjectgroup + subjnum
+    return subjnum
+
+
+class BIDSPlan:
+    # Output filenames of the sequences to convert of one subject/session. The names are assembled once in BIDS entity
+    # order (sub, ses, task, acq, rec, run, echo) and used by the filename check, the conversion and the IntendedFor
+    # of the fieldmaps. Labels and entity values are checked with set lookups, duplicates with a dict.
+
+    suffixes = {'anat': frozenset(['T1w', 'T2w', 'T1rho', 'T1map', 'T2map', 'T2star', 'FLAIR', 'FLASH', 'PD', 'PDmap',
+                                   'PDT2', 'inplaneT1', 'inplaneT2', 'angio', 'defacemask']),
+                'func': frozenset(['bold', 'sbref', 'asl']),
+                'dwi': frozenset(['dwi']),
+                'fmap': frozenset(['fieldmap', 'magnitude', 'magnitude1', 'magnitude2', 'phasediff', 'phase1',
+                                   'phase2', 'epi'])}
+    valuechars = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')
+
+    def __init__(self, subjnum, sessionnumber, folder2conv, task2conv, acq2conv, run2conv, rec2conv, label2conv):
+        self.folders = folder2conv
+        self.labels = label2conv
+        self.values = [OrderedDict([('task', task2conv[ii]), ('acq', acq2conv[ii]), ('rec', rec2conv[ii]),
+                                    ('run', run2conv[ii])]) for ii in range(len(folder2conv))]
+
+        prefix = "sub-" + subjnum
+        self.sesfolder = ""
+        if sessionnumber != "":
+            prefix = prefix + "_ses-" + str(sessionnumber)
+            self.sesfolder = "ses-" + str(sessionnumber)
+        self.stems = [prefix + ''.join("_" + key + "-" + value for key, value in values.items() if value != "")
+                      for values in self.values]
+
+    def filename(self, ii, echo='', suffix=None):
+        # filename without extension (multi echo data: echo number, fmap: numbered suffix)
+        stem = self.stems[ii]
+        if echo != '':
+            stem = stem + "_echo-" + str(echo)
+        if suffix is None:
+            suffix = self.labels[ii]
+        return stem + "_" + suffix
+
+    def path(self, ii):
+        return self.folders[ii] + "/" + self.filename(ii)
+
+    def intendedfor(self, ii):
+        # IntendedFor target relative to the subject folder, as required by BIDS: with the session folder and the
+        # subject label including the group (the file that was written)
+        if self.sesfolder:
+            return self.sesfolder + "/" + self.path(ii) + ".nii.gz"
+        return self.path(ii) + ".nii.gz"
+
+    def missingtasks(self):
+        return [ii for ii in range(len(self.folders)) if self.folders[ii] == 'func' and self.values[ii]['task'] == ""]
+
+    def invalidlabels(self):
+        return [ii for ii in range(len(self.folders)) if self.labels[ii] not in self.suffixes.get(self.folders[ii], ())]
+
+    def invalidvalues(self):
+        return [ii for ii in range(len(self.values))
+                if any(not self.valuechars.issuperset(value) for value in self.values[ii].values())]
+
+    def sidecars(self, fmapref, echo2conv):
+        # changes of the json sidecar of each sequence ({key: value}, value None removes the key): task name of func,
+        # IntendedFor of fmap (fmapref: references of the nth fmap) and the echo times of a phasediff fmap
+        patches = [OrderedDict() for ii in range(len(self.folders))]
+        fmc = -1
+        for ii in range(len(self.folders)):
+            if self.folders[ii] == 'func':
+                patches[ii]['TaskName'] = self.values[ii]['task']
+
+            if self.folders[ii] == 'fmap':
+                fmc += 1
+                refs = fmapref[fmc] if fmc < len(fmapref) else []
+                if len(refs) == 1:
+                    patches[ii]['IntendedFor'] = str(self.intendedfor(refs[0]))
+                else:
+                    patches[ii]['IntendedFor'] = [str(self.intendedfor(ref)) for ref in refs]
+
+                if self.labels[ii] == "phasediff" and ii > 0 and self.folders[ii-1] == 'fmap' and \
+                        len(echo2conv[ii-1]) > 1:
+                    patches[ii]['EchoTime'] = None
+                    for jj in range(len(echo2conv[ii-1])):
+                        patches[ii]["EchoTime"+str(jj+1)] = float(echo2conv[ii-1][jj])/1000
+        return patches
+
+    def duplicates(self):
+        # {path: indices} of the paths used by more than one sequence
+        seen = OrderedDict()
+        for ii in range(len(self.folders)):
+            seen.setdefault(self.path(ii), []).append(ii)
+        return OrderedDict((path, indices) for path, indices in seen.items() if len(indices) > 1)
+
+
+def format_run(run):
+    # run label of a grid run value (int or string): the number zero padded to two digits, '' if not set
+    run = ('%s' % run).strip()
+    try:
+        return "%02d" % int(run)
+    except ValueError:
+        return run
+
+
+def grid2conv(rows, un_seq, un_echo, acq_time):
+    # Lists for Convert2BIDS of the sequences selected for conversion in the grid state rows (see
+    # CheckSeqs.getgridstate). Raises ValueError if a selected sequence has no BIDS folder.
+
+    folder2conv = []
+    folderindex = []
+    task2conv = []
+    run2conv = []
+    acq2conv = []
+    rec2conv = []
+    label2conv = []
+    echo2conv = []
+    fmapref = []
+    scantime2conv = []
+    warnings = []
+    maparray = np.empty((len(rows), 2))
+
+    # index of the sequences within the sequences to convert
+    count = -1
+    for i in range(len(rows)):
+        maparray[i][0] = i
+        if rows[i]['convert'] == 'Yes':
+            count += 1
+            maparray[i][1] = count
+
+    for i in range(len(rows)):
+        row = rows[i]
+        if row['convert'] != 'Yes':
+            continue
+
+        if row['folder'] == '---':
+            raise ValueError("Sequence Nr " + str(i) + " is selected to convert but BIDS folder is not selected." +
+                             "\nPlease check your input!")
+        folder2conv.append(row['folder'])
+        folderindex.append(i)
+        echo2conv.append(un_echo[i])
+        task2conv.append(row['task'])
+        run2conv.append(format_run(row['run']))
+
+        acq2conv.append(row['acq'])
+        rec2conv.append(row['rec'])
+        label2conv.append(row['label'])
+
+        if row['folder'] == 'fmap':
+            if not row['ref']:
+                warnings.append("References for fmap (Seq: " + str(un_seq[i]) + ") is not specified!")
+            else:
+                try:
+                    a = row['ref']
+                    a = a.replace(',  ', ' ')
+                    a = a.replace(' , ', ' ')
+                    a = a.replace(',', ' ')
+                    b = a.split()
+                    b = list(map(int, b))
+                    # get index of sequence after convert selection
+                    c = b
+                    for jj in range(len(b)):
+                        index = np.where(maparray[:, 0] == b[jj])
+                        index = np.array(index)
+                        c[jj] = int(maparray[index[0][0], 1])
+                    fmapref.append(c)
+                except:
+                    fmapref.append('')
+
+        try:
+            scantime2conv.append(acq_time[i])
+        except:
+            scantime2conv.append('n/a')
+
+    return {'folder2conv': [x.encode('UTF8') for x in folder2conv], 'folderindex': folderindex,
+            'task2conv': [x.encode('UTF8') for x in task2conv], 'run2conv': [x.encode('UTF8') for x in run2conv],
+            'acq2conv': [x.encode('UTF8') for x in acq2conv], 'rec2conv': [x.encode('UTF8') for x in rec2conv],
+            'label2conv': [x.encode('UTF8') for x in label2conv], 'fmapref': fmapref, 'echo2conv': echo2conv,
+            'scantime2conv': scantime2conv, 'warnings': warnings}
+
+
+def scan_categories(scantype_list, exclusion_array):
+    # index of the BIDS folder (in the CheckSeqs folder list) of each sequence, 0 for excluded sequences
+    labels2 = ['---', 'anat', 'func', 'dwi', 'fmap']
+    scancat = np.array([])
+    for jj in range(len(scantype_list)):
+        la = [labels2.index(i) for i in labels2 if scantype_list[jj] in i]
+        if not la:
+            scancat = np.append(scancat, 0)
+        else:
+            scancat = np.append(scancat, la)
+
+    scancat = scancat.astype(int)
+
+    for ii in range(len(scancat)):
+        if exclusion_array[ii] == 1:
+            scancat[ii] = 0
+    return scancat
+
+
+def guess_fmapref(scancat, it_list2):
+    # fmap references (last func or dwi sequence before the fmap) and index of the fmap label
+    refvalue = [''] * len(scancat)
+    reflab = [''] * len(scancat)
+    mm = [''] * 2
+    cc = [2, 3]
+    for ii in range(len(scancat)):
+        if scancat[ii] == 4:
+            x = scancat[:ii]
+            y = list(reversed(x))
+            for jj in range(len(cc)):
+                try:
+                    mm[jj] = len(y) - y.index(cc[jj]) - 1
+                except:
+                    mm[jj] = 0
+            if mm[0] > mm[1]:
+                refvalue[ii] = mm[0]
+            else:
+                refvalue[ii] = mm[1]
+
+            if it_list2[ii] == "M":
+                reflab[ii] = 1
+
+                if it_list2[ii-1] == "M" and scancat[ii-1] == 4:
+                    reflab[ii] = 3
+                    reflab[ii-1] = 2
+
+            elif it_list2[ii] == "P":
+                reflab[ii] = 4
+
+                if it_list2[ii-1] == "P" and scancat[ii-1] == 4:
+                    reflab[ii] = 6
+                    reflab[ii-1] = 5
+            else:
+                reflab[ii] = 1
+    return refvalue, reflab
+
+
+def default_tasknames(scantype_list, un_seq, cfg=None):
+    # task name of the func sequences: TaskNameBySequenceDescriptionSubstring of the config (last matching
+    # substring) or a placeholder TasknameN
+    try:
+        taskmap = cfg.TaskNameBySequenceDescriptionSubstring
+    except AttributeError:
+        taskmap = {}
+
+    c = [i for i, item in enumerate(scantype_list) if "func" in item]
+    taskname_list = [""] * len(scantype_list)
+    ic = 1
+    for iii in range(len(c)):
+        taskname_list[c[iii]] = "Taskname" + str(ic)
+        for key in taskmap:
+            if key.lower() in un_seq[c[iii]].lower():
+                taskname_list[c[iii]] = taskmap[key]
+        ic += 1
+    return taskname_list
+
+
+def default_gridstate(un_seq, scantype_list, exclusion_array, acq_name_list, rec_name_list, label_list, it_list2,
+                      signatures=None, cfg=None):
+    # grid state rows (see CheckSeqs.getgridstate) of the CheckSeqs GUI before any user input
+    folders = ['---', 'anat', 'func', 'dwi', 'fmap']
+    fmaplabel = ['fieldmap', 'magnitude', 'magnitude1', 'magnitude2', 'phasediff', 'phase1', 'phase2', 'epi']
+    scancat = scan_categories(scantype_list, exclusion_array)
+    refvalue, reflab = guess_fmapref(scancat, it_list2)
+    tasknames = default_tasknames(scantype_list, un_seq, cfg)
+
+    rows = []
+    for i in range(len(un_seq)):
+        row = {'signature': signatures[i] if signatures else None,
+               'convert': ['Yes', 'No'][exclusion_array[i]], 'folder': folders[scancat[i]],
+               'task': '', 'run': '', 'acq': '', 'rec': '', 'label': '', 'ref': ''}
+        if scancat[i] != 0:
+            row['acq'] = acq_name_list[i]
+            row['label'] = label_list[i].strip()
+        if scancat[i] in [1, 2, 3]:
+            row['rec'] = rec_name_list[i]
+        if scancat[i] == 2:
+            row['task'] = tasknames[i]
+        if scancat[i] == 4:
+            row['label'] = fmaplabel[reflab[i]]
+            row['ref'] = str(refvalue[i])
+        rows.append(row)
+    return rows
+
+
+def confidence_scores(rows, nrvols_array, un_seq, multidate=False, duplicates=(), cfg=None):
+    # Confidence of the default categorization of each sequence: fraction of passed checks and the failed checks.
+    # rule: exactly one categorization rule matched (or excluded by config); files: number of files as expected
+    # (ExpectedFileCountBySequenceDescription); series: series number not shared with another series; date: single
+    # acquisition date in the folder; name: task name known and output filename unique; ref: fmap references a
+    # converted func/dwi sequence
+    try:
+        expected = cfg.ExpectedFileCountBySequenceDescription
+    except AttributeError:
+        expected = {}
+
+    names = {}
+    for i, row in enumerate(rows):
+        if row['convert'] == 'Yes':
+            name = (row['folder'], row['task'], row['acq'], row['rec'], row['run'], row['label'])
+            names.setdefault(name, []).append(i)
+
+    scores = []
+    for i, row in enumerate(rows):
+        failed = []
+        if row['convert'] == 'Yes':
+            if row['folder'] == '---' or not row['label']:
+                failed.append('rule')
+            if un_seq[i] in expected and int(expected[un_seq[i]]) != int(nrvols_array[i]):
+                failed.append('files')
+            if i in duplicates:
+                failed.append('series')
+            if multidate:
+                failed.append('date')
+            name = (row['folder'], row['task'], row['acq'], row['rec'], row['run'], row['label'])
+            if row['task'].startswith('Taskname') or len(names[name]) > 1:
+                failed.append('name')
+            if row['folder'] == 'fmap':
+                try:
+                    refs = [int(r) for r in row['ref'].replace(',', ' ').split()]
+                    if not refs or not all(rows[r]['convert'] == 'Yes' and rows[r]['folder'] in ['func', 'dwi']
+                                           for r in refs):
+                        failed.append('ref')
+                except (ValueError, IndexError):
+                    failed.append('ref')
+        scores.append((1.0 - len(failed) / 6.0, failed))
+    return scores
+
+
+class ProtocolTemplates:
+    # Protocol templates of a BIDS dataset (code/pyBIDSconv_protocols.json): the final CheckSeqs grid state of a
+    # subject, keyed by the fingerprint of its ordered list of series signatures. A new subject matches a template
+    # exactly or within a tolerance of extra series that repeat a series of the template (e.g. a repeated run); the
+    # decisions of the repeated series are copied, their runs numbered and fmap references extended to them.
+
+    def __init__(self, outputdir):
+        self.filename = os.path.join(outputdir, 'code', 'pyBIDSconv_protocols.json')
+        try:
+            with open(self.filename) as f:
+                self.templates = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.templates = {}
+
+    @staticmethod
+    def signaturekey(signature):
+        return json.dumps(signature)
+
+    def fingerprint(self, signatures):
+        return hashlib.md5(json.dumps([self.signaturekey(sig) for sig in signatures]).encode('utf-8')).hexdigest()
+
+    def record(self, rows):
+        signatures = [row['signature'] for row in rows]
+        if None in signatures:
+            return
+        self.templates[self.fingerprint(signatures)] = rows
+        try:
+            if not os.path.exists(os.path.dirname(self.filename)):
+                os.makedirs(os.path.dirname(self.filename))
+            with open(self.filename, 'w') as f:
+                f.write(json.dumps(self.templates, indent=4, separators=(', ', ': ')))
+        except (IOError, OSError) as ex:
+            print("Protocol template could not be saved: " + str(ex))
+
+    def match(self, signatures, tolerance=1):
+        # grid state rows for the series signatures or None if no template fits
+        key = self.fingerprint(signatures)
+        if key in self.templates:
+            return [dict(row, signature=sig) for row, sig in zip(self.templates[key], signatures)]
+
+        newkeys = [self.signaturekey(sig) for sig in signatures]
+        for rows in self.templates.values():
+            oldkeys = [self.signaturekey(row['signature']) for row in rows]
+            if not 0 < len(newkeys) - len(oldkeys) <= tolerance:
+                continue
+            replay = self.align(rows, oldkeys, newkeys)
+            if replay is not None:
+                return [dict(row, signature=sig) for row, sig in zip(replay, signatures)]
+        return None
+
+    @staticmethod
+    def align(rows, oldkeys, newkeys):
+        matcher = difflib.SequenceMatcher(None, oldkeys, newkeys, autojunk=False)
+        old2new = {}
+        inserted = []
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                for k in range(i2 - i1):
+                    old2new[i1 + k] = j1 + k
+            elif tag == 'insert' and all(newkeys[j] in oldkeys for j in range(j1, j2)):
+                inserted.extend(range(j1, j2))
+            else:
+                return None
+
+        replay = [None] * len(newkeys)
+        for i, j in old2new.items():
+            replay[j] = dict(rows[i])
+        for j in inserted:
+            # decisions of the last template series with this signature
+            i = len(oldkeys) - 1 - oldkeys[::-1].index(newkeys[j])
+            replay[j] = dict(rows[i])
+
+        # fmap references: template indices to new indices, including the repeats of referenced series
+        for j, row in enumerate(replay):
+            if row['folder'] == 'fmap' and row['ref']:
+                try:
+                    refs = [old2new[int(r)] for r in row['ref'].replace(',', ' ').split()]
+                except (ValueError, KeyError):
+                    return None
+                refs += [k for k in inserted if newkeys[k] in [newkeys[r] for r in refs]]
+                row['ref'] = ' '.join(str(r) for r in sorted(set(refs)))
+
+        # number the runs of series that are converted with identical names now
+        if inserted:
+            groups = OrderedDict()
+            for j, row in enumerate(replay):
+                if row['convert'] == 'Yes':
+                    name = (row['folder'], row['task'], row['acq'], row['rec'], row['label'])
+                    groups.setdefault(name, []).append(j)
+            for members in groups.values():
+                if len(members) > 1 and any(j in inserted for j in members):
+                    for run, j in enumerate(members):
+                        replay[j]['run'] = format_run(run + 1)
+
+        return replay
+
+
+def read_dicom_file(dcmfile):
+    # read a complete dicom file (with pixel data), also from an archive
+    if DicomArchive.separator in dcmfile:
+        archive, member = DicomArchive.split(dcmfile)
+        for _, data in archive.readmembers([member]):
+            return pydicom.read_file(io.BytesIO(data))
+    return pydicom.read_file(dcmfile)
+
+
+def dicom_thumbnail(dcm, size):
+    # middle slice of the pixel data as uint8 array, block averaged to at most size x size pixels and scaled to the
+    # 1-99 percentile range
+    pixels = dcm.pixel_array.astype(np.float32)
+    if getattr(dcm, 'SamplesPerPixel', 1) > 1:
+        pixels = pixels.mean(axis=-1)
+    while pixels.ndim > 2:
+        pixels = pixels[pixels.shape[0] // 2]
+
+    step = int(np.ceil(max(pixels.shape) / float(size)))
+    step = max(1, min(step, min(pixels.shape)))
+    if step > 1:
+        h = pixels.shape[0] // step * step
+        w = pixels.shape[1] // step * step
+        pixels = pixels[:h, :w].reshape(h // step, step, w // step, step).mean(axis=3).mean(axis=1)
+
+    lo, hi = np.percentile(pixels, [1, 99])
+    if hi <= lo:
+        hi = lo + 1
+    return (np.clip((pixels - lo) / (hi - lo), 0, 1) * 255).astype(np.uint8)
+
+
+class ThumbnailCache:
+    # thumbnails of series in the pyBIDSconv cache folder, keyed by SeriesInstanceUID and thumbnail size
+
+    def __init__(self, size):
+        self.size = size
+        self.folder = os.path.join(pybidsconv_cachedir(), 'thumbnails')
+        try:
+            os.makedirs(self.folder)
+        except OSError:
+            pass
+
+    def filename(self, uid):
+        return os.path.join(self.folder, hashlib.sha1(('%s_%d' % (uid, self.size)).encode('utf-8')).hexdigest() +
+                            '.npy')
+
+    def get(self, dcmfile):
+        # thumbnail of the series of dcmfile; the pixel data is only read if the series is not in the cache
+        if DicomArchive.separator in dcmfile:
+            dcm = read_dicom_file(dcmfile)
+        else:
+            dcm = pydicom.read_file(dcmfile, stop_before_pixels=True)
+        uid = str(getattr(dcm, 'SeriesInstanceUID', ''))
+
+        cachefile = self.filename(uid) if uid else None
+        if cachefile is not None and os.path.isfile(cachefile):
+            try:
+                return np.load(cachefile)
+            except (IOError, OSError, ValueError):
+                pass
+
+        if not hasattr(dcm, 'PixelData'):
+            dcm = read_dicom_file(dcmfile)
+        thumb = dicom_thumbnail(dcm, self.size)
+
+        if cachefile is not None:
+            tmpfile = cachefile + '.' + str(os.getpid()) + '.tmp'
+            try:
+                with open(tmpfile, 'wb') as f:
+                    np.save(f, thumb)
+                os.rename(tmpfile, cachefile)
+            except (IOError, OSError):
+                pass
+        return thumb
+
+
+class ThumbnailLoader:
+    # Decodes the thumbnails of the CheckSeqs grid in a background thread. A row is requested by its renderer when
+    # it is drawn for the first time (i.e. when it scrolls into view), the latest request is served first. Finished
+    # thumbnails become wx.Bitmaps on the main thread, then ondone(row) is called.
+
+    def __init__(self, dcmfiles, size, ondone):
+        self.dcmfiles = dcmfiles
+        self.cache = ThumbnailCache(size)
+        self.ondone = ondone
+        self.bitmaps = {}
+        self.requested = set()
+        self.pending = []
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def request(self, row):
+        if row in self.requested:
+            return
+        self.requested.add(row)
+        with self.condition:
+            self.pending.append(row)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                row = self.pending.pop()
+
+            files = self.dcmfiles[row]
+            if len(files) == 0:
+                continue
+            try:
+                thumb = self.cache.get(files[len(files) // 2])
+            except Exception as ex:
+                print("No thumbnail for sequence " + str(row) + ": " + str(ex))
+                continue
+            wx.CallAfter(self.loaded, row, thumb)
+
+    def loaded(self, row, thumb):
+        if self.closed:
+            return
+        h, w = thumb.shape
+        rgb = np.repeat(thumb[:, :, np.newaxis], 3, axis=2)
+        self.bitmaps[row] = wx.Bitmap(wx.Image(w, h, rgb.tobytes()))
+        self.ondone(row)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+
+class ThumbnailRenderer(wx.grid.GridCellRenderer):
+    # draws the thumbnail of a row, or requests it from the ThumbnailLoader while it is not there yet
+
+    def __init__(self, loader):
+        wx.grid.GridCellRenderer.__init__(self)
+        self.loader = loader
+
+    def Draw(self, grid, attr, dc, rect, row, col, isSelected):
+        dc.SetBrush(wx.Brush(attr.GetBackgroundColour()))
+        dc.SetPen(wx.TRANSPARENT_PEN)
+        dc.DrawRectangle(rect)
+        bitmap = self.loader.bitmaps.get(row)
+        if bitmap is None:
+            self.loader.request(row)
+        else:
+            dc.DrawBitmap(bitmap, rect.x + (rect.width - bitmap.GetWidth()) // 2,
+                          rect.y + (rect.height - bitmap.GetHeight()) // 2)
+
+    def GetBestSize(self, grid, attr, dc, row, col):
+        return wx.Size(self.loader.cache.size, self.loader.cache.size)
+
+    def Clone(self):
+        return ThumbnailRenderer(self.loader)
+
+
+class SeqGridTable(wx.grid.GridTableBase):
+    # Virtual table behind the CheckSeqs grid: one row dict per sequence (see CheckSeqs.getgridstate). The grid
+    # only asks for the cells it draws, so building the GUI does not depend on the number of sequences.
+    columns = ['convert', 'folder', 'task', 'run', 'acq', 'rec', 'label', 'ref', 'nr', 'nrvols', 'seq']
+    headers = ['Convert?', 'Folder', '_task-', '_run-', '_acq-', '_rec-', '_label', 'Ref', 'Nr', 'NrVols',
+               'Sequence name']
+    folders = ['---', 'anat', 'func', 'dwi', 'fmap']
+    # editable entities of each folder
+    entities = {'---': [], 'anat': ['run', 'acq', 'rec', 'label'], 'func': ['task', 'run', 'acq', 'rec', 'label'],
+                'dwi': ['run', 'acq', 'rec', 'label'], 'fmap': ['run', 'acq', 'label', 'ref']}
+
+    def __init__(self, rows, un_seq, nrvols_array, defaults, labels, colours, thumbnails=None):
+        wx.grid.GridTableBase.__init__(self)
+        self.rows = rows
+        self.un_seq = un_seq
+        self.nrvols_array = nrvols_array
+        self.defaults = defaults
+        self.labels = labels
+        self.colours = colours
+        # optional thumbnail column (ThumbnailLoader)
+        self.thumbnails = thumbnails
+        if thumbnails is not None:
+            self.columns = self.columns + ['thumb']
+            self.headers = self.headers + ['']
+        # rows with a duplicate output filename (see CheckSeqs.updateplan)
+        self.duplicates = set()
+        # cell attributes are shared between all cells with the same look
+        self.attrs = {}
+
+    def GetNumberRows(self):
+        return len(self.rows)
+
+    def GetNumberCols(self):
+        return len(self.columns)
+
+    def GetColLabelValue(self, col):
+        return self.headers[col]
+
+    def IsEmptyCell(self, row, col):
+        if self.columns[col] == 'thumb':
+            return False
+        return self.GetValue(row, col) == ''
+
+    def GetValue(self, row, col):
+        key = self.columns[col]
+        if key == 'nr':
+            return str(row)
+        elif key == 'nrvols':
+            return str(self.nrvols_array[row])
+        elif key == 'seq':
+            return self.un_seq[row]
+        elif key == 'thumb':
+            return ''
+        return self.rows[row][key]
+
+    def SetValue(self, row, col, value):
+        key = self.columns[col]
+        if key == 'folder':
+            self.setfolder(row, value)
+        elif key in self.rows[row]:
+            self.rows[row][key] = value
+
+    def setfolder(self, row, folder):
+        # a new folder resets the entities of the sequence to the defaults of that folder
+        r = self.rows[row]
+        r['folder'] = folder
+        for key in ['task', 'acq', 'rec']:
+            if key in self.entities[folder]:
+                r[key] = self.defaults[row][key]
+            else:
+                r[key] = ''
+        if folder == '---':
+            r['run'] = ''
+        if self.labels[folder]:
+            r['label'] = self.labels[folder][0]
+        else:
+            r['label'] = ''
+        if folder != 'fmap':
+            r['ref'] = ''
+
+    def GetAttr(self, row, col, kind):
+        r = self.rows[row]
+        key = self.columns[col]
+
+        if r['convert'] == 'No':
+            colour = 'nofont'
+        elif key == 'folder':
+            colour = 'red' if r['folder'] == '---' else 'blue'
+        elif key in ['task', 'acq', 'rec', 'run', 'label'] and row in self.duplicates:
+            colour = 'red'
+        elif key == 'label' and r['label'] in ['', '---']:
+            colour = 'red'
+        else:
+            colour = 'font'
+        readonly = key in ['nr', 'nrvols', 'seq', 'thumb'] or \
+            (key in ['task', 'run', 'acq', 'rec', 'label', 'ref'] and key not in self.entities.get(r['folder'], []))
+        folder = r['folder'] if key == 'label' else None
+
+        attrkey = (col, colour, readonly, folder)
+        if attrkey not in self.attrs:
+            attr = wx.grid.GridCellAttr()
+            attr.SetTextColour(self.colours[colour])
+            if readonly:
+                attr.SetReadOnly(True)
+                attr.SetBackgroundColour(self.colours['background'])
+            elif key in ['run', 'acq', 'rec']:
+                attr.SetBackgroundColour(self.colours['optbox'])
+            else:
+                attr.SetBackgroundColour(self.colours['box'])
+            if key == 'convert':
+                attr.SetEditor(wx.grid.GridCellChoiceEditor(['Yes', 'No']))
+            elif key == 'folder':
+                attr.SetEditor(wx.grid.GridCellChoiceEditor(self.folders))
+            elif key == 'label' and not readonly:
+                attr.SetEditor(wx.grid.GridCellChoiceEditor(self.labels[folder]))
+            elif key == 'thumb':
+                attr.SetRenderer(ThumbnailRenderer(self.thumbnails))
+            self.attrs[attrkey] = attr
+        attr = self.attrs[attrkey]
+        attr.IncRef()
+        return attr
+
+
 class CheckSeqs(wx.Frame):
-    def __init__(self, un_seq, scantype_list, exclusion_array, nrvols_array, subjectnumber, subjectgroup, sessionnumber, subjtext2log, acq_name_list, rec_name_list, label_list, dcmfiles, pathdicom, outputdir, it_list2, acq_time, patinfo, un_echo):
+    def __init__(self, un_seq, scantype_list, exclusion_array, nrvols_array, subjectnumber, subjectgroup, sessionnumber, subjtext2log, acq_name_list, rec_name_list, label_list, dcmfiles, pathdicom, outputdir, it_list2, acq_time, patinfo, un_echo, cfg=None,
+                 signatures=None):
         wx.Frame.__init__(self, None)
 
         # default colours
@@ -1123,25 +3589,19 @@ class CheckSeqs(wx.Frame):
         self.boxbackgroundcolor = wx.Colour(100, 100, 100)
         self.optboxbackgroundcolor = wx.Colour(60, 60, 60)
 
-
-        # self.panel = wx.Panel(self)
-        # self.panel = wx.lib.scrolledpanel.ScrolledPanel(self)
-        self.panel = wx.ScrolledWindow(self, -1)
+        self.panel = wx.Panel(self, -1)
         self.SetBackgroundColour(self.backgroundcolor)
+        self.panel.SetBackgroundColour(self.backgroundcolor)
 
         self.Bind(wx.EVT_CLOSE, self.onclosewindow)
 
-        labels2 = ['---', 'anat', 'func', 'dwi', 'fmap']
-        exctxt = ['Yes', 'No']
         self.exccol = [self.fontcolor, self.NOfontcolor]
         self.fmaplabel = ['fieldmap', 'magnitude', 'magnitude1', 'magnitude2', 'phasediff', 'phase1', 'phase2', 'epi']
         self.anatlabel = ['---', 'T1w', 'T2w', 'T1rho', 'T1map', 'T2map', 'T2star', 'FLAIR', 'FLASH', 'PD', 'PDmap',
                           'PDT2', 'inplaneT1', 'inplaneT2', 'angio', 'defacemask']
         self.funclabel = ['---', 'bold', 'sbref', 'asl']
-        self.dwilabel = ['---', 'dwi', 'bvec', 'bval']
-        self.alllabel = ['---', 'T1w', 'T2w', 'T1rho', 'T1map', 'T2map', 'T2star', 'FLAIR', 'FLASH', 'PD', 'PDmap',
-         'PDT2', 'inplaneT1', 'inplaneT2', 'angio', 'defacemask', 'bold', 'sbref', 'asl', 'dwi', 'bvec', 'bval',
-         'fieldmap', 'magnitude', 'magnitude1', 'magnitude2', 'phasediff', 'phase1', 'phase2', 'epi']
+        # bvec and bval are the gradient files written next to a dwi series, not labels of a series
+        self.dwilabel = ['---', 'dwi']
 
         self.acq_name_list = acq_name_list
         self.rec_name_list = rec_name_list
@@ -1158,86 +3618,44 @@ class CheckSeqs(wx.Frame):
         self.patinfo = patinfo
         self.un_echo = un_echo
         self.subjtext2log = subjtext2log
-
-        scancat = np.array([])
-        for jj in range(len(scantype_list)):
-            la = [labels2.index(i) for i in labels2 if scantype_list[jj] in i]
-            if not la:
-                scancat = np.append(scancat, 0)
-            else:
-                scancat = np.append(scancat, la)
-
-        scancat = scancat.astype(int)
-
-        scancat2 = scancat
-        for ii in range(len(scancat2)):
-            if exclusion_array[ii] == 1:
-                scancat2[ii] = 0
-
-        # guess reference for fmap
-        refvalue = [''] * len(un_seq)
-        reflab = [''] * len(un_seq)
-        mm = [''] * 2
-        cc = [2, 3]
-        for ii in range(len(scancat2)):
-            if scancat2[ii] == 4:
-                x = scancat[:ii]
-                y = list(reversed(x))
-                for jj in range(len(cc)):
-                    try:
-                        mm[jj] = len(y) - y.index(cc[jj]) - 1
-                    except:
-                        mm[jj] = 0
-                if mm[0] > mm[1]:
-                    refvalue[ii] = mm[0]
-                else:
-                    refvalue[ii] = mm[1]
-
-                if it_list2[ii] == "M":
-                    reflab[ii] = 1
-
-                    if it_list2[ii-1] == "M" and scancat2[ii-1] == 4:
-                        reflab[ii] = 3
-                        reflab[ii-1] = 2
-
-                elif it_list2[ii] == "P":
-                    reflab[ii] = 4
-
-                    if it_list2[ii-1] == "P" and scancat2[ii-1] == 4:
-                        reflab[ii] = 6
-                        reflab[ii-1] = 5
-                else:
-                    reflab[ii] = 1
+        self.cfg = cfg
+        self.signatures = signatures
 
         # specify taskname list
-        c = [i for i, item in enumerate(scantype_list) if "func" in item]
-        self.taskname_list = [""] * len(scantype_list)
-        ic = 1
-        for iii in range(len(c)):
-            self.taskname_list[c[iii]] = "Taskname" + str(ic)
-            ic += 1
+        self.taskname_list = default_tasknames(scantype_list, un_seq, cfg)
 
-        # Specify GUI size
+        # Specify GUI size (the grid scrolls by itself and only draws the visible rows)
         screenSize = wx.DisplaySize()
         # screenWidth = screenSize[0]
         screenHeight = screenSize[1]
 
         guiwidth = 1200
         self.vertshift = 100
-        guiheight = len(un_seq)*40+self.vertshift+120
+        rowheight = 30
 
-        if guiheight >= screenHeight*0.7:
-            # self.SetSize((guiwidth, floor(screenHeight*0.9)))
-            self.SetSize((guiwidth, screenHeight * 0.7))
-            self.panel.SetScrollbars(0, 10, 0, guiheight /10)
-            self.panel.SetScrollRate(1, 1)
-        else:
-            self.SetSize((guiwidth, guiheight))
+        # optional thumbnail column, decoded in the background for the rows in view
+        try:
+            thumbnails = cfg.Thumbnails
+        except AttributeError:
+            thumbnails = False
+        try:
+            thumbsize = cfg.ThumbnailSize
+        except AttributeError:
+            thumbsize = 48
+        self.thumbnails = None
+        if thumbnails:
+            self.thumbnails = ThumbnailLoader(dcmfiles, thumbsize, self.refreshrow)
+            rowheight = max(rowheight, thumbsize + 4)
+
+        gridtop = self.vertshift*2/3
+        gridheight = len(un_seq)*rowheight + 35
+        if gridtop + gridheight + 120 >= screenHeight*0.7:
+            gridheight = max(int(screenHeight*0.7) - gridtop - 120, 5*rowheight)
+        guiheight = gridtop + gridheight + 120
 
+        self.SetSize((guiwidth, guiheight))
         self.SetTitle('pyBIDSconv - Check sequence categorization')
         self.Centre()
-        # self.panel.SetupScrolling()
-        self.panel.SetSize((guiwidth, guiheight))
         self.Show(True)
 
 
@@ -1280,16 +3698,7 @@ class CheckSeqs(wx.Frame):
         textfonttitle = wx.Font(20, wx.DECORATIVE, wx.NORMAL, wx.BOLD)
         headerfont = wx.Font(11, wx.DEFAULT, wx.NORMAL, wx.BOLD)
 
-        if int(float(subjectnumber)) > 99:
-            subjnum = str(subjectnumber)
-        else:
-            if int(float(subjectnumber)) > 9:
-                subjnum = "0" + str(subjectnumber)
-            else:
-                subjnum = "00" + str(subjectnumber)
-
-        if subjectgroup:
-            subjnum = subjectgroup + subjnum
+        subjnum = bids_subjnum(subjectnumber, subjectgroup)
 
         # Check output folder (add subj folder and subfolders)
         subjectinfo = 'sub-' + subjnum
@@ -1302,305 +3711,42 @@ class CheckSeqs(wx.Frame):
         subjtext.SetFont(textfonttitle)
         subjtext.SetForegroundColour(self.bluecolor)
 
-        # column headers
-        t = wx.StaticText(self.panel, -1, label="Convert?", pos=(20, self.vertshift*2/3))
-        t.SetFont(headerfont)
-        t.SetForegroundColour(self.fontcolor)
-        t = wx.StaticText(self.panel, -1, label="Folder", pos=(100, self.vertshift*2/3))
-        t.SetFont(headerfont)
-        t.SetForegroundColour(self.fontcolor)
-        t = wx.StaticText(self.panel, -1, label="_task-", pos=(180, self.vertshift*2/3))
-        t.SetFont(headerfont)
-        t.SetForegroundColour(self.bluecolor)
-        t = wx.StaticText(self.panel, -1, label="_run-", pos=(300, self.vertshift*2/3))
-        t.SetFont(headerfont)
-        t.SetForegroundColour(self.bluecolor)
-        t = wx.StaticText(self.panel, -1, label="_acq-", pos=(380, self.vertshift*2/3))
-        t.SetFont(headerfont)
-        t.SetForegroundColour(self.bluecolor)
-        t = wx.StaticText(self.panel, -1, label="_rec-", pos=(480, self.vertshift*2/3))
-        t.SetFont(headerfont)
-        t.SetForegroundColour(self.bluecolor)
-        t = wx.StaticText(self.panel, -1, label="_label", pos=(580, self.vertshift*2/3))
-        t.SetFont(headerfont)
-        t.SetForegroundColour(self.bluecolor)
-
-        t = wx.StaticText(self.panel, -1, label="Ref", pos=(690, self.vertshift*2/3))
-        t.SetFont(headerfont)
-        t.SetForegroundColour(self.fontcolor)
-        t = wx.StaticText(self.panel, -1, label="Nr", pos=(780, self.vertshift*2/3))
-        t.SetFont(headerfont)
-        t.SetForegroundColour(self.fontcolor)
-        t = wx.StaticText(self.panel, -1, label="NrVols", pos=(850, self.vertshift*2/3))
-        t.SetFont(headerfont)
-        t.SetForegroundColour(self.fontcolor)
-        t = wx.StaticText(self.panel, -1, label="Sequence name", pos=(900, self.vertshift*2/3))
-        t.SetFont(headerfont)
-        t.SetForegroundColour(self.fontcolor)
-
-
-        line = wx.StaticLine(self.panel, id=-1, pos=(10, self.vertshift*2/3+20), size=(guiwidth-40, 1), style=wx.LI_HORIZONTAL)
-        line.SetForegroundColour(self.bluecolor)
-        line.SetBackgroundColour(self.bluecolor)
-
-        # ic = 0
-        self.combo1 = {}
-        self.combo2 = {}
-        self.task = {}
-        self.run = {}
-        self.acq = {}
-        self.rec = {}
-        self.label = {}
-        self.ref = {}
+        # sequence grid: one row per sequence, cell values and colours come from a SeqGridTable
+        rows = default_gridstate(un_seq, scantype_list, exclusion_array, acq_name_list, rec_name_list, label_list,
+                                 it_list2, signatures, cfg)
+        defaults = [{'task': self.taskname_list[i], 'acq': acq_name_list[i], 'rec': rec_name_list[i]}
+                    for i in range(len(un_seq))]
+        labels = {'---': [], 'anat': self.anatlabel, 'func': self.funclabel, 'dwi': self.dwilabel,
+                  'fmap': self.fmaplabel}
+        colours = {'font': self.fontcolor, 'nofont': self.NOfontcolor, 'red': self.fontcolor2, 'blue': self.bluecolor,
+                   'box': self.boxbackgroundcolor, 'optbox': self.optboxbackgroundcolor,
+                   'background': self.backgroundcolor}
         self.new = []
 
-        self.nrvols = {}
-        self.seqnr = {}
-        self.seqlabel = {}
-
-        self.reflabel = {}
-
-        indices = np.where(scancat == 0)
-        indices = list(indices)
-        # print(indices)
-        print(scantype_list)
-        for index in range(len(indices)):
-            scantype_list[indices[0][index]] = 'None'
-        print(scantype_list)
-
-
-        ix = 0
-        for i in range(len(un_seq)):
-
-            ix = i
-
-            self.seqnr[i] = wx.StaticText(self.panel, -1, label=str(i), pos=(780, self.vertshift+40*i), 
-                                          name='seq'+str(i))
-            self.seqnr[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-            self.nrvols[i] = wx.StaticText(self.panel, -1, label=str(nrvols_array[i]), pos=(850, self.vertshift+40*i), 
-                                           name='nvol'+str(i))
-            self.nrvols[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-            self.seqlabel[i] = wx.StaticText(self.panel, -1, label=un_seq[i], pos=(900, self.vertshift+40*i), 
-                                             name='scan'+str(i))
-            self.seqlabel[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-
-            self.combo1[i] = wx.ComboBox(self.panel, choices=exctxt, pos=(20, self.vertshift+40*i-5), name='ex'+str(i))
-            self.combo1[i].SetSelection(self.exclusion_array[i])
-            self.combo1[i].Bind(wx.EVT_COMBOBOX, self.oncombo1)
-            self.combo1[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-            self.combo1[i].SetBackgroundColour(self.boxbackgroundcolor)
-
-            self.combo2[i] = wx.ComboBox(self.panel, choices=labels2, pos=(100, self.vertshift+40*i-5), 
-                                         name='st'+str(i))
-            self.combo2[i].SetSelection(scancat[i])
-            self.combo2[i].Bind(wx.EVT_COMBOBOX, self.oncombo2)
-            self.combo2[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-            self.combo2[i].SetBackgroundColour(self.boxbackgroundcolor)
-
-            reflist = range(len(un_seq))
-            del reflist[i]
-            self.reflabel[i] = [str(k) for k in reflist]
-
-            if scantype_list[i] == "func":
-                self.task[i] = wx.TextCtrl(self.panel, pos=(180, self.vertshift+40*i-5), size=(100, 25),
-                                           name='task'+str(i))
-                self.task[i].SetValue(self.taskname_list[i])
-                self.task[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.task[i].SetBackgroundColour(self.boxbackgroundcolor)
-
-                self.run[i] = wx.TextCtrl(self.panel, pos=(300, self.vertshift+40*i-5), size=(30, 25),
-                                          name='run'+str(i))
-                self.run[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.run[i].SetBackgroundColour(self.optboxbackgroundcolor)
-
-                self.acq[i] = wx.TextCtrl(self.panel, pos=(380, self.vertshift+40*i-5), size=(80, 25),
-                                          name='acq'+str(i))
-                self.acq[i].SetValue(self.acq_name_list[i])
-                self.acq[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.acq[i].SetBackgroundColour(self.optboxbackgroundcolor)
-
-                self.rec[i] = wx.TextCtrl(self.panel, pos=(480, self.vertshift+40*i-5), size=(80, 25),
-                                          name='rec'+str(i))
-                self.rec[i].SetValue(self.rec_name_list[i])
-                self.rec[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.rec[i].SetBackgroundColour(self.optboxbackgroundcolor)
-
-                self.label[i] = wx.ComboBox(self.panel, pos=(580, self.vertshift + 40 * i - 5),
-                                            size=(90, 30), name='lab' + str(i))
-                self.label[i].SetItems(self.funclabel)
-                self.label[i].SetValue(self.label_list[i])
-                self.label[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.label[i].SetBackgroundColour(self.boxbackgroundcolor)
-
-                self.ref[i] = wx.TextCtrl(self.panel, pos=(690, self.vertshift+40*i-5), size=(40, 25), name='r'+str(i))
-                self.ref[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.ref[i].SetBackgroundColour(self.boxbackgroundcolor)
-                self.ref[i].Hide()
-
-            elif scantype_list[i] == "anat":
-                self.task[i] = wx.TextCtrl(self.panel, pos=(180, self.vertshift+40*i-5), size=(100, 25),
-                                           name='task'+str(i))
-                self.task[i].Hide()
-                self.task[i].Clear()
-                self.task[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.task[i].SetBackgroundColour(self.boxbackgroundcolor)
-
-                self.run[i] = wx.TextCtrl(self.panel, pos=(300, self.vertshift+40*i-5), size=(30, 25),
-                                          name='run'+str(i))
-                self.run[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.run[i].SetBackgroundColour(self.optboxbackgroundcolor)
-
-                self.acq[i] = wx.TextCtrl(self.panel, pos=(380, self.vertshift+40*i-5), size=(80, 25),
-                                          name='acq'+str(i))
-                self.acq[i].SetValue(self.acq_name_list[i])
-                self.acq[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.acq[i].SetBackgroundColour(self.optboxbackgroundcolor)
-
-                self.rec[i] = wx.TextCtrl(self.panel, pos=(480, self.vertshift+40*i-5), size=(80, 25),
-                                          name='rec'+str(i))
-                self.rec[i].SetValue(self.rec_name_list[i])
-                self.rec[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.rec[i].SetBackgroundColour(self.optboxbackgroundcolor)
-
-                # self.label[i] = wx.TextCtrl(self.panel, pos=(580, self.vertshift+40*i-5), size=(90, 25),
-                #                             name='lab'+str(i))
-                self.label[i] = wx.ComboBox(self.panel, pos=(580, self.vertshift + 40 * i - 5),
-                                            size=(90, 30), name='lab' + str(i))
-                self.label[i].SetItems(self.anatlabel)
-                self.label[i].SetValue(self.label_list[i])
-                self.label[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.label[i].SetBackgroundColour(self.boxbackgroundcolor)
-
-                self.ref[i] = wx.TextCtrl(self.panel, pos=(690, self.vertshift+40*i-5), size=(40, 25), name='r'+str(i))
-                self.ref[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.ref[i].SetBackgroundColour(self.boxbackgroundcolor)
-                self.ref[i].Hide()
-
-            elif scantype_list[i] == "dwi":
-                self.task[i] = wx.TextCtrl(self.panel, pos=(180, self.vertshift+40*i-5), size=(100, 25),
-                                           name='task'+str(i))
-                self.task[i].Hide()
-                self.task[i].Clear()
-                self.task[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.task[i].SetBackgroundColour(self.boxbackgroundcolor)
-
-                self.run[i] = wx.TextCtrl(self.panel, pos=(300, self.vertshift+40*i-5), size=(30, 25),
-                                          name='run'+str(i))
-                self.run[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.run[i].SetBackgroundColour(self.optboxbackgroundcolor)
-
-                self.acq[i] = wx.TextCtrl(self.panel, pos=(380, self.vertshift+40*i-5), size=(80, 25),
-                                          name='acq'+str(i))
-                self.acq[i].SetValue(self.acq_name_list[i])
-                self.acq[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.acq[i].SetBackgroundColour(self.optboxbackgroundcolor)
-
-                self.rec[i] = wx.TextCtrl(self.panel, pos=(480, self.vertshift+40*i-5), size=(80, 25),
-                                          name='rec'+str(i))
-                self.rec[i].SetValue(self.rec_name_list[i])
-                self.rec[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.rec[i].SetBackgroundColour(self.optboxbackgroundcolor)
-
-                self.label[i] = wx.ComboBox(self.panel, pos=(580, self.vertshift + 40 * i - 5),
-                                            size=(90, 30), name='lab' + str(i))
-                self.label[i].SetItems(self.dwilabel)
-                self.label[i].SetValue(self.label_list[i])
-                self.label[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.label[i].SetBackgroundColour(self.boxbackgroundcolor)
-
-                self.ref[i] = wx.TextCtrl(self.panel, pos=(690, self.vertshift+40*i-5), size=(40, 25), name='r'+str(i))
-                self.ref[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.ref[i].SetBackgroundColour(self.boxbackgroundcolor)
-                self.ref[i].Hide()
-
-            elif scantype_list[i] == "fmap":
-                self.task[i] = wx.TextCtrl(self.panel, pos=(180, self.vertshift+40*i-5), size=(100, 25),
-                                           name='task'+str(i))
-                self.task[i].Hide()
-                self.task[i].Clear()
-                self.task[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.task[i].SetBackgroundColour(self.boxbackgroundcolor)
-
-                self.run[i] = wx.TextCtrl(self.panel, pos=(300, self.vertshift+40*i-5), size=(30, 25),
-                                          name='run'+str(i))
-                self.run[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.run[i].SetBackgroundColour(self.optboxbackgroundcolor)
-
-                self.acq[i] = wx.TextCtrl(self.panel, pos=(380, self.vertshift+40*i-5), size=(80, 25),
-                                          name='acq'+str(i))
-                self.acq[i].SetValue(self.acq_name_list[i])
-                self.acq[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.acq[i].SetBackgroundColour(self.optboxbackgroundcolor)
-
-                self.rec[i] = wx.TextCtrl(self.panel, pos=(480, self.vertshift+40*i-5), size=(80, 25),
-                                          name='rec'+str(i))
-                self.rec[i].Hide()
-                self.rec[i].Clear()
-                self.rec[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.rec[i].SetBackgroundColour(self.optboxbackgroundcolor)
-
-                self.label[i] = wx.ComboBox(self.panel, pos=(580, self.vertshift+40*i-5),
-                                            size=(90, 30), name='lab'+str(i))
-                self.label[i].SetItems(self.fmaplabel)
-                self.label[i].SetSelection(reflab[i])
-                self.label[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.label[i].SetBackgroundColour(self.boxbackgroundcolor)
-
-                self.ref[i] = wx.TextCtrl(self.panel, pos=(690, self.vertshift+40*i-5), size=(40, 25), name='r'+str(i))
-                self.ref[i].Show()
-                self.ref[i].SetValue(str(refvalue[i]))
-                self.ref[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.ref[i].SetBackgroundColour(self.boxbackgroundcolor)
-
-            else:
-                self.task[i] = wx.TextCtrl(self.panel, pos=(180, self.vertshift+40*i-5), size=(100, 25),
-                                           name='task'+str(i))
-                self.task[i].SetBackgroundColour(self.boxbackgroundcolor)
-                self.task[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.task[i].Hide()
-                self.task[i].Clear()
-
-                self.run[i] = wx.TextCtrl(self.panel, pos=(300, self.vertshift+40*i-5), size=(30, 25),
-                                          name='run'+str(i))
-                self.run[i].SetBackgroundColour(self.optboxbackgroundcolor)
-                self.run[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.run[i].Hide()
-                self.run[i].Clear()
-
-                self.acq[i] = wx.TextCtrl(self.panel, pos=(380, self.vertshift+40*i-5), size=(80, 25),
-                                          name='acq'+str(i))
-                self.acq[i].SetBackgroundColour(self.optboxbackgroundcolor)
-                self.acq[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.acq[i].Hide()
-                self.acq[i].Clear()
-
-                self.rec[i] = wx.TextCtrl(self.panel, pos=(480, self.vertshift+40*i-5), size=(80, 25),
-                                          name='rec'+str(i))
-                self.rec[i].SetBackgroundColour(self.optboxbackgroundcolor)
-                self.rec[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.rec[i].Hide()
-                self.rec[i].Clear()
-
-                # self.label[i] = wx.TextCtrl(self.panel, pos=(580, self.vertshift+40*i-5), size=(90, 25),
-                #                             name='lab'+str(i))
-                self.label[i] = wx.ComboBox(self.panel, pos=(580, self.vertshift + 40 * i - 5),
-                                            size=(90, 25), name='lab' + str(i))
-                self.label[i].SetItems(self.alllabel)
-                self.label[i].SetBackgroundColour(self.boxbackgroundcolor)
-                self.label[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.label[i].Clear()
-                self.label[i].Hide()
-
-                self.ref[i] = wx.TextCtrl(self.panel, pos=(690, self.vertshift+40*i-5), size=(40, 25), name='r'+str(i))
-                self.ref[i].SetBackgroundColour(self.boxbackgroundcolor)
-                self.ref[i].SetForegroundColour(self.exccol[self.exclusion_array[i]])
-                self.ref[i].Hide()
-                self.ref[i].Clear()
-
-        self.labelcombocol()
-        self.foldercombocol()
-
-        self.button = wx.Button(self.panel, -1, "CONVERT", pos=(600, self.vertshift+40+40*ix), size=(500, 40),
+        self.grid = wx.grid.Grid(self.panel, -1, pos=(10, gridtop), size=(guiwidth-40, gridheight))
+        self.grid.SetDefaultRowSize(rowheight)
+        self.table = SeqGridTable(rows, un_seq, nrvols_array, defaults, labels, colours, self.thumbnails)
+        self.grid.SetTable(self.table, True)
+        self.grid.SetRowLabelSize(0)
+        self.grid.SetColLabelSize(30)
+        colwidths = [80, 80, 120, 40, 100, 100, 100, 90, 40, 60, 300]
+        if self.thumbnails is not None:
+            colwidths[-1] -= thumbsize + 10
+            colwidths.append(thumbsize + 10)
+        for col, width in enumerate(colwidths):
+            self.grid.SetColSize(col, width)
+        self.grid.DisableDragRowSize()
+        self.grid.SetLabelFont(headerfont)
+        self.grid.SetLabelTextColour(self.fontcolor)
+        self.grid.SetLabelBackgroundColour(self.backgroundcolor)
+        self.grid.SetDefaultCellBackgroundColour(self.backgroundcolor)
+        self.grid.SetGridLineColour(self.optboxbackgroundcolor)
+        self.grid.Bind(wx.grid.EVT_GRID_CELL_CHANGED, self.oncellchanged)
+        self.subjnum = bids_subjnum(subjectnumber, subjectgroup)
+        self.updateplan()
+
+        buttontop = gridtop + gridheight + 20
+        self.button = wx.Button(self.panel, -1, "CONVERT", pos=(600, buttontop), size=(500, 40),
                                 name='gobutton')
         self.button.Bind(wx.EVT_BUTTON, self.onbutton)
         self.button.SetFont(wx.Font(20, wx.SCRIPT, wx.NORMAL, wx.BOLD))
@@ -1608,7 +3754,7 @@ class CheckSeqs(wx.Frame):
         self.button.SetForegroundColour(self.bluecolor)
 
         self.checkbutton = wx.Button(self.panel, -1, "Check output filenames here before pressing CONVERT!!",
-                                     pos=(100, self.vertshift + 40 + 40 * ix), size=(400, 40),
+                                     pos=(100, buttontop), size=(400, 40),
                                      name='gobutton')
         self.checkbutton.Bind(wx.EVT_BUTTON, self.oncheckbutton)
         self.checkbutton.SetBackgroundColour(self.buttonbackgroundcolor)
@@ -1621,10 +3767,25 @@ class CheckSeqs(wx.Frame):
         self.helpbutton.SetForegroundColour('white')
         self.helpbutton.Bind(wx.EVT_BUTTON, self.on_label_help)
 
+        # convert decided sequences in the background
+        self.speculative = None
+        try:
+            speculativejobs = cfg.SpeculativeJobs
+        except AttributeError:
+            speculativejobs = 0
+        if speculativejobs > 0:
+            self.speculative = SpeculativeConversion(dcmfiles, speculativejobs, getattr(cfg, 'DicomReadOrder', ''),
+                                                     getattr(cfg, 'StagingRoot', ''))
+            self.updatespeculative()
+
     def onquit(self, event):
         self.Close(True)
 
     def onclosewindow(self, event):
+        if self.speculative is not None:
+            self.speculative.close()
+        if self.thumbnails is not None:
+            self.thumbnails.close()
         self.Destroy()
 
     def onabout_pybidsconv(self, e):
@@ -1654,371 +3815,739 @@ class CheckSeqs(wx.Frame):
     def getvalue(self):
         return self.input.GetValue()
 
-    def labelcombocol(self):
-        for i in range(len(self.un_seq)):
-            selection = self.label[i].GetSelection()
-            if selection == 0:
-                self.label[i].SetForegroundColour(wx.RED)
-            else:
-                self.label[i].SetForegroundColour(self.exccol[0])
-        self.panel.Refresh()
-
-    def foldercombocol(self):
-        for i in range(len(self.un_seq)):
-            tr = self.combo1[i].GetCurrentSelection()
-            fold = self.combo2[i].GetCurrentSelection()
-            if tr == 0:
-                if fold == 0:
-                    self.combo2[i].SetForegroundColour(wx.RED)
-                else:
-                    self.combo2[i].SetForegroundColour(self.bluecolor)
-        self.panel.Refresh()
-
-    def oncombo1(self, event):
-        b = event.GetEventObject().GetName()
-        nr = int(float(b[2:]))
-
-        selection = event.GetSelection()
+    def oncellchanged(self, event):
+        # an edit changes at most its own row (folder defaults, colours) and the duplicate marks
+        self.updateplan()
+        self.refreshrow(event.GetRow())
+        self.updatespeculative()
+        event.Skip()
+
+    def updateplan(self):
+        # mark the rows of the sequences to convert whose output filename is not unique
+        rows = self.table.rows
+        selected = [i for i in range(len(rows)) if rows[i]['convert'] == 'Yes' and rows[i]['folder'] != '---']
+        plan = BIDSPlan(self.subjnum, self.sessionnumber,
+                        *[[rows[i][key] for i in selected] for key in ['folder', 'task', 'acq', 'run', 'rec', 'label']])
+        duplicates = set(selected[jj] for indices in plan.duplicates().values() for jj in indices)
+        changed = duplicates ^ self.table.duplicates
+        self.table.duplicates = duplicates
+        for row in changed:
+            self.refreshrow(row)
+
+    def refreshrow(self, row):
+        lastcol = self.table.GetNumberCols() - 1
+        rect = self.grid.BlockToDeviceRect(wx.grid.GridCellCoords(row, 0), wx.grid.GridCellCoords(row, lastcol))
+        self.grid.GetGridWindow().RefreshRect(rect)
+
+    def updatespeculative(self):
+        # anat and dwi sequences with a label do not depend on task names or references
+        if self.speculative is None:
+            return
+        wanted = {}
+        for i, row in enumerate(self.getgridstate()):
+            if row['convert'] == 'Yes' and row['folder'] in ['anat', 'dwi'] and row['label'] not in ['', '---']:
+                wanted[i] = row['folder']
+        self.speculative.update(wanted)
 
-        # app = wx.App()
-        if selection == 0:
-            self.task[nr].SetForegroundColour(self.exccol[0])
-            self.run[nr].SetForegroundColour(self.exccol[0])
-            self.acq[nr].SetForegroundColour(self.exccol[0])
-            self.rec[nr].SetForegroundColour(self.exccol[0])
-            self.ref[nr].SetForegroundColour(self.exccol[0])
-            self.label[nr].SetForegroundColour(self.exccol[0])
-            self.seqlabel[nr].SetForegroundColour(self.exccol[0])
-            self.nrvols[nr].SetForegroundColour(self.exccol[0])
-            self.seqnr[nr].SetForegroundColour(self.exccol[0])
-            self.panel.Refresh()
-        elif selection == 1:
-            self.combo2[nr].SetForegroundColour(self.exccol[1])
-            self.task[nr].SetForegroundColour(self.exccol[1])
-            self.run[nr].SetForegroundColour(self.exccol[1])
-            self.rec[nr].SetForegroundColour(self.exccol[1])
-            self.acq[nr].SetForegroundColour(self.exccol[1])
-            self.ref[nr].SetForegroundColour(self.exccol[1])
-            self.label[nr].SetForegroundColour(self.exccol[1])
-            self.seqlabel[nr].SetForegroundColour(self.exccol[1])
-            self.nrvols[nr].SetForegroundColour(self.exccol[1])
-            self.seqnr[nr].SetForegroundColour(self.exccol[1])
-            self.panel.Refresh()
-
-        self.foldercombocol()
-
-    def oncombo2(self, event):
-        b = event.GetEventObject().GetName()
-        nr = int(float(b[2:]))
-
-        selection = event.GetSelection()
-        self.foldercombocol()
+    def oncheckbutton(self, event):
+        folder2conv = []
+        task2conv = []
+        run2conv = []
+        acq2conv = []
+        rec2conv = []
+        label2conv = []
 
-        # app = wx.App()
-        if selection == 2:
-            self.task[nr].Show()
-            self.task[nr].SetValue(self.taskname_list[nr])
+        for i, row in enumerate(self.getgridstate()):
 
-            self.run[nr].Show()
+            if row['convert'] == 'Yes':
+                if row['folder'] == '---':
+                    infomsg = "Sequence Nr " + str(i) + " is selected to convert but BIDS folder is not selected." + \
+                              "\nPlease check your input!"
+                    d = wx.MessageDialog(None, infomsg, "INPUT ERROR!", wx.OK)
+                    d.ShowModal()
+                    d.Destroy()
+                    return
+                folder2conv.append(row['folder'])
+                task2conv.append(row['task'])
+                run2conv.append(format_run(row['run']))
+                acq2conv.append(row['acq'])
+                rec2conv.append(row['rec'])
+                label2conv.append(row['label'])
 
-            self.acq[nr].Show()
-            self.acq[nr].SetValue(self.acq_name_list[nr])
+                if row['folder'] == 'fmap' and not row['ref']:
+                    msg = "References for fmap (Seq: " + str(self.un_seq[i]) + ") is not specified!"
+                    wx.MessageBox(msg, "Input error!", wx.CANCEL)
 
-            self.rec[nr].Show()
-            self.rec[nr].SetValue(self.rec_name_list[nr])
+        folder2conv = [x.encode('UTF8') for x in folder2conv]
+        task2conv = [x.encode('UTF8') for x in task2conv]
+        run2conv = [x.encode('UTF8') for x in run2conv]
+        acq2conv = [x.encode('UTF8') for x in acq2conv]
+        rec2conv = [x.encode('UTF8') for x in rec2conv]
+        label2conv = [x.encode('UTF8') for x in label2conv]
 
-            self.label[nr].SetItems(self.funclabel)
-            self.label[nr].SetSelection(0)
-            self.label[nr].SetForegroundColour(self.exccol[self.exclusion_array[nr]])
-            self.label[nr].SetBackgroundColour(self.boxbackgroundcolor)
-            self.label[nr].Show()
+        CheckFilename(folder2conv, bids_subjnum(self.subjectnumber, self.subjectgroup), self.sessionnumber, task2conv,
+                      acq2conv, run2conv, rec2conv, label2conv)
 
-            self.ref[nr].Hide()
-            self.ref[nr].Clear()
+    def getgridstate(self):
+        # current decisions in the GUI, one dict per sequence
+        if self.grid.IsCellEditControlEnabled():
+            self.grid.SaveEditControlValue()
+        return [dict(row) for row in self.table.rows]
 
-        elif selection == 1:
-            self.task[nr].Hide()
-            self.task[nr].Clear()
+    def onbutton(self, event):
+        rows = self.getgridstate()
 
-            self.run[nr].Show()
+        try:
+            conv = grid2conv(rows, self.un_seq, self.un_echo, self.acq_time)
+        except ValueError as ex:
+            d = wx.MessageDialog(None, str(ex), "INPUT ERROR!", wx.OK)
+            d.ShowModal()
+            d.Destroy()
+            return
 
-            self.acq[nr].Show()
-            self.acq[nr].SetValue(self.acq_name_list[nr])
+        for msg in conv['warnings']:
+            wx.MessageBox(msg, "Input error!", wx.CANCEL)
 
-            self.rec[nr].Show()
-            self.rec[nr].SetValue(self.rec_name_list[nr])
+        if getattr(self.cfg, 'ProtocolReplay', False):
+            ProtocolTemplates(self.outputdir).record(rows)
 
-            self.label[nr].SetItems(self.anatlabel)
-            self.label[nr].SetSelection(0)
-            self.label[nr].SetForegroundColour(self.exccol[self.exclusion_array[nr]])
-            self.label[nr].SetBackgroundColour(self.boxbackgroundcolor)
-            self.label[nr].Show()
+        # hand the background conversions over to Convert2BIDS
+        self.updatespeculative()
+        speculative = self.speculative
+        self.speculative = None
+        if speculative is not None:
+            speculative.finish()
 
-            self.ref[nr].Hide()
-            self.ref[nr].Clear()
+        self.Close()
 
-        elif selection == 3:
-            self.task[nr].Hide()
-            self.task[nr].Clear()
+        Convert2BIDS(self.pathdicom, self.subjectnumber, self.subjectgroup, self.sessionnumber, self.subjtext2log,
+                     self.outputdir, self.dcmfiles, conv['folder2conv'], conv['folderindex'], conv['task2conv'],
+                     conv['run2conv'], conv['acq2conv'], conv['rec2conv'], conv['label2conv'], conv['fmapref'],
+                     self.un_seq, self.acq_time, self.patinfo, conv['echo2conv'], conv['scantime2conv'],
+                     cfg=self.cfg, speculative=speculative)
 
-            self.run[nr].Show()
 
-            self.acq[nr].Show()
-            self.acq[nr].SetValue(self.acq_name_list[nr])
+# ################################################################################################################################
+# ################################################################################################################################
+#
+# Conversion plan
+#
+# ################################################################################################################################
+# ################################################################################################################################
 
-            self.rec[nr].Show()
-            self.rec[nr].SetValue(self.rec_name_list[nr])
+def series_output_estimate(files):
+    # expected number of volumes and uncompressed output bytes of a series, from the header of its first file
+    if DicomArchive.separator in files[0]:
+        dcm = read_dicom_file(files[0])
+    else:
+        dcm = pydicom.read_file(files[0], stop_before_pixels=True)
+    rows = int(getattr(dcm, 'Rows', 0) or 0)
+    columns = int(getattr(dcm, 'Columns', 0) or 0)
+    bits = int(getattr(dcm, 'BitsAllocated', 16) or 16)
+    frames = int(getattr(dcm, 'NumberOfFrames', 1) or 1)
+    imagetype = [str(x).upper() for x in getattr(dcm, 'ImageType', [])]
+
+    nrfiles = len(files)
+    if 'MOSAIC' in imagetype or frames > 1:
+        # one volume per file
+        volumes = nrfiles
+    else:
+        # one slice per file
+        try:
+            slices = int(dcm.ImagesInAcquisition)
+        except (AttributeError, TypeError, ValueError):
+            slices = nrfiles
+        volumes = max(1, nrfiles // max(slices, 1))
+    return volumes, nrfiles * frames * rows * columns * bits // 8
 
-            self.label[nr].SetItems(self.dwilabel)
-            self.label[nr].SetSelection(0)
-            self.label[nr].SetForegroundColour(self.exccol[self.exclusion_array[nr]])
-            self.label[nr].Show()
 
-            self.ref[nr].Hide()
-            self.ref[nr].Clear()
+def plan_echo_times(echoes):
+    values = []
+    for echo in echoes:
+        try:
+            values.append(float(echo))
+        except (TypeError, ValueError):
+            values.append(str(echo))
+    return values
+
+
+def plan_subject(pathdicom, subjectnumber, subjectgroup, sessionnumber, rules, cfg, outputdir, usetemplates=False):
+    # Conversion plan of one subject, without GUI and without writing to the BIDS folder: header scan,
+    # categorization and (usetemplates) the decisions of a matching protocol template. The questions of the GUI get
+    # their default answer (scan dates and duplicate series numbers are kept in one session) and become warnings.
+    warnings = []
+    list_dicom_files, table = scan_dicom_folder(pathdicom, cfg)
+    if table is None:
+        raise ValueError("No dicom files found in " + pathdicom)
+
+    sn_array = table.sn_array
+    dates = scan_dates(table.acq_date_list)
+    if len(dates) > 1:
+        warnings.append("Data of the scan dates " + ", ".join(dates) + " kept in one session")
+        split_scan_dates(sn_array, table.acq_date_list, dates)
+    for oo, unique_seqnames in duplicate_series_numbers(sn_array, table.seq_array):
+        warnings.append("Series number " + str(int(oo)) + " shared by " + ", ".join(unique_seqnames))
+        split_series_number(sn_array, table.seq_array, oo, unique_seqnames)
+
+    series = series_info(list_dicom_files, table, sn_array, getattr(cfg, 'LowMemoryMode', False),
+                         getattr(cfg, 'MemoryBudgetMB', 2000) * 1024 * 1024)
+    del sn_array
+    table.close()
+    categories = categorize_series(series, rules, cfg)
+
+    rows = None
+    if usetemplates:
+        rows = ProtocolTemplates(outputdir).match(categories['signatures'], getattr(cfg, 'ProtocolTolerance', 1))
+        if rows is None:
+            warnings.append("No matching protocol template, default categorization used")
+    if rows is None:
+        rows = default_gridstate(series['un_seq'], categories['scantype_list'], categories['exclusion_array'],
+                                 categories['acq_name_list'], categories['rec_name_list'], categories['label_list'],
+                                 series['it_list2'], categories['signatures'], cfg)
+    for ii in range(len(rows)):
+        if rows[ii]['convert'] == 'Yes' and rows[ii]['folder'] == '---':
+            warnings.append("Series " + str(series['un_seq'][ii]) + " is not categorized and not converted")
+            rows[ii]['convert'] = 'No'
+    conv = grid2conv(rows, series['un_seq'], series['un_echo'], series['acq_time'])
+    warnings += conv['warnings']
+
+    subjectfolder = bids_subject(subjectnumber, subjectgroup, sessionnumber).replace('\\', '/')
+    if os.path.exists(os.path.join(outputdir, subjectfolder)):
+        warnings.append(subjectfolder + " already exists in the BIDS folder")
+
+    task2conv = [re.sub(" ", "", x) for x in conv['task2conv']]
+    plan = BIDSPlan(bids_subjnum(subjectnumber, subjectgroup), sessionnumber, conv['folder2conv'], task2conv,
+                    conv['acq2conv'], conv['run2conv'], conv['rec2conv'], conv['label2conv'])
+    sidecars = plan.sidecars(conv['fmapref'], conv['echo2conv'])
+    for ii in plan.invalidlabels():
+        warnings.append(plan.path(ii) + ": not a valid BIDS suffix for " + plan.folders[ii])
+    for ii in plan.invalidvalues():
+        warnings.append(plan.path(ii) + ": entities with characters other than letters and digits")
+    for ii in plan.missingtasks():
+        warnings.append(plan.path(ii) + ": task name missing")
+    for path in plan.duplicates():
+        warnings.append(path + ": duplicate output filename")
+
+    planned = []
+    fmc = -1
+    for ii in range(len(conv['folderindex'])):
+        index = conv['folderindex'][ii]
+        files = list(series['dcmfiles'][index])
+        try:
+            volumes, nbytes = series_output_estimate(files)
+        except Exception as ex:
+            warnings.append(plan.path(ii) + ": no size estimate (" + str(ex) + ")")
+            volumes, nbytes = None, None
+
+        entry = OrderedDict([('index', index), ('seriesnumber', int(series['un_sn'][index])),
+                             ('description', str(series['un_seq'][index])), ('folder', plan.folders[ii]),
+                             ('entities', plan.values[ii]), ('label', plan.labels[ii]),
+                             ('target', subjectfolder + "/" + plan.path(ii)), ('sidecar', sidecars[ii])])
+        if plan.folders[ii] == 'fmap':
+            fmc += 1
+            refs = conv['fmapref'][fmc] if fmc < len(conv['fmapref']) else []
+            entry['ref'] = list(refs) if refs != '' else []
+            entry['intendedfor'] = [plan.intendedfor(ref) for ref in entry['ref']]
+        entry['echo_times'] = plan_echo_times(conv['echo2conv'][ii])
+        entry['acq_time'] = conv['scantime2conv'][ii]
+        entry['nrfiles'] = len(files)
+        entry['volumes'] = volumes
+        entry['bytes'] = nbytes
+        entry['files'] = files
+        planned.append(entry)
+
+    return OrderedDict([('pathdicom', pathdicom), ('subjectnumber', subjectnumber), ('subjectgroup', subjectgroup),
+                        ('session', sessionnumber), ('subject', subjectfolder),
+                        ('patinfo', [str(x) for x in table.patinfo]), ('warnings', warnings),
+                        ('bytes', sum(e['bytes'] or 0 for e in planned)), ('series', planned)])
+
+
+def plan_study(subjects, categorizationfile, configfile, outputdir, usetemplates=False):
+    # conversion plan of several subjects (dicts with pathdicom, subjectnumber, subjectgroup, session); subjects that
+    # cannot be planned are listed with their error
+    cfg = load_config(configfile)
+    rules = CategorizationRules(categorizationfile)
+    plan = OrderedDict([('version', 1), ('created', datetime.now().strftime('%Y-%m-%dT%H:%M:%S')),
+                        ('pyBIDSconv', ver), ('outputdir', os.path.abspath(outputdir)),
+                        ('configfile', os.path.abspath(configfile)),
+                        ('categorizationfile', os.path.abspath(categorizationfile)), ('subjects', []),
+                        ('errors', [])])
+    for subject in subjects:
+        t0 = time.time()
+        try:
+            plan['subjects'].append(plan_subject(subject['pathdicom'], subject['subjectnumber'],
+                                                 subject.get('subjectgroup', ''), subject.get('session', ''), rules,
+                                                 cfg, outputdir, usetemplates))
+        except Exception as ex:
+            plan['errors'].append(OrderedDict([('pathdicom', subject['pathdicom']), ('error', str(ex))]))
+        print("Planned %s (%.1f s)" % (subject['pathdicom'], time.time() - t0))
+    return plan
+
+
+def execute_plan(plan, cfg=None, outputdir=None):
+    # convert the subjects of a conversion plan (see plan_study)
+    if outputdir is None:
+        outputdir = plan['outputdir']
+    for subjectplan in plan['subjects']:
+        Convert2BIDS.fromplan(subjectplan, outputdir, cfg)
+
+
+def read_subject_list(filename):
+    # tab separated subject list with a header line: dicom, subject and optionally group and session
+    subjects = []
+    with open(filename) as f:
+        header = f.readline().rstrip('\r\n').split('\t')
+        for line in f:
+            if not line.strip():
+                continue
+            values = dict(zip(header, line.rstrip('\r\n').split('\t')))
+            subjects.append({'pathdicom': values['dicom'], 'subjectnumber': values['subject'],
+                             'subjectgroup': values.get('group', ''), 'session': values.get('session', '')})
+    return subjects
 
 
-        elif selection == 4:
-            self.task[nr].Hide()
-            self.task[nr].Clear()
+# ################################################################################################################################
+# ################################################################################################################################
+#
+# Shared work queue
+#
+# ################################################################################################################################
+# ################################################################################################################################
 
-            self.run[nr].Show()
+def worker_id():
+    # name of this process in claims and locks
+    return "%s_%d" % (socket.gethostname(), os.getpid())
 
-            self.acq[nr].Show()
-            self.acq[nr].SetValue(self.acq_name_list[nr])
 
-            self.rec[nr].Hide()
-            self.rec[nr].Clear()
+def makedirs(path):
+    # os.makedirs that tolerates the creation of the same folder by another worker, and the removal of an empty
+    # parent folder by another worker in between
+    for attempt in range(3):
+        try:
+            os.makedirs(path)
+            return
+        except OSError as ex:
+            if os.path.isdir(path):
+                return
+            if ex.errno != errno.ENOENT or attempt == 2:
+                raise
+
+
+def write_atomic(filename, data):
+    # readers (and other nodes) see either the old or the complete new file
+    tmpname = os.path.join(os.path.dirname(filename), '.' + os.path.basename(filename) + '.' + worker_id())
+    with open(tmpname, 'w') as f:
+        f.write(data)
+    os.rename(tmpname, filename)
+
+
+def filesystem_time(folder):
+    # current time of the file server: the age of claims and locks is measured with it instead of the (possibly
+    # different) clock of this node
+    clock = os.path.join(folder, '.clock_' + worker_id())
+    with open(clock, 'w'):
+        pass
+    os.utime(clock, None)
+    now = os.stat(clock).st_mtime
+    os.remove(clock)
+    return now
+
+
+class Heartbeat:
+    # touches a claim or lock file every interval seconds in a daemon thread, onlost is called when the file is gone
+    # or replaced by another file (the claim was given to another worker, the lock was broken)
+
+    def __init__(self, filename, interval, onlost=None):
+        self.filename = filename
+        self.interval = interval
+        self.onlost = onlost
+        try:
+            self.inode = os.stat(filename).st_ino
+        except OSError:
+            self.inode = None
+        self.stopped = threading.Event()
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def beat(self):
+        if os.stat(self.filename).st_ino != self.inode:
+            raise OSError(errno.ENOENT, "replaced", self.filename)
+        os.utime(self.filename, None)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.beat()
+            except OSError:
+                # a lock file is taken away for a moment when another worker checks it
+                if self.stopped.wait(0.5):
+                    return
+                try:
+                    self.beat()
+                except OSError:
+                    if self.onlost is not None:
+                        self.onlost()
+                    return
 
-            self.label[nr].SetItems(self.fmaplabel)
-            self.label[nr].SetSelection(0)
-            self.label[nr].SetBackgroundColour(self.boxbackgroundcolor)
-            self.label[nr].Show()
+    def stop(self):
+        self.stopped.set()
 
-            self.ref[nr].Show()
 
-        else:
+class DatasetLock:
+    # Advisory lock of the dataset level files of a BIDS folder (CHANGES, participants.tsv/.json,
+    # dataset_description.json) and of the publication of subject folders, for conversions in several threads,
+    # processes or nodes: exclusive creation of .pyBIDSconv.lock, kept alive by a heartbeat and broken by the next
+    # worker when not touched for timeout seconds. The lock file holds a token of its owner: a lock file is only
+    # removed (on release or when broken) if it still holds the token it was judged by, a lock file taken away by
+    # mistake is put back. A holder whose lock was broken gets an IOError on release.
+    lockname = '.pyBIDSconv.lock'
 
-            self.task[nr].Hide()
-            self.task[nr].Clear()
+    def __init__(self, outputdir, timeout=300):
+        self.outputdir = outputdir
+        self.lockfile = os.path.join(outputdir, self.lockname)
+        self.timeout = timeout
+        self.heartbeat = None
+        self.token = '%s_%x_%.6f' % (worker_id(), id(self), time.time())
+        self.lost = threading.Event()
+
+    def __enter__(self):
+        delay = 0.05
+        while True:
+            try:
+                fd = os.open(self.lockfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError as ex:
+                if ex.errno != errno.EEXIST:
+                    raise
+                self.breakstale()
+                time.sleep(delay)
+                delay = min(2 * delay, 1.0)
+                continue
+            os.write(fd, self.token.encode('UTF8'))
+            os.close(fd)
+            self.lost.clear()
+            self.heartbeat = Heartbeat(self.lockfile, max(1, self.timeout // 4), self.lost.set)
+            return self
 
-            self.run[nr].Hide()
-            self.run[nr].Clear()
+    @staticmethod
+    def readtoken(filename):
+        with open(filename, 'rb') as f:
+            return f.read().decode('UTF8')
 
-            self.acq[nr].Hide()
-            self.acq[nr].Clear()
+    def breakstale(self):
+        try:
+            token = self.readtoken(self.lockfile)
+            age = filesystem_time(self.outputdir) - os.stat(self.lockfile).st_mtime
+        except (IOError, OSError):
+            return
+        if age > self.timeout:
+            # one of the waiting workers breaks the stale lock: the one that creates its break marker
+            marker = self.lockfile + '.break_' + token
+            try:
+                os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except OSError:
+                return
+            try:
+                if self.remove(token):
+                    print("Stale lock removed: " + self.lockfile)
+            finally:
+                os.remove(marker)
+
+    def remove(self, token):
+        # remove the lock file if it holds token; the check is made on the renamed file, a lock file of another
+        # owner (created since the token was read) is linked back
+        taken = self.lockfile + '.' + self.token
+        try:
+            os.rename(self.lockfile, taken)
+        except OSError:
+            return False
+        try:
+            try:
+                owner = self.readtoken(taken)
+            except (IOError, OSError):
+                owner = None
+            if owner == token:
+                return True
+            try:
+                os.link(taken, self.lockfile)
+            except OSError:
+                # a new lock meanwhile: the owner of the taken one is told by its heartbeat
+                pass
+            return False
+        finally:
+            os.remove(taken)
 
-            self.rec[nr].Hide()
-            self.rec[nr].Clear()
+    def __exit__(self, *args):
+        self.heartbeat.stop()
+        if not self.lost.is_set() and self.remove(self.token):
+            return
+        if args[0] is None:
+            raise IOError("Dataset lock lost (broken by another worker as stale): " + self.lockfile)
 
-            self.label[nr].Hide()
-            self.label[nr].Clear()
 
-            self.ref[nr].Hide()
-            self.ref[nr].Clear()
+class DatasetFragments:
+    # Entries of the conversions for the dataset level files, written without lock to fragment files of each
+    # conversion (.pybidsconv_fragments in the BIDS folder) and folded into the dataset level files by merge, under
+    # the DatasetLock: <name>.log while the conversion runs, <name>.changes (CHANGES entry, without number) and
+    # <name>.participants (participants.tsv row) when it is done. Fragments of crashed workers are merged by the next.
+    foldername = '.pybidsconv_fragments'
 
-        self.labelcombocol()
-        self.panel.Refresh()
+    @staticmethod
+    def folder(outputdir):
+        # the folder stays, other conversions may write to it
+        folder = os.path.join(outputdir, DatasetFragments.foldername)
+        makedirs(folder)
+        return folder
 
-    def oncheckbutton(self, event):
-        b = event.GetEventObject().GetName()
+    @staticmethod
+    def write(outputdir, name, kind, data):
+        write_atomic(os.path.join(DatasetFragments.folder(outputdir), name + '.' + kind), data)
 
-        data2conv = []
-        folder2conv = []
-        folderindex = []
-        task2conv = []
-        run2conv = []
-        acq2conv = []
-        rec2conv = []
-        label2conv = []
-        echo2conv = []
-        fmapref = []
+    @staticmethod
+    def pending(folder, kind):
+        # in the order the conversions finished
+        try:
+            names = [name for name in os.listdir(folder) if name.endswith('.' + kind) and not name.startswith('.')]
+        except OSError:
+            return []
+        files = [os.path.join(folder, name) for name in names]
+        return sorted(files, key=lambda filename: (os.stat(filename).st_mtime, filename))
 
-        for i in range(len(self.un_seq)):
+    @staticmethod
+    def merge(outputdir, timeout=300):
+        folder = os.path.join(outputdir, DatasetFragments.foldername)
+        with DatasetLock(outputdir, timeout):
+            participants = DatasetFragments.pending(folder, 'participants')
+            changes = DatasetFragments.pending(folder, 'changes')
+            if not participants and not changes:
+                # merged by another worker
+                return
 
-            if self.combo1[i].GetValue() == 'Yes':
-                data2conv.append(i)
-                if self.combo2[i].GetValue() == '---':
-                    infomsg = "Sequence Nr " + str(i) + " is selected to convert but BIDS folder is not selected." + \
-                              "\nPlease check your input!"
-                    d = wx.MessageDialog(None, infomsg, "INPUT ERROR!", wx.OK)
-                    d.ShowModal()
-                    d.Destroy()
-                    return
+            # participants.tsv: the row of a fragment replaces the row of the same participant
+            pfilename = os.path.join(outputdir, 'participants.tsv')
+            if participants:
+                if os.path.isfile(pfilename):
+                    with open(pfilename) as f:
+                        lines = [line for line in f.read().splitlines() if line]
                 else:
-                    folder2conv.append(self.combo2[i].GetValue())
-                folderindex.append(i)
-                echo2conv.append(self.un_echo[i])
-
-                try:
-                    task2conv.append(self.task[i].GetValue())
-                except:
-                    task2conv.append('')
-
-                try:
-                    rr = self.run[i].GetValue()
-                    if rr > 10:
-                        run2conv.append(str(rr))
-                    else:
-                        run2conv.append("0"+str(rr))
-                except:
-                    run2conv.append('')
-
-                try:
-                    acq2conv.append(self.acq[i].GetValue())
-                except:
-                    acq2conv.append('')
-
-                try:
-                    rec2conv.append(self.rec[i].GetValue())
-                except:
-                    rec2conv.append('')
-
-                try:
-                    label2conv.append(self.label[i].GetValue())
-                except:
-                    label2conv.append('')
-
-                if self.combo2[i].GetValue() == 'fmap':
-                    if not self.ref[i].GetValue():
-                        # app = wx.App()
-                        msg = "References for fmap (Seq: " + str(self.un_seq[i]) + ") is not specified!"
-                        wx.MessageBox(msg, "Input error!", wx.CANCEL)
-                    else:
-                        try:
-                            a = self.ref[i].GetValue()
-                            a = a.replace(', ', ', ')
-                            a = a.replace(' , ', ', ')
-                            a = a.replace(', ', ' ')
-                            b = a.split()
-                            b = list(map(int, b))
-                            fmapref.append(b)
-                        except:
-                            fmapref.append('')
-
-        folder2conv = [x.encode('UTF8') for x in folder2conv]
-        task2conv = [x.encode('UTF8') for x in task2conv]
-        run2conv = [x.encode('UTF8') for x in run2conv]
-        acq2conv = [x.encode('UTF8') for x in acq2conv]
-        rec2conv = [x.encode('UTF8') for x in rec2conv]
-        label2conv = [x.encode('UTF8') for x in label2conv]
-
-        CheckFilename(folder2conv, self.subjectnumber, self.sessionnumber, task2conv, acq2conv, run2conv, rec2conv,
-                      label2conv)
-
-    def onbutton(self, event):
-        b = event.GetEventObject().GetName()
-
-        data2conv = []
-        folder2conv = []
-        folderindex = []
-        task2conv = []
-        run2conv = []
-        acq2conv = []
-        rec2conv = []
-        label2conv = []
-        echo2conv = []
-        fmapref = []
-        scantime2conv = []
-        maparray = np.empty((len(self.un_seq), 2))
-
-        count = -1
-        for i in range(len(self.un_seq)):
-            maparray[i][0] = i
-            if self.combo1[i].GetValue() == 'Yes':
-                count += 1
-                maparray[i][1] = count
-
-        for i in range(len(self.un_seq)):
-            # maparray[i][0] = i
-            if self.combo1[i].GetValue() == 'Yes':
-                # count += 1
-                # maparray[i][1] = count
-                data2conv.append(i)
-                if self.combo2[i].GetValue() == '---':
-                    infomsg = "Sequence Nr " + str(i) + " is selected to convert but BIDS folder is not selected." + \
-                              "\nPlease check your input!"
-                    d = wx.MessageDialog(None, infomsg, "INPUT ERROR!", wx.OK)
-                    d.ShowModal()
-                    d.Destroy()
-                    return
+                    lines = ["participant_id\tage\tsex"]
+                for filename in participants:
+                    with open(filename) as f:
+                        row = f.read().strip()
+                    subjid = row.split('\t')[0]
+                    lines = lines[:1] + [line for line in lines[1:] if line.split('\t')[0] != subjid] + [row]
+                write_atomic(pfilename, "\r\n".join(lines))
+
+            pjfilename = os.path.join(outputdir, 'participants.json')
+            if not os.path.isfile(pjfilename):
+                paritipant_data = OrderedDict([('age', {'Description': 'age of participant', 'Units': 'years'}),
+                                               ('sex', {'Description': 'sex of participant',
+                                                        "Levels": {"m": "male", "f": "female"}})])
+                write_atomic(pjfilename, json.dumps(paritipant_data, indent=4, sort_keys=False,
+                                                    separators=(',', ': ')))
+
+            # CHANGES: the entries numbered in the order the conversions finished, newest first
+            cfilename = os.path.join(outputdir, 'CHANGES')
+            if changes:
+                if os.path.isfile(cfilename):
+                    with open(cfilename) as f:
+                        text = f.read()
                 else:
-                    folder2conv.append(self.combo2[i].GetValue())
-
-                folderindex.append(i)
-                echo2conv.append(self.un_echo[i])
-
-                try:
-                    task2conv.append(self.task[i].GetValue())
-                except:
-                    task2conv.append('')
-
-                try:
-                    rr = self.run[i].GetValue()
-                    if rr > 10:
-                        run2conv.append(str(rr))
-                    else:
-                        run2conv.append("0"+str(rr))
-                except:
-                    run2conv.append('')
+                    text = "0.01 " + datetime.now().strftime('%Y-%m-%dT%H:%M:%S') + "\n\n\t- Initial release.\n\n"
+                for filename in changes:
+                    with open(filename) as f:
+                        entry = f.read()
+                    text = str(float(text.split()[0]) + 0.01) + " " + entry + text
+                write_atomic(cfilename, text)
 
-                try:
-                    acq2conv.append(self.acq[i].GetValue())
-                except:
-                    acq2conv.append('')
+            for filename in participants + changes:
+                os.remove(filename)
 
-                try:
-                    rec2conv.append(self.rec[i].GetValue())
-                except:
-                    rec2conv.append('')
 
-                try:
-                    label2conv.append(self.label[i].GetValue())
-                except:
-                    label2conv.append('')
+class WorkQueue:
+    # Conversion jobs on a shared file system (NFS, Lustre) for workers on several nodes without a job scheduler.
+    # A job (a subject or a single series of a conversion plan) is a json file that moves by atomic renames between
+    # the folders pending, claimed, done and failed of the queue folder. A worker claims a job by renaming it to
+    # claimed/<job>@<worker> and touches the claim while it converts; claims that were not touched for timeout seconds
+    # are renamed back to pending by the next worker that looks for a job.
+    folders = ('pending', 'claimed', 'done', 'failed')
 
-                if self.combo2[i].GetValue() == 'fmap':
-                    if not self.ref[i].GetValue():
-                        # app = wx.App()
-                        msg = "References for fmap (Seq: " + str(self.un_seq[i]) + ") is not specified!"
-                        wx.MessageBox(msg, "Input error!", wx.CANCEL)
-                    else:
-                        try:
-                            a = self.ref[i].GetValue()
-                            a = a.replace(',  ', ' ')
-                            a = a.replace(' , ', ' ')
-                            a = a.replace(',', ' ')
-                            b = a.split()
-                            b = list(map(int, b))
-                            # get index pif sequence after conver selection
-                            c = b
-                            for i in range(len(b)):
-                                index = np.where(maparray[:, 0] == b[i])
-                                index = np.array(index)
-                                c[i] = int(maparray[index[0][0],1])
-                            fmapref.append(c)
-                        except:
-                            fmapref.append('')
-
-                        d=1
+    def __init__(self, queuedir):
+        self.queuedir = queuedir
+        with open(os.path.join(queuedir, 'queue.json')) as f:
+            self.timeout = json.load(f)['timeout']
+        self.worker = worker_id()
 
-                try:
-                    scantime2conv.append(self.acq_time[i])
-                except:
-                    scantime2conv.append('n/a')
+    @staticmethod
+    def submit(queuedir, plan, perseries=False, timeout=300):
+        # add the subjects of a conversion plan (see plan_study) as jobs; jobs already pending, claimed or done are
+        # kept, failed jobs are queued again
+        for folder in WorkQueue.folders:
+            makedirs(os.path.join(queuedir, folder))
+        if not os.path.exists(os.path.join(queuedir, 'queue.json')):
+            write_atomic(os.path.join(queuedir, 'queue.json'), json.dumps({'timeout': timeout}))
+        queue = WorkQueue(queuedir)
+        known = queue.jobs()
+
+        added = []
+        for name, job in WorkQueue.plan2jobs(plan, perseries):
+            if name in known and known[name] != 'failed':
+                print("Already queued (" + known[name] + "): " + name)
+                continue
+            write_atomic(os.path.join(queuedir, 'pending', name + '.json'), json.dumps(job, indent=2))
+            if known.get(name) == 'failed':
+                os.remove(os.path.join(queuedir, 'failed', name + '.json'))
+            added.append(name)
+        return added
 
-        folder2conv = [x.encode('UTF8') for x in folder2conv]
-        task2conv = [x.encode('UTF8') for x in task2conv]
-        run2conv = [x.encode('UTF8') for x in run2conv]
-        acq2conv = [x.encode('UTF8') for x in acq2conv]
-        rec2conv = [x.encode('UTF8') for x in rec2conv]
-        label2conv = [x.encode('UTF8') for x in label2conv]
+    @staticmethod
+    def plan2jobs(plan, perseries):
+        for subjectplan in plan['subjects']:
+            name = subjectplan['subject'].replace('/', '_')
+            if not perseries:
+                yield name, OrderedDict([('outputdir', plan['outputdir']), ('configfile', plan['configfile']),
+                                         ('subject', subjectplan)])
+                continue
+            for entry in subjectplan['series']:
+                seriesplan = OrderedDict(subjectplan)
+                seriesplan['series'] = [entry]
+                seriesplan['bytes'] = entry['bytes']
+                yield name + '_%03d' % entry['index'], OrderedDict([('outputdir', plan['outputdir']),
+                                                                   ('configfile', plan['configfile']),
+                                                                   ('subject', seriesplan)])
+
+    def jobs(self):
+        # job name -> folder (claimed jobs without the worker)
+        jobs = {}
+        for folder in self.folders:
+            for name in os.listdir(os.path.join(self.queuedir, folder)):
+                if name.startswith('.'):
+                    continue
+                if name.endswith('.json'):
+                    jobs[name[:-5]] = folder
+                elif folder == 'claimed' and '@' in name:
+                    jobs[name.rsplit('@', 1)[0]] = folder
+        return jobs
+
+    def reclaim(self):
+        # give the stale claims of dead or hanging workers back to the pending jobs
+        claimeddir = os.path.join(self.queuedir, 'claimed')
+        now = filesystem_time(claimeddir)
+        for name in os.listdir(claimeddir):
+            claimfile = os.path.join(claimeddir, name)
+            try:
+                age = now - os.stat(claimfile).st_mtime
+            except OSError:
+                continue
+            if age > self.timeout and '@' in name:
+                job, worker = name.rsplit('@', 1)
+                try:
+                    os.rename(claimfile, os.path.join(self.queuedir, 'pending', job + '.json'))
+                    print("Stale claim of " + worker + " (%d s) given back: " % age + job)
+                except OSError:
+                    pass
 
-        self.Close()
+    def claim(self):
+        # (job name, claim file) of the next pending job or None
+        self.reclaim()
+        pendingdir = os.path.join(self.queuedir, 'pending')
+        for name in sorted(os.listdir(pendingdir)):
+            if not name.endswith('.json') or name.startswith('.'):
+                continue
+            job = name[:-5]
+            pendingfile = os.path.join(pendingdir, name)
+            claimfile = os.path.join(self.queuedir, 'claimed', job + '@' + self.worker)
+            try:
+                # fresh mtime before the rename, the claim must not look stale to other workers
+                os.utime(pendingfile, None)
+                os.rename(pendingfile, claimfile)
+            except OSError:
+                # claimed by another worker (a retransmitted NFS rename of this worker fails as well)
+                if not os.path.exists(claimfile):
+                    continue
+            return job, claimfile
+        return None
+
+    def finish(self, job, claimfile, state, message=''):
+        # move the claim to done or failed; False if the claim was lost to another worker
+        target = os.path.join(self.queuedir, state, job)
+        try:
+            os.rename(claimfile, target + '.json')
+        except OSError:
+            return False
+        with open(target + '.log', 'w') as f:
+            f.write(self.worker + " " + datetime.now().strftime('%Y-%m-%dT%H:%M:%S') + "\n" + message)
+        return True
+
+    def unfinished(self):
+        return any(folder in ('pending', 'claimed') for folder in self.jobs().values())
+
+    def status(self):
+        counts = OrderedDict((folder, 0) for folder in self.folders)
+        for folder in self.jobs().values():
+            counts[folder] += 1
+        print(", ".join("%d %s" % (n, folder) for folder, n in counts.items()))
+
+        claimeddir = os.path.join(self.queuedir, 'claimed')
+        now = filesystem_time(claimeddir)
+        for name in sorted(os.listdir(claimeddir)):
+            # claims only (filesystem_time clocks and temp files of the workers are hidden)
+            if name.startswith('.') or '@' not in name:
+                continue
+            try:
+                age = now - os.stat(os.path.join(claimeddir, name)).st_mtime
+            except OSError:
+                continue
+            job, worker = name.rsplit('@', 1)
+            print("  %s: %s, heartbeat %d s ago%s" % (job, worker, age, " (stale)" if age > self.timeout else ""))
+        for name in sorted(os.listdir(os.path.join(self.queuedir, 'failed'))):
+            if name.endswith('.log'):
+                with open(os.path.join(self.queuedir, 'failed', name)) as f:
+                    print("  failed " + name[:-4] + ": " + f.read().replace("\n", " ")[:200])
+        return counts
+
+
+def run_worker(queuedir, cfg=None, maxjobs=None):
+    # convert jobs of the work queue until no job is pending or claimed by another worker (stale claims of dead
+    # workers are taken over)
+    queue = WorkQueue(queuedir)
+    interval = max(1, queue.timeout // 4)
+    nrjobs = 0
+    while maxjobs is None or nrjobs < maxjobs:
+        claim = queue.claim()
+        if claim is None:
+            if not queue.unfinished():
+                break
+            # jobs of other workers in progress, one of them may die
+            time.sleep(interval)
+            continue
+        job, claimfile = claim
+        nrjobs += 1
+        print("\n\n" + queue.worker + " CONVERT JOB " + job)
+
+        # the conversion stops when the heartbeat finds the claim taken over
+        cancelled = threading.Event()
+        heartbeat = Heartbeat(claimfile, interval, cancelled.set)
+        state = 'failed'
+        message = ''
+        try:
+            with open(claimfile) as f:
+                jobdata = json.load(f, object_pairs_hook=OrderedDict)
+            jobcfg = cfg if cfg is not None else load_config(jobdata['configfile'])
+            conv = Convert2BIDS.fromplan(jobdata['subject'], jobdata['outputdir'], jobcfg, cancelled)
+            if conv.state == 'done':
+                state = 'done'
+            else:
+                message = "conversion " + conv.state
+        except Exception:
+            message = traceback.format_exc()
+        heartbeat.stop()
 
-        Convert2BIDS(self.pathdicom, self.subjectnumber, self.subjectgroup, self.sessionnumber, self.subjtext2log,
-                     self.outputdir, self.dcmfiles, folder2conv, folderindex, task2conv, run2conv, acq2conv, rec2conv,
-                     label2conv, fmapref, self.un_seq, self.acq_time, self.patinfo, echo2conv, scantime2conv)
+        if cancelled.is_set():
+            print("Claim lost, job left to the worker that took it over: " + job)
+        elif queue.finish(job, claimfile, state, message):
+            print(job + ": " + state)
+    return nrjobs
 
 
 # ################################################################################################################################
@@ -2029,95 +4558,686 @@ class CheckSeqs(wx.Frame):
 # ################################################################################################################################
 # ################################################################################################################################
 
+class Dcm2niixProcess:
+    # A dcm2niix process of Dcm2niixScheduler.execute. The scheduler reaps it itself (os.wait4, for the peak RSS), its
+    # pid may be reused afterwards: the reaped state is kept here under a lock and kill / running never touch the
+    # Popen object (whose own poll or kill could reap the process or signal a reused pid) where os.wait4 is used.
+    def __init__(self, process):
+        self.process = process
+        self.lock = threading.Lock()
+        self.returncode = None
+
+    def running(self):
+        if not hasattr(os, 'wait4'):
+            return self.process.poll() is None
+        with self.lock:
+            return self.returncode is None
+
+    def kill(self):
+        try:
+            if not hasattr(os, 'wait4'):
+                self.process.kill()
+                return
+            with self.lock:
+                if self.returncode is None:
+                    os.kill(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def reap(self):
+        # waits for the end of the process: return code and resource usage (None without os.wait4)
+        if not hasattr(os, 'wait4'):
+            return self.process.wait(), None
+        while True:
+            with self.lock:
+                pid, status, usage = os.wait4(self.process.pid, os.WNOHANG)
+                if pid != 0:
+                    if os.WIFSIGNALED(status):
+                        self.returncode = -os.WTERMSIG(status)
+                    else:
+                        self.returncode = os.WEXITSTATUS(status)
+                    # reaped: Popen must not wait for this pid again when it is collected (subprocess._cleanup)
+                    self.process.returncode = self.returncode
+                    return self.returncode, usage
+            time.sleep(0.05)
+
+
+class Dcm2niixScheduler:
+    # All dcm2niix processes of this pyBIDSconv session (the sequences of the converted subjects and the background
+    # conversions). The peak memory of a job is estimated from the header of its series; a job is admitted when its
+    # estimate fits into the memory budget next to the running jobs (a job larger than the budget runs alone) and
+    # fewer than maxjobs run (with AdaptiveWorkers: the level of the controller, up to maxjobs). Of the waiting jobs
+    # the largest one that fits starts first (longest processing time first). The peak RSS of every dcm2niix is
+    # measured (os.wait4) and logged next to its estimate.
+
+    condition = threading.Condition()
+    waiting = []
+    running = 0
+    used = 0
+    budget = None
+    maxjobs = None
+    controller = None
+    # dcm2niix holds the dicom data, the NIfTI image and the compressed output at the same time
+    factor = 3
+    overhead = 32 * 1024 * 1024
+
+    @classmethod
+    def configure(cls, cfg):
+        try:
+            maxjobs = cfg.Dcm2niixJobs
+        except AttributeError:
+            maxjobs = 0
+        try:
+            budget = cfg.Dcm2niixMemoryMB
+        except AttributeError:
+            budget = 0
+        with cls.condition:
+            cls.maxjobs = maxjobs or multiprocessing.cpu_count()
+            cls.budget = budget * 1024 * 1024 if budget else physical_memory() // 2
+            if not getattr(cfg, 'AdaptiveWorkers', False):
+                cls.controller = None
+            elif cls.controller is None or cls.controller.maximum != cls.maxjobs:
+                # converted image MB/s decide, measured over at least 10 s
+                cls.controller = AdaptiveConcurrency('dcm2niix', cls.maxjobs, start=min(2, cls.maxjobs), window=10.0,
+                                                     rate='bytes')
+            cls.condition.notify_all()
+
+    @classmethod
+    def estimate(cls, files):
+        # estimated peak memory of the conversion of a series in bytes
+        try:
+            nbytes = series_output_estimate(files)[1]
+        except Exception:
+            # header not readable, size of the files instead
+            nbytes = sum(os.path.getsize(f) for f in files if os.path.isfile(f))
+        return cls.factor * nbytes + cls.overhead
+
+    @classmethod
+    def acquire(cls, estimate, cancelled):
+        # waits until the job is admitted, False if cancelled while waiting
+        if cls.maxjobs is None:
+            cls.configure(None)
+        job = [estimate]
+        with cls.condition:
+            cls.waiting.append(job)
+            while not cancelled.is_set() and not cls.admissible(job):
+                cls.condition.wait(0.5)
+            cls.waiting.remove(job)
+            if not cancelled.is_set():
+                cls.running += 1
+                cls.used += estimate
+                print("dcm2niix started: estimated %d MB (%d running, %d of %d MB)" %
+                      (estimate // 1024 ** 2, cls.running, cls.used // 1024 ** 2, cls.budget // 1024 ** 2))
+            cls.condition.notify_all()
+        return not cancelled.is_set()
+
+    @classmethod
+    def admissible(cls, job):
+        # (condition held)
+        limit = cls.controller.level if cls.controller is not None else cls.maxjobs
+        if cls.running >= limit:
+            return False
+        free = cls.budget - cls.used
+        fitting = [w for w in cls.waiting if cls.running == 0 or w[0] <= free]
+        return len(fitting) > 0 and max(fitting, key=lambda w: w[0]) is job
+
+    @classmethod
+    def release(cls, estimate, nrfiles=0):
+        # nrfiles: number of converted files (0 for failed or cancelled jobs)
+        controller = cls.controller
+        if controller is not None:
+            controller.done(nrfiles, (estimate - cls.overhead) // cls.factor if nrfiles else 0)
+        with cls.condition:
+            cls.running -= 1
+            cls.used -= estimate
+            cls.condition.notify_all()
+
+    @staticmethod
+    def execute(command, started=None):
+        # runs dcm2niix: output, return code and peak RSS of the process in MB (None without os.wait4); started is
+        # called with its Dcm2niixProcess (for cancelling)
+        process = Dcm2niixProcess(subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT))
+        if started is not None:
+            started(process)
+        output = process.process.stdout.read()
+        process.process.stdout.close()
+        returncode, usage = process.reap()
+        peak = None
+        if usage is not None:
+            peak = usage.ru_maxrss / 1024.0
+            if sys.platform == 'darwin':
+                peak = peak / 1024.0
+        return output, returncode, peak
+
+    @staticmethod
+    def report(estimate, peak):
+        if peak is None:
+            return "peak memory estimated %d MB" % (estimate // 1024 ** 2)
+        return "peak memory estimated %d MB, measured %d MB" % (estimate // 1024 ** 2, peak)
+
+
+class StagingRoot:
+    # Staging of the dicom copies and the dcm2niix output (StagingRoot in the config: e.g. /dev/shm or a local NVMe
+    # scratch instead of the subject folder on the output volume). Before a series is staged its space (dicom files
+    # and uncompressed image) is reserved against the free space of the staging file system. The free space already
+    # lacks what the staged series have written, so only the unwritten part of a reservation is subtracted from it.
+    # A reservation ends when the dcm2niix output of its series is complete (not when the series is committed, which
+    # waits for the earlier series); a series that does not fit waits for the running series, and fails when no
+    # other series is running.
+
+    condition = threading.Condition()
+    reservations = {}
+    counter = itertools.count()
+
+    @staticmethod
+    def folder(cfg, subjectfolder, subjectfolderrel):
+        # staging folder of a subject conversion of this process
+        try:
+            stagingroot = cfg.StagingRoot
+        except AttributeError:
+            stagingroot = ''
+        if not stagingroot:
+            return subjectfolder
+        return os.path.join(stagingroot, "pybidsconv_" + subjectfolderrel.replace(os.sep, '_') + "_" + worker_id())
+
+    @staticmethod
+    def freespace(folder):
+        # free bytes of the file system of folder (None where not available)
+        try:
+            st = os.statvfs(folder)
+            return st.f_bavail * st.f_frsize
+        except (AttributeError, OSError):
+            pass
+        try:
+            return shutil.disk_usage(folder).free
+        except (AttributeError, OSError):
+            return None
+
+    @staticmethod
+    def required(files, estimate):
+        # bytes of the dicom copies and the uncompressed image of a series
+        imagebytes = (estimate - Dcm2niixScheduler.overhead) // Dcm2niixScheduler.factor
+        if DicomArchive.separator in files[0]:
+            return 2 * imagebytes
+        return sum(os.path.getsize(f) for f in files) + imagebytes
+
+    @staticmethod
+    def usage(folders):
+        # bytes allocated by the files in folders
+        total = 0
+        for folder in folders:
+            for root, _, files in os.walk(folder):
+                for name in files:
+                    try:
+                        st = os.lstat(os.path.join(root, name))
+                    except OSError:
+                        continue
+                    total += getattr(st, 'st_blocks', 0) * 512 or st.st_size
+        return total
+
+    @classmethod
+    def unwritten(cls):
+        # reserved bytes the running series have not written yet
+        return sum(max(0, nbytes - cls.usage(folders)) for nbytes, folders in cls.reservations.values())
+
+    @classmethod
+    def reserve(cls, folder, nbytes, folders, cancelled):
+        # waits for the space of a series staged in folders; key of the reservation, None if cancelled while waiting
+        with cls.condition:
+            while not cancelled.is_set():
+                free = cls.freespace(folder)
+                if free is None or nbytes <= free - cls.unwritten():
+                    key = next(cls.counter)
+                    cls.reservations[key] = (nbytes, folders)
+                    return key
+                if not cls.reservations:
+                    raise IOError("Not enough space for staging in %s: %d MB needed, %d MB free" %
+                                  (folder, nbytes // 1024 ** 2, free // 1024 ** 2))
+                cls.condition.wait(1.0)
+        return None
+
+    @classmethod
+    def release(cls, key):
+        if key is not None:
+            with cls.condition:
+                cls.reservations.pop(key, None)
+                cls.condition.notify_all()
+
+
+def copy_file_data(fsrc, fdst, size):
+    # copy in the kernel where possible (copy_file_range, sendfile), otherwise through a buffer
+    offset = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < size:
+                n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - offset)
+                if n == 0:
+                    break
+                offset += n
+        except OSError:
+            pass
+    if offset < size and hasattr(os, 'sendfile'):
+        try:
+            while offset < size:
+                n = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, size - offset)
+                if n == 0:
+                    break
+                offset += n
+        except OSError:
+            pass
+    if offset < size:
+        fsrc.seek(offset)
+        fdst.seek(offset)
+        shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+
+
+def commit_file(source, dest):
+    # move a staged file into the BIDS folder: a rename on the same file system, otherwise a copy that is on disk
+    # (fsync) before the staged file is removed
+    try:
+        os.rename(source, dest)
+        return
+    except OSError as ex:
+        if ex.errno != errno.EXDEV:
+            raise
+    with open(source, 'rb') as fsrc:
+        with open(dest, 'wb') as fdst:
+            copy_file_data(fsrc, fdst, os.fstat(fsrc.fileno()).st_size)
+            fdst.flush()
+            os.fsync(fdst.fileno())
+    shutil.copymode(source, dest)
+    os.remove(source)
+
+
+def merge_folder(existing, staged, scansname):
+    # (with DatasetLock) complete a staged subject (session) folder with the files of the existing one: hard links
+    # (copies on file systems without), the staged files replace existing files of the same name; the rows of the
+    # scans.tsv file are merged
+    for root, dirs, files in os.walk(existing):
+        stagedroot = os.path.join(staged, os.path.relpath(root, existing))
+        makedirs(stagedroot)
+        for name in files:
+            source = os.path.join(root, name)
+            dest = os.path.join(stagedroot, name)
+            if root == existing and name == scansname and os.path.exists(dest):
+                merge_scans(source, dest)
+            elif not os.path.exists(dest):
+                try:
+                    os.link(source, dest)
+                except OSError:
+                    shutil.copy2(source, dest)
+
+
+def merge_scans(existing, staged):
+    # rows of an existing scans.tsv file in front of the staged one, the staged row of a file wins
+    with open(staged) as f:
+        stagedlines = f.read().splitlines()
+    with open(existing) as f:
+        lines = f.read().splitlines()
+    newfiles = set(line.split('\t')[0] for line in stagedlines[1:])
+    rows = [line for line in lines[1:] if line and line.split('\t')[0] not in newfiles] + stagedlines[1:]
+    write_atomic(staged, "\n".join(lines[:1] + rows))
+
+
+def exchange_folders(source, dest):
+    # swap two folders with one rename (renameat2 with RENAME_EXCHANGE, Linux 3.15 and glibc 2.28); False where the
+    # system or the file system cannot
+    if ctypes is None or not sys.platform.startswith('linux'):
+        return False
+    try:
+        renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    except (AttributeError, OSError):
+        return False
+    atfdcwd, exchange = -100, 2
+    source, dest = [p if isinstance(p, bytes) else p.encode(sys.getfilesystemencoding()) for p in (source, dest)]
+    if renameat2(atfdcwd, source, atfdcwd, dest, exchange) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.EINVAL, errno.ENOSYS, errno.EPERM):
+        return False
+    raise OSError(err, os.strerror(err), dest)
+
+
+def fsync_folder(folder):
+    # make the new directory entries durable (not possible on Windows)
+    try:
+        fd = os.open(folder, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    os.close(fd)
+
+
+class SpeculativeConversion:
+    # Background dcm2niix conversion of the sequences whose BIDS folder and label are already decided (anat, dwi)
+    # while CheckSeqs is open. Every sequence is copied and converted in its own staging folder, at most maxjobs
+    # conversions run at the same time. A sequence whose decision changes is discarded (a running dcm2niix is killed).
+    # Convert2BIDS takes the finished NIfTI files and only renames them and adds the sidecar information.
+
+    options = ['-b', 'y', '-ba', 'y', '-z', 'i', '-f', '%s']
+
+    def __init__(self, dcmfiles, maxjobs=2, readorder='', stagingroot=None):
+        self.dcmfiles = dcmfiles
+        self.maxjobs = maxjobs
+        self.readorder = readorder
+        self.stagingroot = tempfile.mkdtemp(prefix='pybidsconv_speculative_', dir=stagingroot or None)
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.pending = []
+        atexit.register(self.close)
+
+    def update(self, wanted):
+        # wanted: {sequence index: decision the output depends on}; discards changed and starts new conversions
+        with self.lock:
+            for index in list(self.jobs):
+                if self.jobs[index]['key'] != wanted.get(index):
+                    self.discardjob(index)
+            for index in sorted(wanted):
+                if index not in self.jobs:
+                    self.jobs[index] = {'key': wanted[index], 'state': 'pending', 'process': None,
+                                        'cancelled': threading.Event(), 'done': threading.Event(),
+                                        'folder': tempfile.mkdtemp(dir=self.stagingroot)}
+                    self.pending.append(index)
+            self.startpending()
+
+    def startpending(self):
+        # (lock held)
+        running = len([job for job in self.jobs.values() if job['state'] == 'running'])
+        while self.pending and running < self.maxjobs:
+            index = self.pending.pop(0)
+            job = self.jobs[index]
+            job['state'] = 'running'
+            thread = threading.Thread(target=self.runjob, args=(index, job))
+            thread.daemon = True
+            thread.start()
+            running += 1
+
+    def runjob(self, index, job):
+        inputfolder = os.path.join(job['folder'], 'dcm')
+        outputfolder = os.path.join(job['folder'], 'nii')
+        ok = False
+        files = self.dcmfiles[index]
+        estimate = Dcm2niixScheduler.estimate(files)
+        if Dcm2niixScheduler.acquire(estimate, job['cancelled']):
+            try:
+                os.makedirs(inputfolder)
+                os.makedirs(outputfolder)
+                if DicomArchive.separator in files[0]:
+                    DicomArchive.extract(files, inputfolder)
+                else:
+                    for _, dcmfile in DicomIOScheduler(files, self.readorder):
+                        if job['cancelled'].is_set():
+                            break
+                        shutil.copy2(dcmfile, inputfolder)
+
+                command = ['dcm2niix'] + self.options + ['-o', outputfolder, inputfolder]
+                job['command'] = ' '.join(command)
+                if not job['cancelled'].is_set():
+                    job['output'], returncode, peak = Dcm2niixScheduler.execute(
+                        command, lambda process: self.started(job, process))
+                    job['memory'] = Dcm2niixScheduler.report(estimate, peak)
+                    ok = returncode == 0 and not job['cancelled'].is_set()
+            except (IOError, OSError) as ex:
+                print("Background conversion of sequence " + str(index) + " failed: " + str(ex))
+            Dcm2niixScheduler.release(estimate, len(files) if ok else 0)
+
+        with self.lock:
+            job['state'] = 'done' if ok else 'failed'
+            if job['cancelled'].is_set():
+                shutil.rmtree(job['folder'], ignore_errors=True)
+            else:
+                shutil.rmtree(inputfolder, ignore_errors=True)
+            job['done'].set()
+            self.startpending()
+
+    def started(self, job, process):
+        with self.lock:
+            job['process'] = process
+            if job['cancelled'].is_set():
+                process.kill()
+
+    def discardjob(self, index):
+        # (lock held)
+        job = self.jobs.pop(index)
+        job['cancelled'].set()
+        if index in self.pending:
+            self.pending.remove(index)
+            job['state'] = 'failed'
+            job['done'].set()
+        if job['process'] is not None and job['process'].running():
+            job['process'].kill()
+        if job['state'] != 'running':
+            shutil.rmtree(job['folder'], ignore_errors=True)
+
+    def finish(self):
+        # no new conversions after the decisions are final, running ones are kept
+        with self.lock:
+            for index in list(self.pending):
+                self.discardjob(index)
+
+    def take(self, index):
+        # folder with the dcm2niix output of a sequence, the command and its memory use (waits for a running
+        # conversion) or None
+        with self.lock:
+            job = self.jobs.get(index)
+        if job is None:
+            return None
+        job['done'].wait()
+        if job['state'] != 'done':
+            return None
+        return os.path.join(job['folder'], 'nii'), job['command'], job.get('memory', '')
+
+    def has(self, index):
+        with self.lock:
+            return index in self.jobs
+
+    def close(self):
+        with self.lock:
+            for index in list(self.jobs):
+                self.discardjob(index)
+        shutil.rmtree(self.stagingroot, ignore_errors=True)
+
+
+class ConversionQueue:
+    # All conversions of this pyBIDSconv session. At most maxjobs (ConversionSlots in the config) convert at the same
+    # time, the others wait in order for a free slot. Listeners (the subject queue window) are called on the main
+    # thread after every change. quiet: no final dialog per subject.
+
+    condition = threading.Condition()
+    jobs = []
+    listeners = []
+    maxjobs = 2
+    quiet = False
+
+    @classmethod
+    def add(cls, subject, maxjobs=None):
+        with cls.condition:
+            if maxjobs:
+                cls.maxjobs = maxjobs
+            job = {'subject': subject, 'state': 'waiting'}
+            cls.jobs.append(job)
+        cls.notify()
+        return job
+
+    @classmethod
+    def acquire(cls, job, cancelled):
+        # waits for a free slot, False if cancelled while waiting
+        with cls.condition:
+            while not cancelled.is_set():
+                running = len([j for j in cls.jobs if j['state'] == 'converting'])
+                waiting = [j for j in cls.jobs if j['state'] == 'waiting']
+                if running < cls.maxjobs and waiting[0] is job:
+                    break
+                cls.condition.wait(0.5)
+            if cancelled.is_set():
+                job['state'] = 'cancelled'
+            else:
+                job['state'] = 'converting'
+            cls.condition.notify_all()
+        cls.notify()
+        return job['state'] == 'converting'
+
+    @classmethod
+    def release(cls, job, state):
+        with cls.condition:
+            job['state'] = state
+            cls.condition.notify_all()
+        cls.notify()
+
+    @classmethod
+    def notify(cls):
+        for listener in list(cls.listeners):
+            wx.CallAfter(listener)
+
+
+class ConversionStatus(wx.Frame):
+    # Status of the sequences of a running conversion (state and elapsed time) with a cancel button
+
+    def __init__(self, subject, sequences, folders, oncancel):
+        wx.Frame.__init__(self, None, size=(600, min(150 + 25 * len(sequences), 700)))
+        self.SetTitle('pyBIDSconv - Conversion ' + subject)
+        self.oncancel = oncancel
+        self.states = ['queued'] * len(sequences)
+        self.starttimes = [None] * len(sequences)
+        self.endtimes = [None] * len(sequences)
+
+        panel = wx.Panel(self)
+        self.table = wx.ListCtrl(panel, style=wx.LC_REPORT)
+        for col, (label, width) in enumerate([('Nr', 40), ('Sequence', 240), ('Folder', 70), ('Status', 100),
+                                              ('Time', 80)]):
+            self.table.InsertColumn(col, label, width=width)
+        for i in range(len(sequences)):
+            self.table.InsertItem(i, str(i))
+            self.table.SetItem(i, 1, sequences[i])
+            self.table.SetItem(i, 2, folders[i])
+            self.table.SetItem(i, 3, 'queued')
+
+        self.button = wx.Button(panel, -1, "Cancel")
+        self.button.Bind(wx.EVT_BUTTON, self.onbutton)
+
+        sizer = wx.BoxSizer(wx.VERTICAL)
+        sizer.Add(self.table, 1, wx.EXPAND | wx.ALL, 5)
+        sizer.Add(self.button, 0, wx.ALIGN_RIGHT | wx.ALL, 5)
+        panel.SetSizer(sizer)
+
+        self.Bind(wx.EVT_CLOSE, self.onclosewindow)
+        self.timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.ontimer, self.timer)
+        self.timer.Start(1000)
+        self.finished = False
+        self.Show(True)
+
+    def setstate(self, i, state):
+        if state in ['staging', 'converting', 'renaming'] and self.starttimes[i] is None:
+            self.starttimes[i] = time.time()
+        if state in ['done', 'failed', 'cancelled'] and self.starttimes[i] is not None:
+            self.endtimes[i] = time.time()
+        self.states[i] = state
+        self.table.SetItem(i, 3, state)
+        if state == 'failed':
+            self.table.SetItemTextColour(i, wx.RED)
+        self.ontimer(None)
+
+    def ontimer(self, _):
+        for i in range(len(self.states)):
+            if self.starttimes[i] is not None:
+                end = self.endtimes[i] if self.endtimes[i] is not None else time.time()
+                self.table.SetItem(i, 4, "%.0f s" % (end - self.starttimes[i]))
+
+    def setfinished(self):
+        self.finished = True
+        self.timer.Stop()
+        self.button.SetLabel("Close")
+
+    def onbutton(self, _):
+        if self.finished:
+            self.Close()
+            return
+        self.button.Disable()
+        self.button.SetLabel("Cancelling ...")
+        self.oncancel()
+
+    def onclosewindow(self, event):
+        if not self.finished:
+            # keep the window until the conversion is stopped
+            self.onbutton(None)
+            return
+        self.timer.Stop()
+        self.Destroy()
+
+
 class Convert2BIDS:
+    # hidden folder of the dataset with the subject (session) folders in conversion
+    transactions = ".pybidsconv_staging"
+
     def __init__(self, pathdicom, subjectnumber, subjectgroup, sessionnumber, subjtext2log, outputdir, dcmfiles, 
                  folder2conv, folderindex, task2conv, run2conv, acq2conv, rec2conv, label2conv, fmapref, seqlabel2conv, 
-                 acq_time, patinfo, echo2conv, scantime2conv):
+                 acq_time, patinfo, echo2conv, scantime2conv, cfg=None, speculative=None, sidecars=None,
+                 cancelled=None):
 
-        # create subject number
-        if int(float(subjectnumber)) > 99:
-            subjnum = str(subjectnumber)
-        else:
-            if int(float(subjectnumber)) > 9:
-                subjnum = "0" + str(subjectnumber)
-            else:
-                subjnum = "00" + str(subjectnumber)
+        # done, incomplete or cancelled after the conversion, stopped by the checks of the input
+        self.state = 'stopped'
 
-        # Check BIDS labels
-        # -------------------------------------
-        validBIDSlabels =["FLAIR", "FLASH", "T1w", "T2w", "T1rho", "T1map", "T2map", "T2star", "PD", "PDmap",
-                          "PDT2", "inplaneT1", "inplaneT2", "angio", "defacemask", "bold", "sbref",
-                          "asl", "dwi", "fieldmap", "magnitude", "magnitude1", "magnitude2", "phasediff",
-                          "phase1", "phase2","epi'"]
-
-        for ii in range(len(folder2conv)):
-            c = [i for i, item in enumerate(validBIDSlabels) if label2conv[ii] in item]
-            if not c:
-                # oo = wx.App()
-                infomsg = "The specified label " + label2conv[ii] + " seems not to be a valid BIDS label." + \
-                          "\nPlease check your input!\nPress YES to go further or NO to stop the conversion"
-                d = wx.MessageDialog( None, infomsg, "IMPORTANT!", wx.YES_NO)
-                answer = d.ShowModal()
+        try:
+            readorder = cfg.DicomReadOrder
+        except AttributeError:
+            readorder = ''
 
-                if (answer == wx.ID_NO):
-                    return
+        # heartbeat timeout of the lock of the dataset level files
+        try:
+            locktimeout = cfg.QueueTimeout
+        except AttributeError:
+            locktimeout = 300
+
+        Dcm2niixScheduler.configure(cfg)
 
-        # Check new filenames for duplicates
+        subjnum = bids_subjnum(subjectnumber, subjectgroup)
+
+        # output filenames
         # -------------------------------------
-        nf_list = []
-        fmap_list = []
-        for ii in range(len(folder2conv)):
-            # create new filenames
-            sub1 = "sub-" + subjnum
-
-            if sessionnumber == "":
-                sess1 = ""
-            else:
-                sess1 = "_ses-" + str(sessionnumber)
-
-            if task2conv[ii] == "":
-                if folder2conv == "func":
-                    # oo = wx.App()
-                    infomsg = "Conversion stopped!\nA task name needs to be specified for each functional session." + \
-                              "\n Taskname missing for sequence " + str(ii)
-                    d = wx.MessageDialog( None, infomsg, "INPUT ERROR!", wx.OK)
-                    d.ShowModal()
-                    d.Destroy()
-                    return
-                else:
-                    task1 = ""
-            else:
-                task2conv[ii] = re.sub(" ", "", task2conv[ii])
-                task1 = "_task-" + task2conv[ii]
+        task2conv = [re.sub(" ", "", x) for x in task2conv]
+        plan = BIDSPlan(subjnum, sessionnumber, folder2conv, task2conv, acq2conv, run2conv, rec2conv, label2conv)
 
-            if acq2conv[ii] == "":
-                acq1 = ""
-            else:
-                acq1 = "_acq-" + acq2conv[ii]
+        # Check BIDS labels
+        # -------------------------------------
+        for ii in plan.invalidlabels():
+            # oo = wx.App()
+            infomsg = "The specified label " + label2conv[ii] + " seems not to be a valid BIDS label." + \
+                      "\nPlease check your input!\nPress YES to go further or NO to stop the conversion"
+            answer = self.showdialog(infomsg, "IMPORTANT!", wx.YES_NO)
 
-            if run2conv[ii] == "":
-                run1 = ""
-            else:
-                run1 = "_run-" + run2conv[ii]
+            if (answer == wx.ID_NO):
+                return
 
-            if rec2conv[ii] == "":
-                rec1 = ""
-            else:
-                rec1 = "_rec-" + rec2conv[ii]
+        for ii in plan.invalidvalues():
+            infomsg = "The entities of " + plan.path(ii) + " contain characters other than letters and digits." + \
+                      "\nPlease check your input!\nPress YES to go further or NO to stop the conversion"
+            answer = self.showdialog(infomsg, "IMPORTANT!", wx.YES_NO)
+
+            if (answer == wx.ID_NO):
+                return
 
-            nf_list.append(sub1 + sess1 + task1 + acq1 + run1 + rec1 + "_" + label2conv[ii])
-            fmap_list.append(folder2conv[ii] + "/" + sub1 + sess1 + task1 + acq1 + run1 + rec1 + "_" + label2conv[ii] + ".nii.gz")
+        # Check new filenames for missing task names and duplicates
+        # -------------------------------------
+        missing = plan.missingtasks()
+        if missing:
+            # oo = wx.App()
+            infomsg = "Conversion stopped!\nA task name needs to be specified for each functional session." + \
+                      "\n Taskname missing for sequence " + str(missing[0])
+            self.showdialog(infomsg, "INPUT ERROR!", wx.OK)
+            return
 
-        dup = [x for n, x in enumerate(nf_list) if x in nf_list[:n]]
+        dup = list(plan.duplicates().keys())
         if len(dup) > 0:
             dialogtext = "Conversion stopped, because input leads to duplicate filenames! :\n"
             for ii in range(len(dup)):
                 dialogtext = dialogtext + dup[ii] + "\n"
 
             # oo = wx.App()
-            d = wx.MessageDialog(
-                None, dialogtext, "IMPORTANT", wx.OK)
-            d.ShowModal()
+            self.showdialog(dialogtext, "IMPORTANT", wx.OK)
             return
         else:
             print "\n\nFilenames checked"
@@ -2125,10 +5245,6 @@ class Convert2BIDS:
         # Create subfolders
         # ----------------------------
         subfolderlist = list(set(folder2conv))
-        # subjrawnum = subjnum
-
-        if subjectgroup:
-            subjnum = subjectgroup + subjnum
 
         # Check output folder (add subj folder and subfolders)
         if sessionnumber == "":
@@ -2140,8 +5256,23 @@ class Convert2BIDS:
             subjectfolderrel = os.path.join("sub-" + subjnum, "ses-" + str(sessionnumber))
             # subjid4out = "Subject: " + subjnum, "Session: " + str(sessionnumber)
 
-        tempfolder1 = os.path.join(subjectfolder, "temp")
-        tempfolder2 = os.path.join(subjectfolder, "temp2")
+        # the subject (session) folder is built in a hidden transaction folder of the dataset and published with one
+        # rename when it is complete (see publish), readers of the dataset never see a half converted subject
+        targetfolder = subjectfolder
+        Convert2BIDS.recover(outputdir, locktimeout)
+        transaction = os.path.join(outputdir, Convert2BIDS.transactions,
+                                   subjectfolderrel.replace(os.sep, '_') + "_" + worker_id())
+        shutil.rmtree(transaction, ignore_errors=True)
+        subjectfolder = os.path.join(transaction, subjectfolderrel)
+        makedirs(subjectfolder)
+        with open(os.path.join(transaction, "target"), 'w') as f:
+            f.write(subjectfolderrel)
+
+        # own temp folders of this process (other workers may convert series of the same subject), in the subject
+        # folder or in the staging root of the config
+        stagingfolder = StagingRoot.folder(cfg, subjectfolder, subjectfolderrel)
+        tempfolder1 = os.path.join(stagingfolder, "temp_" + worker_id())
+        tempfolder2 = os.path.join(stagingfolder, "temp2_" + worker_id())
 
         try:
             shutil.rmtree(tempfolder1)
@@ -2153,26 +5284,10 @@ class Convert2BIDS:
         except:
             pass
 
-        subjexist = os.path.exists(subjectfolder)
-        if not subjexist:
-            os.makedirs(subjectfolder)
-            # os.makedirs(tempfolder1)
-            # os.makedirs(tempfolder2)
-            for ss in range(len(subfolderlist)):
-                os.makedirs(os.path.join(subjectfolder, subfolderlist[ss]))
-        else:
-            # if not os.path.exists(tempfolder1):
-            # os.makedirs(tempfolder1)
-            # if not os.path.exists(tempfolder2):
-            # os.makedirs(tempfolder2)
-            for ss in range(len(subfolderlist)):
-                if not os.path.exists(os.path.join(subjectfolder, subfolderlist[ss])):
-                    os.makedirs(os.path.join(subjectfolder, subfolderlist[ss]))
-
-        logfolder = os.path.join(outputdir, "pyBIDSconv_logs")
-        logfolderexist = os.path.exists(logfolder)
-        if not logfolderexist:
-            os.makedirs(logfolder)
+        for ss in range(len(subfolderlist)):
+            makedirs(os.path.join(subjectfolder, subfolderlist[ss]))
+
+        logfolder = DatasetFragments.folder(outputdir)
 
         # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         # procedure existing folder missing
@@ -2183,34 +5298,19 @@ class Convert2BIDS:
         strg = t.strftime('%B_%d_%Y_%H_%M')
         strg2 = t.strftime('%Y-%m-%dT%H:%M:%S')
 
-        # Check / create CHANGE file
-        # -----------------------------------------
-        cfilename = os.path.join(outputdir, "CHANGES")
-        cexist = os.path.exists(cfilename)
-        if not cexist:
-            cfile = open(cfilename, "w")
-            cfile.write("0.01 "+ strg2 + "\n\n\t- Initial release.\n\n")
-            cfile.close()
-            changenumber = 0.02
-        else:
-            infile = open(cfilename, 'r')
-            firstline = infile.readline()
-            x = firstline.split()
-            changenumber = float(x[0]) + 0.01
-
-        # start log file
+        # start log file (the CHANGES entry of the conversion, see DatasetFragments)
         # -----------------------------------------
         if sessionnumber == "":
-            logfilename = os.path.join(logfolder, "log_pyBIDSconv_sub-" + subjnum + "_" + strg + ".txt")
+            fragment = "sub-" + subjnum + "_" + strg + "_" + worker_id()
             scantsvfilename = os.path.join(subjectfolder, "sub-" + subjnum + "_scans.tsv")
         else:
-            logfilename = os.path.join(logfolder, "log_pyBIDSconv_sub-" + subjnum + "_ses-" + str(sessionnumber) +
-                                       "_" + strg + ".txt")
+            fragment = "sub-" + subjnum + "_ses-" + str(sessionnumber) + "_" + strg + "_" + worker_id()
             scantsvfilename = os.path.join(subjectfolder, "sub-" + subjnum + "_ses-" + str(sessionnumber) + "_scans.tsv")
+        logfilename = os.path.join(logfolder, fragment + ".log")
         logfile = open(logfilename, "w")
 
-        # add first line
-        logfile.write(str(changenumber) + " " + strg2 + "\n\n")
+        # add first line (numbered when merged into CHANGES)
+        logfile.write(strg2 + "\n\n")
 
         # add deletion of subject
         if not subjtext2log == "":
@@ -2224,27 +5324,28 @@ class Convert2BIDS:
             logfile.write("\t- ADD sub-" + subjnum + " ses-" + str(sessionnumber) + " to the BIDS directory: " + outputdir +
                           " (by pyBIDSconv version " + ver + " : \n\n")
 
-        # Check if scan tsv file exist otherwise start it
-        # -------------------------------------------------
-        scantsvexistexist = os.path.exists(scantsvfilename)
-        if not scantsvexistexist:
-            scantsvfile = open(scantsvfilename, "w")
-            scantsvfile.write("filename\tacq_time")
-
         # Check existance / Create dataset_description.json file
         # -----------------------------------------
         # app = wx.App()
         dsfile = "dataset_description.json"
         dsfilename = os.path.join(outputdir, dsfile)
         dsexist = os.path.exists(dsfilename)
-        if not dsexist:
+        if not dsexist and wx.GetApp() is None:
+            # command line and work queue: other workers may create it at the same time
+            pathx, defname = os.path.split(outputdir)
+            with DatasetLock(outputdir, locktimeout):
+                if not os.path.exists(dsfilename):
+                    logfile.write("\t- Create dataset_description.json file in: " + outputdir + "\n\n")
+                    write_atomic(dsfilename, json.dumps(OrderedDict([("Name", defname), ("BIDSVersion", bidsver)]),
+                                                        indent=4, separators=(', ', ': ')))
+        elif not dsexist:
 
             logfile.write("\t- Create dataset_description.json file in: " + outputdir + "\n\n")
 
             pathx, defname = os.path.split(outputdir)
             # Empty dict
             d = {}
-            dialog = wx.TextEntryDialog(None, "Name of the dataset:", 
+            dialog = wx.TextEntryDialog(None, "Name of the dataset:",
                                         "Input Name of Dataset for dataset_description.json file", defname)
             if dialog.ShowModal() == wx.ID_OK:
                 dataname = dialog.GetValue()
@@ -2253,62 +5354,435 @@ class Convert2BIDS:
                     None, "Conversion stopped!",
                     "IMPORTANT", wx.OK)
                 d.ShowModal()
+                logfile.close()
+                os.remove(logfilename)
+                shutil.rmtree(transaction, ignore_errors=True)
                 return
 
             d["Name"] = dataname
             d["BIDSVersion"] = bidsver
 
-            # write json file
-            with open(dsfilename, 'w') as f:
-                f.write(json.dumps(d, indent=4, separators=(', ', ': ')))
+            # write json file, unless another conversion created it meanwhile
+            with DatasetLock(outputdir, locktimeout):
+                if not os.path.exists(dsfilename):
+                    write_atomic(dsfilename, json.dumps(d, indent=4, separators=(', ', ': ')))
+
+        # convert in a worker thread, the status window shows the progress of each sequence
+        # ------------------------------------------------------------------------------------
+        self.dcmfiles = dcmfiles
+        self.echo2conv = echo2conv
+        self.fragment = fragment
+        self.plan = plan
+        if sidecars is None:
+            sidecars = plan.sidecars(fmapref, echo2conv)
+        self.sidecars = sidecars
+        self.fmapref = fmapref
+        self.folder2conv = folder2conv
+        self.folderindex = folderindex
+        self.label2conv = label2conv
+        self.logfile = logfile
+        self.logfilename = logfilename
+        self.locktimeout = locktimeout
+        self.logfolder = logfolder
+        self.outputdir = outputdir
+        self.pathdicom = pathdicom
+        self.patinfo = patinfo
+        self.readorder = readorder
+        self.scantime2conv = scantime2conv
+        self.scantsvfilename = scantsvfilename
+        self.seqlabel2conv = seqlabel2conv
+        self.sessionnumber = sessionnumber
+        self.speculative = speculative
+        self.stagingfolder = stagingfolder
+        self.subjectfolder = subjectfolder
+        self.subjectfolderrel = subjectfolderrel
+        self.subjnum = subjnum
+        self.targetfolder = targetfolder
+        self.tempfolder1 = tempfolder1
+        self.tempfolder2 = tempfolder2
+        self.transaction = transaction
+
+        if cancelled is None:
+            cancelled = threading.Event()
+        self.cancelled = cancelled
+        self.jobs = {}
+        self.processes = []
+        self.created = []
+        self.current = None
+        self.status = None
+        if wx.GetApp() is None:
+            try:
+                self.run()
+            except Exception:
+                self.abort()
+                raise
+        else:
+            self.status = ConversionStatus("sub-" + subjnum, [seqlabel2conv[i] for i in folderindex], folder2conv,
+                                           self.cancel)
+            try:
+                slots = cfg.ConversionSlots
+            except AttributeError:
+                slots = 2
+            self.job = ConversionQueue.add(subjectfolderrel, slots)
+            thread = threading.Thread(target=self.worker)
+            thread.daemon = True
+            thread.start()
+
+    @staticmethod
+    def fromplan(subjectplan, outputdir, cfg=None, cancelled=None):
+        # convert a subject of a conversion plan (see plan_subject), or some of its series (see WorkQueue)
+        series = subjectplan['series']
+        entities = [s['entities'] for s in series]
+        return Convert2BIDS(subjectplan['pathdicom'], subjectplan['subjectnumber'], subjectplan['subjectgroup'],
+                            subjectplan['session'], "\t- Converted from conversion plan\n\n", outputdir,
+                            [s['files'] for s in series], [str(s['folder']) for s in series], list(range(len(series))),
+                            [str(e['task']) for e in entities], [str(e['run']) for e in entities],
+                            [str(e['acq']) for e in entities], [str(e['rec']) for e in entities],
+                            [str(s['label']) for s in series], [s['ref'] for s in series if s['folder'] == 'fmap'],
+                            [s['description'] for s in series], [s['acq_time'] for s in series],
+                            subjectplan['patinfo'], [s['echo_times'] for s in series],
+                            [s['acq_time'] for s in series], cfg=cfg,
+                            sidecars=[OrderedDict(s['sidecar']) for s in series], cancelled=cancelled)
+
+    def worker(self):
+        # wait for a free conversion slot
+        if not ConversionQueue.acquire(self.job, self.cancelled):
+            for ii in range(len(self.folder2conv)):
+                self.setstatus(ii, 'cancelled')
+            self.logfile.close()
+            self.discard()
+            wx.CallAfter(self.status.setfinished)
+            return
+
+        state = 'done'
+        try:
+            self.run()
+        except Exception as ex:
+            # roll back the sequence in progress
+            self.setstatus(None, 'failed')
+            self.abort()
+            state = 'failed'
+            wx.CallAfter(self.showdialog, "Conversion failed:\n" + str(ex), "IMPORTANT", wx.OK)
+        if self.cancelled.is_set() and state == 'done':
+            state = 'cancelled'
+        ConversionQueue.release(self.job, state)
+        wx.CallAfter(self.status.setfinished)
+
+    def setstatus(self, ii, state):
+        # ii None: sequence in progress
+        if ii is None:
+            ii = self.current
+        if self.status is not None and ii is not None:
+            wx.CallAfter(self.status.setstate, ii, state)
+
+    def showdialog(self, message, caption, style):
+        # modal message dialog on the main thread (waits for the answer if called from the worker); without wx app
+        # (command line) the message is printed and answered with YES/OK
+        if wx.GetApp() is None:
+            print(caption + " " + message)
+            if style & wx.YES_NO:
+                return wx.ID_YES
+            return wx.ID_OK
+        if wx.IsMainThread():
+            d = wx.MessageDialog(None, message, caption, style)
+            answer = d.ShowModal()
+            d.Destroy()
+            return answer
+
+        result = {}
+        done = threading.Event()
+
+        def show():
+            result['answer'] = self.showdialog(message, caption, style)
+            done.set()
+
+        wx.CallAfter(show)
+        done.wait()
+        return result['answer']
+
+    def cancel(self):
+        # stop after killing the running dcm2niix processes, the partial sequence is rolled back
+        self.cancelled.set()
+        for process in list(self.processes):
+            if process.running():
+                process.kill()
+        if self.speculative is not None:
+            self.speculative.close()
+
+    def startseries(self, ii):
+        # convert a sequence in its own thread as soon as the dcm2niix scheduler admits it
+        job = {'done': threading.Event()}
+        thread = threading.Thread(target=self.convertseries, args=(ii, job))
+        thread.daemon = True
+        thread.start()
+        return job
+
+    def convertseries(self, ii, job):
+        # copy the dicom files of a sequence to its temp folder and convert them to nii in its temp2 folder
+        tempfolder1 = os.path.join(self.tempfolder1, str(ii))
+        tempfolder2 = os.path.join(self.tempfolder2, str(ii))
+        files = self.dcmfiles[self.folderindex[ii]]
+        try:
+            estimate = Dcm2niixScheduler.estimate(files)
+            if not Dcm2niixScheduler.acquire(estimate, self.cancelled):
+                return
+            nrfiles = 0
+            reservation = None
+            try:
+                # space in the staging folder, released when the dcm2niix output is complete
+                makedirs(self.stagingfolder)
+                required = StagingRoot.required(files, estimate)
+                reservation = StagingRoot.reserve(self.stagingfolder, required, [tempfolder1, tempfolder2],
+                                                  self.cancelled)
+                if reservation is None:
+                    return
+
+                self.setstatus(ii, 'staging')
+                os.makedirs(tempfolder1)
+                os.makedirs(tempfolder2)
+
+                # copy file to tempfolder1
+                print "\n\nCOPY FILES " + self.seqlabel2conv[self.folderindex[ii]] + "\n"
+                if DicomArchive.separator in files[0]:
+                    # extract only the members of this series from the archive
+                    DicomArchive.extract(files, tempfolder1)
+                else:
+                    for _, dcmfile in DicomIOScheduler(files, self.readorder):
+                        if self.cancelled.is_set():
+                            break
+                        shutil.copy2(dcmfile, tempfolder1)
+
+                # convert dcm in temfolder1 to nii in tempfolder2
+                self.setstatus(ii, 'converting')
+                # options = "-b y -ba y -z y -f %s"
+                options = "-b y -ba y -z i -f %s"
+                commandstr = "dcm2niix {} -o {} {}"
+                job['command'] = commandstr.format(options, tempfolder2, tempfolder1)
+                if not self.cancelled.is_set():
+                    output, job['returncode'], peak = Dcm2niixScheduler.execute(
+                        ['dcm2niix'] + options.split() + ['-o', tempfolder2, tempfolder1], self.processes.append)
+                    print "CONVERT DICOM TO NIFTI \n" + job['command'] + "\n" + output
+                    job['memory'] = Dcm2niixScheduler.report(estimate, peak)
+                    job['estimate'] = estimate
+                    job['peak'] = peak
+                    print(self.seqlabel2conv[self.folderindex[ii]] + ": " + job['memory'])
+                    if job['returncode'] == 0:
+                        nrfiles = len(files)
+            finally:
+                StagingRoot.release(reservation)
+                Dcm2niixScheduler.release(estimate, nrfiles)
+        except (IOError, OSError) as ex:
+            job['error'] = str(ex)
+        finally:
+            job['done'].set()
+
+    def appendscans(self, lines):
+        # rows of a converted sequence in the scans.tsv file of the transaction folder
+        if os.path.exists(self.scantsvfilename):
+            scantsvfile = open(self.scantsvfilename, "a")
+        else:
+            scantsvfile = open(self.scantsvfilename, "w")
+            scantsvfile.write("filename\tacq_time")
+        for line in lines:
+            scantsvfile.write(line)
+        scantsvfile.close()
+
+    def writereport(self, jobs, started):
+        # run report (code/pyBIDSconv_reports in the BIDS folder): number of header readers and dcm2niix processes
+        # chosen at runtime with the measurements behind them, estimated and measured memory of each sequence
+        sequences = []
+        for ii in range(len(self.folder2conv)):
+            job = jobs.get(ii, {})
+            sequences.append(OrderedDict([('sequence', self.seqlabel2conv[self.folderindex[ii]]),
+                                          ('folder', self.folder2conv[ii]),
+                                          ('files', len(self.dcmfiles[self.folderindex[ii]])),
+                                          ('background', ii not in jobs),
+                                          ('estimated_mb', job['estimate'] // 1024 ** 2 if 'estimate' in job else None),
+                                          ('peak_mb', round(job['peak']) if job.get('peak') is not None else None)]))
+        controller = Dcm2niixScheduler.controller
+        report = OrderedDict([('subject', self.subjectfolderrel.replace('\\', '/')), ('pathdicom', self.pathdicom),
+                              ('started', datetime.fromtimestamp(started).strftime('%Y-%m-%dT%H:%M:%S')),
+                              ('seconds', round(time.time() - started, 1)), ('state', self.state),
+                              ('scan', AdaptiveConcurrency.scanreports.get(self.pathdicom)),
+                              ('dcm2niix', controller.report(started)), ('sequences', sequences)])
+
+        folder = os.path.join(self.outputdir, 'code', 'pyBIDSconv_reports')
+        makedirs(folder)
+        filename = os.path.join(folder, self.subjectfolderrel.replace(os.sep, '_') + "_" +
+                                datetime.fromtimestamp(started).strftime('%Y%m%d_%H%M%S') + ".json")
+        write_atomic(filename, json.dumps(report, indent=2))
+        print("\nRun report: " + filename + "\n" + controller.summary(started))
+
+    def rollback(self):
+        # remove the files of the sequence in progress
+        for dest in self.created:
+            try:
+                os.remove(dest)
+            except OSError:
+                pass
+        self.created = []
+        if self.current is not None:
+            shutil.rmtree(os.path.join(self.tempfolder1, str(self.current)), ignore_errors=True)
+            shutil.rmtree(os.path.join(self.tempfolder2, str(self.current)), ignore_errors=True)
+
+    def abort(self):
+        # after an error: stop the other conversions of the subject and remove all temp folders
+        self.cancel()
+        self.rollback()
+        self.removestaging()
+        self.discard()
+
+    def removestaging(self):
+        shutil.rmtree(self.tempfolder1, ignore_errors=True)
+        shutil.rmtree(self.tempfolder2, ignore_errors=True)
+        if self.stagingfolder != self.subjectfolder:
+            try:
+                os.rmdir(self.stagingfolder)
+            except OSError:
+                pass
+
+    def discard(self):
+        # nothing of a failed or cancelled conversion gets into the dataset: remove the transaction folder
+        self.logfile.close()
+        try:
+            os.remove(self.logfilename)
+        except OSError:
+            pass
+        shutil.rmtree(self.transaction, ignore_errors=True)
+        try:
+            os.rmdir(os.path.dirname(self.transaction))
+        except OSError:
+            pass
+
+    @staticmethod
+    def recover(outputdir, timeout):
+        # a conversion that stopped between the two renames of publish left the replaced subject (session) folder in
+        # its transaction folder: put it back if the new folder is not in place, remove it otherwise
+        pattern = os.path.join(outputdir, Convert2BIDS.transactions, "*", "replaced")
+        if not glob.glob(pattern):
+            return
+        with DatasetLock(outputdir, timeout):
+            # publish holds the lock until its transaction folder is removed: what is left belongs to no one
+            for replaced in glob.glob(pattern):
+                transaction = os.path.dirname(replaced)
+                try:
+                    with open(os.path.join(transaction, "target")) as f:
+                        targetfolder = os.path.join(outputdir, f.read().strip())
+                except IOError:
+                    continue
+                if not os.path.exists(targetfolder):
+                    os.rename(replaced, targetfolder)
+                    fsync_folder(os.path.dirname(targetfolder))
+                shutil.rmtree(transaction, ignore_errors=True)
+
+    def publish(self):
+        # (with DatasetLock) move the finished subject (session) folder into the dataset with one rename; a subject
+        # folder that exists (other sessions, series of other workers, reconversion) is merged into the transaction
+        # folder first and swapped with it in one step where the system can (exchange_folders), otherwise with two
+        # renames whose interruption is repaired by recover
+        subjfolder = os.path.join(self.outputdir, "sub-" + self.subjnum)
+        if not os.path.exists(subjfolder):
+            os.rename(os.path.join(self.transaction, "sub-" + self.subjnum), subjfolder)
+        elif not os.path.exists(self.targetfolder):
+            os.rename(self.subjectfolder, self.targetfolder)
+        else:
+            merge_folder(self.targetfolder, self.subjectfolder, os.path.basename(self.scantsvfilename))
+            if not exchange_folders(self.subjectfolder, self.targetfolder):
+                replaced = os.path.join(self.transaction, "replaced")
+                os.rename(self.targetfolder, replaced)
+                os.rename(self.subjectfolder, self.targetfolder)
+        for folder in set([self.outputdir, os.path.dirname(self.targetfolder)]):
+            fsync_folder(folder)
+        shutil.rmtree(self.transaction, ignore_errors=True)
+        try:
+            os.rmdir(os.path.dirname(self.transaction))
+        except OSError:
+            pass
+
+    def run(self):
+        self.current = None
+        started = time.time()
 
-        scanjson = [""] * len(folder2conv)
-        scannii = [""] * len(folder2conv)
+        scanjson = [""] * len(self.folder2conv)
+        scannii = [""] * len(self.folder2conv)
         scanstsv = []
 
         nrfuncfiles = 0
         funcfilenames = []
 
-        # Loop over sequences to convert
+        # Convert the sequences in parallel (see Dcm2niixScheduler), the ones converted in the background while the
+        # sequences were checked are taken over
         # -----------------------------------------
-        for ii in range(len(folder2conv)):
+        jobs = self.jobs
+        for ii in range(len(self.folder2conv)):
+            if self.speculative is None or not self.speculative.has(self.folderindex[ii]):
+                jobs[ii] = self.startseries(ii)
+
+        # Loop over sequences to rename, in order
+        # -----------------------------------------
+        nrconverted = 0
+        for ii in range(len(self.folder2conv)):
+
+            if self.cancelled.is_set():
+                for jj in range(ii, len(self.folder2conv)):
+                    self.setstatus(jj, 'cancelled')
+                break
+
+            self.current = ii
+            self.created = []
+            tempfolder1 = os.path.join(self.tempfolder1, str(ii))
+            tempfolder2 = os.path.join(self.tempfolder2, str(ii))
 
             if ii > 1:
-                logfile.write("\n")
-
-            logfile.write("\t- Convert data: " + seqlabel2conv[folderindex[ii]] + " to " + folder2conv[ii] + "\n")
-
-            os.makedirs(tempfolder1)
-            os.makedirs(tempfolder2)
-
-            # copy file to tempfolder1
-            print "\n\nCOPY FILES " + seqlabel2conv[folderindex[ii]] + "\n"
-            for files in range(len(dcmfiles[folderindex[ii]])):
-                shutil.copy2(dcmfiles[folderindex[ii]][files], tempfolder1)
-
-            # convert dcm in temfolder1 to nii in tempfolder2
-            print "CONVERT DICOM TO NIFTI \n"
-            # options = "-b y -ba y -z y -f %s"
-            options = "-b y -ba y -z i -f %s"
-            commandstr = "dcm2niix {} -o {} {}"
-            command = commandstr.format(options, tempfolder2, tempfolder1)
-            print command
-            logfile.write("\t\t" + command + "\n")
-            os.system(command)
-
-            # delete dcm files from tempfolder1
-            filelist = glob.glob(os.path.join(tempfolder1, "*.dcm"))
-            try:
-                for f in filelist:
-                    os.remove(f)
-            except:
-                for f in filelist:
-                    os.chmod(f, 666)
-                    os.remove(f)
+                self.logfile.write("\n")
+
+            self.logfile.write("\t- Convert data: " + self.seqlabel2conv[self.folderindex[ii]] + " to " +
+                               self.folder2conv[ii] + "\n")
+
+            speculated = None
+            if ii not in jobs:
+                speculated = self.speculative.take(self.folderindex[ii])
+                if speculated is None:
+                    # background conversion failed or discarded
+                    jobs[ii] = self.startseries(ii)
+
+            if speculated is not None:
+                # already converted in the background while the sequences were checked
+                print "\n\nTAKE BACKGROUND CONVERSION " + self.seqlabel2conv[self.folderindex[ii]] + "\n"
+                self.logfile.write("\t\t" + speculated[1] + " (in background)\n")
+                if speculated[2]:
+                    self.logfile.write("\t\t" + speculated[2] + "\n")
+                makedirs(self.tempfolder2)
+                shutil.move(speculated[0], tempfolder2)
+            else:
+                job = jobs[ii]
+                job['done'].wait()
+                if 'command' in job:
+                    self.logfile.write("\t\t" + job['command'] + "\n")
+                if 'memory' in job:
+                    self.logfile.write("\t\t" + job['memory'] + "\n")
+                if 'error' in job:
+                    raise IOError(job['error'])
+                if job.get('returncode') != 0 and not self.cancelled.is_set():
+                    self.logfile.write("\t\tdcm2niix failed (exit code " + str(job.get('returncode')) + ")\n")
+                    self.rollback()
+                    self.setstatus(ii, 'failed')
+                    continue
+
+            if self.cancelled.is_set():
+                self.logfile.write("\t\tConversion cancelled\n")
+                self.rollback()
+                for jj in range(ii, len(self.folder2conv)):
+                    self.setstatus(jj, 'cancelled')
+                break
+
+            # delete dcm files
+            shutil.rmtree(tempfolder1, ignore_errors=True)
 
             # Rename files
             print "\nRENAME FILES \n"
-            logfile.write("\t- Rename files: " + "\n")
+            self.setstatus(ii, 'renaming')
+            self.logfile.write("\t- Rename files: " + "\n")
 
             # detect multi echos
             onlyfiles = glob.glob(os.path.join(tempfolder2, "*.json"))
@@ -2317,58 +5791,30 @@ class Convert2BIDS:
             except:
                 nrecho = 1
 
-            # create new filenames
-            sub1 = "sub-" + subjnum
-
-            if sessionnumber == "":
-                sess1 = ""
-            else:
-                sess1 = "_ses-" + str(sessionnumber)
-
-            if task2conv[ii] == "":
-                task1 = ""
-            else:
-                task1 = "_task-" + task2conv[ii]
-
-            if acq2conv[ii] == "":
-                acq1 = ""
-            else:
-                acq1 = "_acq-" + acq2conv[ii]
-
-            if run2conv[ii] == "":
-                run1 = ""
-            else:
-                run1 = "_run-" + run2conv[ii]
-
-            if rec2conv[ii] == "":
-                rec1 = ""
-            else:
-                rec1 = "_rec-" + rec2conv[ii]
-
             if nrecho > 1:
                 echocount = 1
 
             # rename all files
             filetypes = ['.nii.gz', '.json']
 
-            if folder2conv[ii] == 'dwi':
+            if self.folder2conv[ii] == 'dwi':
                 filetypes = filetypes + ['.bval', '.bvec']
 
             # loop over files to rename
             sc1 = []
             sc2 = []
+            tsvlines = []
             for filename in onlyfiles:
 
                 if nrecho > 1:
-                    echo1 = "_echo-" + str(echocount)
-                    if folder2conv[ii] == 'fmap':
-                        newfilename = sub1 + sess1 + task1 + acq1 + rec1 + run1 + "_" + label2conv[ii] + str(echocount)
+                    if self.folder2conv[ii] == 'fmap':
+                        newfilename = self.plan.filename(ii, suffix=self.label2conv[ii] + str(echocount))
                     else:
-                        newfilename = sub1 + sess1 + task1 + acq1 + rec1 + run1  + echo1 + "_" + label2conv[ii]
+                        newfilename = self.plan.filename(ii, echo=echocount)
 
                     echocount += 1
                 else:
-                    newfilename = sub1 + sess1 + task1 + acq1 + rec1 + run1 + "_" + label2conv[ii]
+                    newfilename = self.plan.filename(ii)
 
                 fn = os.path.splitext(os.path.basename(filename))
 
@@ -2376,51 +5822,56 @@ class Convert2BIDS:
                 for ftype in filetypes:
 
                     source = os.path.join(tempfolder2, fn[0] + ftype)
-                    dest = os.path.join(subjectfolder, folder2conv[ii], newfilename + ftype)
+                    dest = os.path.join(self.subjectfolder, self.folder2conv[ii], newfilename + ftype)
                     if ftype == '.nii.gz':
                         if not os.path.isfile(source):
                             source = os.path.join(tempfolder2, fn[0] + '.nii')
-                            dest = os.path.join(subjectfolder, folder2conv[ii], newfilename + '.nii')
+                            dest = os.path.join(self.subjectfolder, self.folder2conv[ii], newfilename + '.nii')
                             winfo = "The following file was not been gzip form dcm2niix:\n" + dest + " \nPlease gzip it manuallzy afterwards!! \n"
-                            d = wx.MessageDialog(
-                                None, winfo,
-                                "Warning", wx.OK | wx.ICON_QUESTION)
-                            d.ShowModal()
-                            d.Destroy()
+                            self.showdialog(winfo, "Warning", wx.OK | wx.ICON_QUESTION)
 
 
                     if ftype == '.json':
-                        x = os.path.join(folder2conv[ii], newfilename + ftype)
+                        x = os.path.join(self.folder2conv[ii], newfilename + ftype)
                         x = x.replace('\\', '/')
                         sc1.append(x)
                     else:
 
 
-                        x1 = os.path.join(subjectfolderrel, folder2conv[ii], newfilename + ftype)
+                        x1 = os.path.join(self.subjectfolderrel, self.folder2conv[ii], newfilename + ftype)
                         x1 = x1.replace('\\', '/')
                         scanstsv.append(x1)
-                        scantsvfile.write("\n" + x1)
-                        scantsvfile.write("\t" + scantime2conv[ii])
+                        tsvlines.append("\n" + x1 + "\t" + self.scantime2conv[ii])
 
-                        if sessionnumber == "":
-                            x2 = os.path.join(folder2conv[ii], newfilename + ftype)
+                        if self.sessionnumber == "":
+                            x2 = os.path.join(self.folder2conv[ii], newfilename + ftype)
                         else:
-                            x2 = os.path.join("ses-" + str(sessionnumber), folder2conv[ii], newfilename + ftype)
+                            x2 = os.path.join("ses-" + str(self.sessionnumber), self.folder2conv[ii],
+                                              newfilename + ftype)
                         x2 = x2.replace('\\', '/')
                         sc2.append(x2)
 
-                    logfile.write("\t\t" + source + " ---> " + dest + "\n")
+                    self.logfile.write("\t\t" + source + " ---> " +
+                                  os.path.join(self.targetfolder, self.folder2conv[ii], os.path.basename(dest)) + "\n")
 
-                    os.rename(source, dest)
+                    commit_file(source, dest)
+                    self.created.append(dest)
 
 
-                    if folder2conv[ii] == 'func':
+                    if self.folder2conv[ii] == 'func':
                         if ftype == ".nii.gz":
-                            funcfilenames.append(dest)
+                            funcfilenames.append(os.path.join(self.targetfolder, self.folder2conv[ii],
+                                                              os.path.basename(dest)))
                             nrfuncfiles += 1
 
             scanjson[ii] = sc1
             scannii[ii] = sc2
+            self.appendscans(tsvlines)
+            self.created = []
+            if sc1:
+                nrconverted += 1
+
+            fsync_folder(os.path.join(self.subjectfolder, self.folder2conv[ii]))
 
             # remove temp folder
             try:
@@ -2432,183 +5883,120 @@ class Convert2BIDS:
             except:
                 pass
 
-        logfile.write("\n\t- Create scan tsv file: " + scantsvfilename + "\n\n")
+            if scanjson[ii]:
+                self.setstatus(ii, 'done')
+            else:
+                # dcm2niix created no files
+                self.setstatus(ii, 'failed')
+
+        self.current = None
+        if self.speculative is not None:
+            self.speculative.close()
+
+        # conversions still running after a cancel
+        for job in jobs.values():
+            job['done'].wait()
+        self.removestaging()
+
+        if self.cancelled.is_set():
+            # nothing is published
+            self.discard()
+            self.state = 'cancelled'
+            print("\nConversion cancelled: sub-" + self.subjnum + " not changed")
+            return
 
-        scantsvfile.close()
+        self.logfile.write("\n\t- Create scan tsv file: " +
+                      os.path.join(self.targetfolder, os.path.basename(self.scantsvfilename)) + "\n\n")
 
         # Add infos json files
-        logfile.write("\t- Add info to .json files: \n")
-
-        fmc = -1
-        for ii in range(len(folder2conv)):
+        self.logfile.write("\t- Add info to .json files: \n")
 
-            # add Add taskname to func json files
-            if folder2conv[ii] == 'func':
+        for ii in range(len(self.folder2conv)):
+            if not self.sidecars[ii]:
+                continue
 
-                for yy in range(len(scanjson[ii])):
+            for yy in range(len(scanjson[ii])):
 
-                    filename = subjectfolder.replace('\\', '/') + "/" + scanjson[ii][yy]
+                filename = self.subjectfolder.replace('\\', '/') + "/" + scanjson[ii][yy]
 
-                    logfile.write("\t\tAdd to " + scanjson[ii][yy] + ":\n" )
-                    logfile.write("\t\tTaskName: " + task2conv[ii] + "\n")
+                self.logfile.write("\t\tAdd to " + scanjson[ii][yy] + ":\n")
+                print "\nAdd to .json file:  \n" + scanjson[ii][yy]
 
-                    print filename
-                    with open(filename) as f:
-                        data = f.read()
-
-                    # Add IntendedFor
-                    d = json.loads(data)
-                    d["TaskName"] = task2conv[ii]
-
-                    # write json file
-                    with open(filename, 'w') as f:
-                        f.write(json.dumps(d, indent=4, separators=(', ', ': ')))
-
-            # add IntendedFor to fmap json files
-            if folder2conv[ii] == 'fmap':
-                fmc += 1
-
-                # loop over json files
-                for yy in range(len(scanjson[ii])):
-                    print "\nAdd IntendedFor to fmap .json file:  \n" + scanjson[ii][yy]
-
-                    # load json file
-                    filename = subjectfolder.replace('\\', '/') + "/" + scanjson[ii][yy]
-
-                    with open(filename) as f:
-                        data = f.read()
-
-                    # add IntendedFor
-                    d = json.loads(data)
-
-                    # create indendedfor content
-                    if len(fmapref[fmc]) == 1:
-                        d["IntendedFor"] = str(fmap_list[fmapref[fmc][0]])
-                    else:
-                        d["IntendedFor"] = []
-                        for jj in range(len(fmapref[fmc])):
-                            d["IntendedFor"].append(str(fmap_list[fmapref[fmc][jj]]))
-
-                    logfile.write("\n\t\tAdd IntendedFor to fmap .json file: " + scanjson[ii][yy] + ":\n")
-                    logfile.write("\t\tIntendedFor: ")
-                    print "IntendedFor: "
-
-                    for ix in range(len(fmapref[fmc])):
-                        logfile.write("\n\t\t\t" + d["IntendedFor"][ix] )
-                        print("\t\t\t" + d["IntendedFor"][ix])
-
-                    if label2conv[ii] == "phasediff":
-                        if folder2conv[ii-1] == 'fmap':
-                            if len(echo2conv[ii-1]) > 1:
-
-                                logfile.write("\n\t\tAdd both echo times to phasediff fmap .json file: " +
-                                              scanjson[ii][0] + " \n")
-                                print "Add both echo times to phasediff fmap json file: " + scanjson[ii][0]
+                with open(filename) as f:
+                    data = f.read()
 
-                                try:
-                                    del d['EchoTime']
-                                except:
-                                    pass
+                d = json.loads(data)
+                for key, value in self.sidecars[ii].items():
+                    if value is None:
+                        d.pop(key, None)
+                        continue
+                    d[key] = value
+                    self.logfile.write("\t\t" + key + ": " + json.dumps(value) + "\n")
+                    print(key + ": " + json.dumps(value))
 
-                                for jj in range(len(echo2conv[ii-1])):
-                                    d["EchoTime"+str(jj+1)] = float(echo2conv[ii-1][jj])/1000
+                # write json file
+                with open(filename, 'w') as f:
+                    f.write(json.dumps(d, indent=4, separators=(', ', ': ')))
 
-                    with open(filename, 'w') as f:
-                        f.write(json.dumps(d, indent=4, separators=(', ', ': ')))
+        # Publish the subject (session) folder with scans.tsv and sidecars complete
+        # -----------------------------------
+        with DatasetLock(self.outputdir, self.locktimeout):
+            self.publish()
 
-        # Participant file
+        # Participant file and CHANGES
         # -----------------------------------
-        pfilename = os.path.join(outputdir, 'participants.tsv')
-        pjfilename = os.path.join(outputdir, 'participants.json')
+        pfilename = os.path.join(self.outputdir, 'participants.tsv')
 
-        subjid = "sub-" + subjnum
+        subjid = "sub-" + self.subjnum
+        row = subjid + "\t" + str(self.patinfo[0]) + "\t" + str(self.patinfo[1]).lower()
 
-        # check if participants.tsv file exists
+        # the participants.tsv row and the log are fragments of this conversion, merged with the ones of other
+        # workers into participants.tsv and CHANGES (see DatasetFragments)
+        replace = True
         if os.path.isfile(pfilename):  # if yes
 
             # check if subject is alreeady included
             df = pd.read_csv(pfilename, delimiter='\t')
             x = df['participant_id'].tolist()
-            index1 = [i for i, c in enumerate(x) if c == "sub-" + subjnum]
+            index1 = [i for i, c in enumerate(x) if c == "sub-" + self.subjnum]
 
             if index1:  # if yes, as for replacement
 
                 winfo1 = "Subject " + subjid + " already exists in the participant.tsv file!\n"
                 winfo2 = "Do you want to replace the entry in the participant.tsv file.\n"
                 winfo3 = "Press YES, to replace, or NO to keep the old entry. "
-                d = wx.MessageDialog(
-                    None, winfo1 + winfo2 + winfo3, 
-                    "Warning", wx.YES_NO | wx.NO_DEFAULT | wx.ICON_QUESTION)
-                answer = d.ShowModal()
-                d.Destroy()
-
-                if answer == wx.ID_YES:
-
-                    df = df[df.participant_id != "sub-" + subjnum]
-                    df.to_csv(pfilename, sep='\t', index=False)
-                    pfile = open(pfilename, 'ab')
-                    pfile.write( "\r\n" + subjid + "\t" + str(patinfo[0]) + "\t" + str(patinfo[1]).lower())
-                    pfile.close()
+                answer = self.showdialog(winfo1 + winfo2 + winfo3, "Warning",
+                                         wx.YES_NO | wx.NO_DEFAULT | wx.ICON_QUESTION)
+                replace = answer == wx.ID_YES
 
-            else:  # if not add
+        if replace:
+            DatasetFragments.write(self.outputdir, self.fragment, 'participants', row)
 
-                pfile = open(pfilename, 'ab')
-                pfile.write( "\r\n" + subjid + "\t" + str(patinfo[0]) + "\t" + str(patinfo[1]).lower())
-                pfile.close()
+        self.logfile.write("\n\t- Load participants.tsv file and add/replace: " + row)
+        print "\n\n- Load participants.tsv file and add/replace: \nparticipant_id\tage\tsex\n" + row
 
-        else:  # create if participant file does not exist
-            pfile = open(pfilename, "w")
-            pfile.write("participant_id\tage\tsex")
+        self.logfile.write("\n\n\n")
+        self.logfile.close()
+        os.rename(self.logfilename, os.path.join(self.logfolder, self.fragment + ".changes"))
 
-            pfile.write("\r\n" + subjid + "\t" + str(patinfo[0]) + "\t" + str(patinfo[1]).lower())
-            pfile.close()
-
-        logfile.write("\n\t- Load participants.tsv file and add/replace: " +
-                      subjid + "\t" + str(patinfo[0]) + "\t" + str(patinfo[1]).lower() )
-        print "\n\n- Load participants.tsv file and add/replace: \nparticipant_id\tage\tsex\n" + \
-              subjid + "\t" + str(patinfo[0]) + "\t" + str(patinfo[1]).lower()
-
-        logfile.write("\n\n\n")
-        logfile.close()
-
-        # check if participants.json file exists
-        if not os.path.isfile(pjfilename):
-            try:
-                to_unicode = unicode
-            except NameError:
-                to_unicode = str
-            # create participants.json file
-            paritipant_data = {'age': {'Description': 'age of participant',
-                                   'Units': 'years'},
-                               'sex': {'Description': 'sex of participant',
-                                       "Levels": {
-                                           "m": "male",
-                                           "f": "female"} }}
-            with io.open(pjfilename, 'w', encoding='utf8') as pjsonfile:
-                str_ = json.dumps(paritipant_data,
-                            indent=4, sort_keys=False,
-                            separators=(',', ': '), ensure_ascii=False)
-                pjsonfile.write(to_unicode(str_))
-
-        # concat logfile to change
         print "\n\nUpdate CHANGE log file"
-        cfiles = [logfilename, cfilename]
-        concat = ''.join([open(f).read() for f in cfiles])
+        DatasetFragments.merge(self.outputdir, self.locktimeout)
 
-        with open(cfilename, 'w') as fout:
-            for line in concat:
-                fout.write(line)
-            fout.close()
+        if nrconverted < len(self.folder2conv):
+            self.state = 'incomplete'
+        else:
+            self.state = 'done'
 
-        try:
-            shutil.rmtree(logfolder)
-        except:
-            pass
+        if Dcm2niixScheduler.controller is not None:
+            self.writereport(jobs, started)
 
 
         # Present final message dialog
         # ------------------------------
         winfo1 = "Conversion completed for:\t " + subjid
+        if nrconverted < len(self.folder2conv):
+            winfo1 = winfo1 + "\n(" + str(nrconverted) + " of " + str(len(self.folder2conv)) + \
+                     " sequences converted, see the conversion status)"
 
         # add task event.tsv file
         if nrfuncfiles > 0:
@@ -2623,7 +6011,7 @@ class Convert2BIDS:
             winfo1b = ""
 
         # add README file
-        pfilename = os.path.join(outputdir, 'README')
+        pfilename = os.path.join(self.outputdir, 'README')
         if not os.path.isfile(pfilename): # if yes
             winfo1c = "\n\nPlease add a README file (in the BIDS source directory) containing " + \
                       "\na detailed description of the dataset."
@@ -2642,13 +6030,17 @@ class Convert2BIDS:
         winfo5 = '\n\nby Michael Lindner\nm.lindner@reading.ac.uk\nUniversity of Reading, 2017' \
                  '\nCenter for Integrative Neuroscience and Neurodynamics' \
                  '\nhttps://www.reading.ac.uk/cinn/cinn-home.aspx'
-        d = wx.MessageDialog(
-            None, winfo1 + winfo1a + winfo1b + winfo1c + winfo2 + winfo3 + winfo4 + winfo5, 
-            "IMPORTANT", wx.OK)
-        d.ShowModal()
-
-
-        StartValidator()
+        if wx.GetApp() is None:
+            # command line
+            print(winfo1 + winfo1a + winfo1b + winfo1c)
+        elif ConversionQueue.quiet:
+            # subject queue: status in the queue window, no dialog for every subject
+            print(winfo1 + winfo1a + winfo1b)
+        else:
+            # the conversion slot is released without waiting for the user
+            wx.CallAfter(self.showdialog, winfo1 + winfo1a + winfo1b + winfo1c + winfo2 + winfo3 + winfo4 + winfo5,
+                         "IMPORTANT", wx.OK)
+            wx.CallAfter(StartValidator)
 
         # close program
         # sys.exit(0)
@@ -3159,55 +6551,23 @@ class BIDSspecs:
 class CheckFilename:
     def __init__(self, folder2conv, subjnum, sessionnumber, task2conv, acq2conv, run2conv, rec2conv, label2conv):
 
-        # Check new filenames for duplicates
-        # -------------------------------------
-        nf_list = []
-        nf_list2 = []
-
-        for ii in range(len(folder2conv)):
-            # create new filenames
-            sub1 = "sub-" + subjnum
-
-            if sessionnumber == "":
-                sess1 = ""
-            else:
-                sess1 = "_ses-" + str(sessionnumber)
-
-            if task2conv[ii] == "":
-                if folder2conv == "func":
-                    # oo = wx.App()
-                    infomsg = "A task name needs to be specified for each functional session." + \
-                              "\n Taskname missing for sequence " + str(ii)
-                    d = wx.MessageDialog(None, infomsg, "INPUT ERROR!", wx.OK)
-                    d.ShowModal()
-                    d.Destroy()
-                    return
-                else:
-                    task1 = ""
-            else:
-                task2conv[ii] = re.sub(" ", "", task2conv[ii])
-                task1 = "_task-" + task2conv[ii]
-
-            if acq2conv[ii] == "":
-                acq1 = ""
-            else:
-                acq1 = "_acq-" + acq2conv[ii]
-
-            if run2conv[ii] == "":
-                run1 = ""
-            else:
-                run1 = "_run-" + run2conv[ii]
-
-            if rec2conv[ii] == "":
-                rec1 = ""
-            else:
-                rec1 = "_rec-" + rec2conv[ii]
+        task2conv = [re.sub(" ", "", x) for x in task2conv]
+        plan = BIDSPlan(subjnum, sessionnumber, folder2conv, task2conv, acq2conv, run2conv, rec2conv, label2conv)
 
-            nf_list.append(sub1 + sess1 + task1 + acq1 + run1 + rec1 + "_" + label2conv[ii])
-            nf_list2.append(".../" + folder2conv[ii] + "/" + sub1 + sess1 + task1 + acq1 + run1 + rec1 + "_" +
-                            label2conv[ii])
+        # Check new filenames for missing task names and duplicates
+        # -------------------------------------
+        missing = plan.missingtasks()
+        if missing:
+            # oo = wx.App()
+            infomsg = "A task name needs to be specified for each functional session." + \
+                      "\n Taskname missing for sequence " + str(missing[0])
+            d = wx.MessageDialog(None, infomsg, "INPUT ERROR!", wx.OK)
+            d.ShowModal()
+            d.Destroy()
+            return
 
-        dup = [x for n, x in enumerate(nf_list2) if x in nf_list2[:n]]
+        nf_list2 = [".../" + plan.path(ii) for ii in range(len(folder2conv))]
+        dup = [".../" + x for x in plan.duplicates()]
         if len(dup) > 0:
             dialogtext = "Duplicate filenames detected!\nConversion not possible until filenames are unique " \
                          "in output folders. \n"
@@ -3247,7 +6607,99 @@ class CheckFilename:
 # #####################################################################################################################
 # #####################################################################################################################
 
+def commandline(args):
+    # conversion plans without GUI:
+    #   pyBIDSconv.py plan --config C --categorization R --output BIDS (--dicom D --subject N | --subjects list.tsv)
+    #   pyBIDSconv.py execute plan.json
+    # shared work queue of several nodes (see WorkQueue):
+    #   pyBIDSconv.py submit QUEUE plan.json [--per-series]
+    #   pyBIDSconv.py worker QUEUE [--processes N]
+    #   pyBIDSconv.py status QUEUE
+    parser = argparse.ArgumentParser(prog='pyBIDSconv')
+    commands = parser.add_subparsers(dest='command')
+
+    p = commands.add_parser('plan', help='write a conversion plan (json) without touching the BIDS folder')
+    p.add_argument('--config', required=True, help='config file')
+    p.add_argument('--categorization', required=True, help='categorization file')
+    p.add_argument('--output', required=True, help='BIDS folder')
+    p.add_argument('--dicom', help='dicom folder of a single subject')
+    p.add_argument('--subject', help='subject number of the single subject')
+    p.add_argument('--group', default='', help='subject group of the single subject')
+    p.add_argument('--session', default='', help='session number of the single subject')
+    p.add_argument('--subjects', help='tab separated subject list (columns dicom, subject, group, session)')
+    p.add_argument('--templates', action='store_true', help='use the decisions of matching protocol templates')
+    p.add_argument('--plan', default='pyBIDSconv_plan.json', help='plan file to write')
+
+    e = commands.add_parser('execute', help='convert the subjects of a conversion plan')
+    e.add_argument('plan', help='plan file')
+    e.add_argument('--config', help='config file (default: the config the plan was made with)')
+
+    s = commands.add_parser('submit', help='add the subjects of a conversion plan to a shared work queue')
+    s.add_argument('queue', help='queue folder on the file system shared by the workers')
+    s.add_argument('plan', help='plan file')
+    s.add_argument('--per-series', action='store_true', help='one job per series instead of one per subject')
+    s.add_argument('--timeout', type=int,
+                   help='seconds without heartbeat after which a claim is stale (default: QueueTimeout of the config)')
+
+    w = commands.add_parser('worker', help='convert the jobs of a shared work queue until it is empty')
+    w.add_argument('queue', help='queue folder')
+    w.add_argument('--config', help='config file (default: the config the plan was made with)')
+    w.add_argument('--max-jobs', type=int, help='stop after this number of jobs')
+    w.add_argument('--processes', type=int, default=1, help='number of worker processes on this node')
+
+    q = commands.add_parser('status', help='jobs and claims of a shared work queue')
+    q.add_argument('queue', help='queue folder')
+
+    a = parser.parse_args(args)
+
+    if a.command == 'plan':
+        if a.subjects:
+            subjects = read_subject_list(a.subjects)
+        elif a.dicom and a.subject:
+            subjects = [{'pathdicom': a.dicom, 'subjectnumber': a.subject, 'subjectgroup': a.group,
+                         'session': a.session}]
+        else:
+            parser.error('either --subjects or --dicom and --subject are needed')
+        t0 = time.time()
+        plan = plan_study(subjects, a.categorization, a.config, a.output, a.templates)
+        with open(a.plan, 'w') as f:
+            json.dump(plan, f, indent=2)
+        print("%d subjects planned, %d errors, %.1f s: %s" % (len(plan['subjects']), len(plan['errors']),
+                                                             time.time() - t0, a.plan))
+    elif a.command == 'execute':
+        with open(a.plan) as f:
+            plan = json.load(f, object_pairs_hook=OrderedDict)
+        execute_plan(plan, load_config(a.config or plan['configfile']))
+    elif a.command == 'submit':
+        with open(a.plan) as f:
+            plan = json.load(f, object_pairs_hook=OrderedDict)
+        timeout = a.timeout
+        if timeout is None:
+            timeout = getattr(load_config(plan['configfile']), 'QueueTimeout', 300)
+        added = WorkQueue.submit(a.queue, plan, a.per_series, timeout)
+        print("%d jobs added to %s" % (len(added), a.queue))
+    elif a.command == 'worker':
+        if a.processes > 1:
+            # independent worker processes, as on different nodes
+            command = [sys.executable, os.path.abspath(__file__), 'worker', a.queue]
+            if a.config:
+                command += ['--config', a.config]
+            if a.max_jobs:
+                command += ['--max-jobs', str(a.max_jobs)]
+            processes = [subprocess.Popen(command) for _ in range(a.processes)]
+            for process in processes:
+                process.wait()
+        else:
+            nrjobs = run_worker(a.queue, load_config(a.config) if a.config else None, a.max_jobs)
+            print("%s: %d jobs converted" % (worker_id(), nrjobs))
+    elif a.command == 'status':
+        WorkQueue(a.queue).status()
+
+
 def main():
+    if len(sys.argv) > 1:
+        commandline(sys.argv[1:])
+        return
     x = wx.App()
     # dcm = GetDCMinfo()
     # dcm = GetInput()
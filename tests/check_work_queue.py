@@ -0,0 +1,140 @@
+"""
+Check of the shared-filesystem work queue of pyBIDSconv with local worker processes.
+
+usage: python check_work_queue.py [workers]  (also run by test_work_queue.py)
+
+A small conversion plan is submitted to a queue in a temporary folder and converted by two (or more) local workers
+(run_worker in separate processes, the dicom conversion replaced by a short sleep). One job is left behind as the
+stale claim of a dead worker and one job fails. Checked are:
+- claim exclusivity: no job is converted by two workers at the same time and every job is converted once
+- stale claims: the claim of the dead worker is given back and converted by one of the workers
+- done/failed: all jobs end in done, the failing one in failed, both with a log; pending and claimed are empty
+"""
+
+from __future__ import print_function
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pyBIDSconv
+
+TIMEOUT = 2
+
+
+class FakeConversion:
+    # stands in for Convert2BIDS.fromplan: marks the job as active (exclusive creation) while it "converts"
+    def __init__(self, state):
+        self.state = state
+
+    @staticmethod
+    def fromplan(subjectplan, outputdir, cfg=None, cancelled=None):
+        job = subjectplan['subject'].replace('/', '_')
+        active = os.path.join(outputdir, 'active', job)
+        try:
+            os.close(os.open(active, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError:
+            with open(os.path.join(outputdir, 'violations'), 'a') as f:
+                f.write(job + ' converted by two workers at once\n')
+            raise
+        try:
+            if subjectplan['series'][0]['description'] == 'fail':
+                raise ValueError('conversion of ' + job + ' failed')
+            time.sleep(0.2)
+            with open(os.path.join(outputdir, 'converted', job + '_' + pyBIDSconv.worker_id()), 'w') as f:
+                f.write(job)
+        finally:
+            os.remove(active)
+        return FakeConversion('done')
+
+
+def worker(queuedir):
+    pyBIDSconv.Convert2BIDS = FakeConversion
+    nrjobs = pyBIDSconv.run_worker(queuedir, cfg=object())
+    print(pyBIDSconv.worker_id() + ": " + str(nrjobs) + " jobs")
+
+
+def plan(outputdir, nrsubjects):
+    subjects = []
+    for ii in range(nrsubjects):
+        description = 'fail' if ii == 1 else 't1_mprage'
+        subjects.append({'subject': 'sub-%03d' % ii, 'series': [{'index': 0, 'description': description,
+                                                                  'bytes': 1}]})
+    return {'outputdir': outputdir, 'configfile': '', 'subjects': subjects}
+
+
+def check(nrworkers=2, nrsubjects=12):
+    # runs the queue with nrworkers local worker processes, returns the list of errors
+    folder = tempfile.mkdtemp(prefix='pybidsconv_queue_')
+    queuedir = os.path.join(folder, 'queue')
+    outputdir = os.path.join(folder, 'bids')
+    os.makedirs(os.path.join(outputdir, 'active'))
+    os.makedirs(os.path.join(outputdir, 'converted'))
+    errors = []
+    try:
+        added = pyBIDSconv.WorkQueue.submit(queuedir, plan(outputdir, nrsubjects), timeout=TIMEOUT)
+        if len(added) != nrsubjects:
+            errors.append("%d of %d jobs submitted" % (len(added), nrsubjects))
+        if pyBIDSconv.WorkQueue.submit(queuedir, plan(outputdir, nrsubjects), timeout=TIMEOUT):
+            errors.append("jobs submitted twice")
+
+        # claim of a dead worker, not touched for longer than the timeout
+        stale = os.path.join(queuedir, 'claimed', 'sub-000@deadhost_1')
+        os.rename(os.path.join(queuedir, 'pending', 'sub-000.json'), stale)
+        os.utime(stale, (time.time() - 10 * TIMEOUT, time.time() - 10 * TIMEOUT))
+
+        processes = [multiprocessing.Process(target=worker, args=(queuedir,)) for _ in range(nrworkers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        counts = pyBIDSconv.WorkQueue(queuedir).status()
+        if counts['pending'] or counts['claimed']:
+            errors.append("jobs left in pending or claimed")
+        if counts['done'] != nrsubjects - 1 or counts['failed'] != 1:
+            errors.append("%d done and %d failed jobs, expected %d and 1" %
+                          (counts['done'], counts['failed'], nrsubjects - 1))
+        if not os.path.exists(os.path.join(queuedir, 'failed', 'sub-001.log')):
+            errors.append("no log of the failed job")
+        for name in os.listdir(os.path.join(queuedir, 'done')):
+            if name.endswith('.json') and not os.path.exists(os.path.join(queuedir, 'done', name[:-5] + '.log')):
+                errors.append("no log of the done job " + name[:-5])
+
+        converted = [name.split('_')[0] for name in os.listdir(os.path.join(outputdir, 'converted'))]
+        for ii in range(nrsubjects):
+            job = 'sub-%03d' % ii
+            if ii != 1 and converted.count(job) != 1:
+                errors.append("%s converted %d times" % (job, converted.count(job)))
+        workers = set(name.split('_', 1)[1] for name in os.listdir(os.path.join(outputdir, 'converted')))
+        if len(workers) < min(nrworkers, 2):
+            errors.append("jobs converted by %d worker(s) only" % len(workers))
+        if os.path.exists(os.path.join(outputdir, 'violations')):
+            with open(os.path.join(outputdir, 'violations')) as f:
+                errors.append(f.read().strip())
+        with open(os.path.join(queuedir, 'done', 'sub-000.log')) as f:
+            if 'deadhost' in f.read():
+                errors.append("stale claim finished by the dead worker")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return errors
+
+
+def main():
+    nrworkers = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    nrsubjects = 12
+    errors = check(nrworkers, nrsubjects)
+    for error in errors:
+        print("FAILED: " + error)
+    if not errors:
+        print("Work queue OK: %d jobs, %d workers" % (nrsubjects, nrworkers))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
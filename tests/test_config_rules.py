@@ -0,0 +1,101 @@
+"""
+Tests of the compiled config rules (ConfigRules) against the item by item loops they replace.
+"""
+
+import numpy as np
+
+from pyBIDSconv import ConfigRules
+
+
+class Config:
+    ReconstructionInfoInImageType = ['NORM', 'MOCO']
+    PhaseInfoForFmapsBySequenceDescriptionSubstring = ["_pa", "_ap", "_rl", "_lr"]
+    ExclusionsBySequenceDescriptionContent = ['aah', 'scout', 'phoenix']
+    ExclusionsBySequenceDescriptionEnd = ['Localizer', '_fa', '_trace', '_colfa', '_tracew', '_adc']
+
+
+UN_SEQ = ['AAHead_Scout', 'localizer', 't1_mprage', 'ep2d_bold_rest', 'ep2d_diff_mddw_30_p2_ADC',
+          'ep2d_diff_mddw_30_p2_TRACEW', 'ep2d_diff_mddw_30_p2_ColFA', 'ep2d_diff_mddw_30_p2_FA', 'gre_field_map_AP',
+          'gre_field_map_pa', 'se_epi_lr_scout', 'PhoenixZIPReport', 't2_tse_Localizer_ap', 'Localizer_aah']
+IMAGETYPES = [['ORIGINAL', 'PRIMARY', 'M', 'NORM', 'MOCO'], ['ORIGINAL', 'PRIMARY', 'M', 'NORM'],
+              ['ORIGINAL', 'PRIMARY', 'M', 'ND'], ['ORIGINAL', 'PRIMARY', 'M', 'MOCO']]
+SCANTYPES = ['anat', 'anat', 'anat', 'func', 'dwi', 'dwi', 'dwi', 'dwi', 'fmap', 'fmap', 'fmap', '---', 'fmap',
+             'anat']
+
+
+def reference(cfg, un_seq, it_list_all, scantype_list):
+    # the item by item loops of the categorization before ConfigRules
+    un_seq_l = [item.lower() for item in un_seq]
+    acq_name_list = [''] * len(un_seq)
+    rec_name_list = [''] * len(un_seq)
+    exclusion_array = np.zeros(len(un_seq), dtype=int)
+
+    for item in cfg.ReconstructionInfoInImageType:
+        for jj in range(len(it_list_all)):
+            if [value for value in it_list_all[jj] if item in value]:
+                rec_name_list[jj] = item
+
+    for ii in range(len(un_seq_l)):
+        if scantype_list[ii] == "fmap":
+            for item in cfg.PhaseInfoForFmapsBySequenceDescriptionSubstring:
+                if item in un_seq_l[ii].lower():
+                    acq_name_list[ii] = item[1:]
+
+    for item in cfg.ExclusionsBySequenceDescriptionContent:
+        for ii in range(len(un_seq_l)):
+            if item in un_seq_l[ii]:
+                exclusion_array[ii] = 1
+                acq_name_list[ii] = item
+
+    for item in cfg.ExclusionsBySequenceDescriptionEnd:
+        for ii in range(len(un_seq_l)):
+            if un_seq_l[ii].lower().endswith(item.lower()):
+                exclusion_array[ii] = 1
+                acq_name_list[ii] = item
+
+    return exclusion_array, acq_name_list, rec_name_list
+
+
+def test_rules_match_item_loops():
+    it_list_all = [IMAGETYPES[ii % len(IMAGETYPES)] for ii in range(len(UN_SEQ))]
+    exclusion, acq, rec = ConfigRules(Config).apply(UN_SEQ, it_list_all, SCANTYPES)
+    expected = reference(Config, UN_SEQ, it_list_all, SCANTYPES)
+    assert list(exclusion) == list(expected[0])
+    assert acq == expected[1]
+    assert rec == expected[2]
+
+
+def test_last_matching_item_wins():
+    exclusion, acq, rec = ConfigRules(Config).apply(['aah_localizer', 'scout_aah', 'aah_gre_ap'],
+                                                    [['NORM', 'MOCO'], [], []], ['anat', 'anat', 'fmap'])
+    # end item over content item over phase info, the later list item over the earlier one
+    assert list(exclusion) == [1, 1, 1]
+    assert acq == ['Localizer', 'scout', 'aah']
+    assert rec == ['MOCO', '', '']
+
+
+def test_phase_info_only_for_fieldmaps():
+    exclusion, acq, _ = ConfigRules(Config).apply(['gre_field_map_AP', 'ep2d_bold_AP'], [[], []], ['fmap', 'func'])
+    assert list(exclusion) == [0, 0]
+    assert acq == ['ap', '']
+
+
+def test_items_are_matched_literally():
+    class Special:
+        ExclusionsBySequenceDescriptionContent = ['a.b', '(x']
+        ExclusionsBySequenceDescriptionEnd = ['+1']
+
+    exclusion, acq, _ = ConfigRules(Special).apply(['a.b', 'axb', 'run(x', 'run+1', 'run11'], [[]] * 5, ['anat'] * 5)
+    assert list(exclusion) == [1, 0, 1, 1, 0]
+    assert acq == ['a.b', '', '(x', '+1', '']
+
+
+def test_missing_lists_and_signature():
+    class Empty:
+        pass
+
+    rules = ConfigRules(Empty)
+    exclusion, acq, rec = rules.apply(['t1_mprage'], [['NORM']], ['anat'])
+    assert list(exclusion) == [0]
+    assert acq == [''] and rec == ['']
+    assert rules.signature() != ConfigRules(Config).signature()
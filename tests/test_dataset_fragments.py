@@ -0,0 +1,67 @@
+"""
+Tests of the fragments of the conversions for participants.tsv and CHANGES (DatasetFragments).
+"""
+
+import os
+
+from pyBIDSconv import DatasetFragments
+
+HEADER = "participant_id\tage\tsex"
+
+
+def read(filename):
+    with open(filename) as f:
+        return f.read()
+
+
+def write(outputdir, name, kind, data, mtime):
+    DatasetFragments.write(outputdir, name, kind, data)
+    filename = os.path.join(outputdir, DatasetFragments.foldername, name + '.' + kind)
+    os.utime(filename, (mtime, mtime))
+
+
+def test_merge_into_new_dataset(tmpdir):
+    outputdir = str(tmpdir)
+    write(outputdir, 'sub-002_w1', 'participants', "sub-002\t30\tf", 2000)
+    write(outputdir, 'sub-001_w2', 'participants', "sub-001\t25\tm", 1000)
+    write(outputdir, 'sub-002_w1', 'changes', "sub-002\n\n", 2000)
+    write(outputdir, 'sub-001_w2', 'changes', "sub-001\n\n", 1000)
+    DatasetFragments.merge(outputdir, 5)
+
+    # rows and entries in the order the conversions finished
+    assert read(str(tmpdir.join('participants.tsv'))).splitlines() == [HEADER, "sub-001\t25\tm", "sub-002\t30\tf"]
+    assert os.path.isfile(str(tmpdir.join('participants.json')))
+    changes = read(str(tmpdir.join('CHANGES')))
+    assert changes.startswith("0.03 sub-002\n\n0.02 sub-001\n\n0.01 ")
+    assert "Initial release" in changes
+    # the fragments are removed, the folder stays for other conversions
+    assert os.listdir(str(tmpdir.join(DatasetFragments.foldername))) == []
+
+
+def test_row_of_same_participant_is_replaced(tmpdir):
+    outputdir = str(tmpdir)
+    with open(str(tmpdir.join('participants.tsv')), 'w') as f:
+        f.write(HEADER + "\nsub-001\t25\tm\nsub-002\t30\tf\n")
+    write(outputdir, 'sub-001_ses-2_w1', 'participants', "sub-001\t26\tm", 1000)
+    DatasetFragments.merge(outputdir, 5)
+    assert read(str(tmpdir.join('participants.tsv'))).splitlines() == [HEADER, "sub-002\t30\tf", "sub-001\t26\tm"]
+    assert not os.path.exists(str(tmpdir.join('CHANGES')))
+
+
+def test_entries_numbered_after_existing_changes(tmpdir):
+    outputdir = str(tmpdir)
+    with open(str(tmpdir.join('CHANGES')), 'w') as f:
+        f.write("0.02 earlier\n\n")
+    write(outputdir, 'sub-003_w1', 'changes', "sub-003\n\n", 1000)
+    DatasetFragments.merge(outputdir, 5)
+    assert read(str(tmpdir.join('CHANGES'))) == "0.03 sub-003\n\n0.02 earlier\n\n"
+
+
+def test_log_of_running_conversion_is_left(tmpdir):
+    outputdir = str(tmpdir)
+    write(outputdir, 'sub-001_w1', 'log', "converting\n", 1000)
+    DatasetFragments.merge(outputdir, 5)
+    # nothing to merge: the log of the running conversion stays, no dataset level files are written
+    assert os.listdir(str(tmpdir.join(DatasetFragments.foldername))) == ['sub-001_w1.log']
+    assert not os.path.exists(str(tmpdir.join('participants.tsv')))
+    assert not os.path.exists(str(tmpdir.join('CHANGES')))
@@ -0,0 +1,96 @@
+"""
+Tests of the dataset lock (DatasetLock): exclusion, token based breaking of stale locks and lost locks.
+"""
+
+import os
+import threading
+import time
+
+import pytest
+
+from pyBIDSconv import DatasetLock
+
+
+def write_lock(outputdir, token, seconds=0):
+    lockfile = os.path.join(outputdir, DatasetLock.lockname)
+    with open(lockfile, 'wb') as f:
+        f.write(token.encode('UTF8'))
+    mtime = time.time() - seconds
+    os.utime(lockfile, (mtime, mtime))
+    return lockfile
+
+
+def test_lock_is_exclusive(tmpdir):
+    outputdir = str(tmpdir)
+    counter = os.path.join(outputdir, 'counter')
+    with open(counter, 'w') as f:
+        f.write('0')
+
+    def increment():
+        for _ in range(10):
+            with DatasetLock(outputdir, 30):
+                with open(counter) as f:
+                    value = int(f.read())
+                time.sleep(0.001)
+                with open(counter, 'w') as f:
+                    f.write(str(value + 1))
+
+    threads = [threading.Thread(target=increment) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with open(counter) as f:
+        assert f.read() == '40'
+    assert not os.path.exists(os.path.join(outputdir, DatasetLock.lockname))
+
+
+def test_lock_file_holds_token(tmpdir):
+    with DatasetLock(str(tmpdir), 30) as lock:
+        assert DatasetLock.readtoken(lock.lockfile) == lock.token
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_stale_lock_is_broken(tmpdir):
+    write_lock(str(tmpdir), 'deadhost_1_0_0.0', seconds=60)
+    started = time.time()
+    with DatasetLock(str(tmpdir), 5) as lock:
+        assert DatasetLock.readtoken(lock.lockfile) == lock.token
+    assert time.time() - started < 5
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_remove_keeps_lock_of_other_owner(tmpdir):
+    # the lock was judged stale with one token, meanwhile another worker holds it
+    lockfile = write_lock(str(tmpdir), 'newowner')
+    assert not DatasetLock(str(tmpdir), 5).remove('staleowner')
+    assert DatasetLock.readtoken(lockfile) == 'newowner'
+    assert os.listdir(str(tmpdir)) == [DatasetLock.lockname]
+
+
+def test_remove_of_judged_token(tmpdir):
+    write_lock(str(tmpdir), 'staleowner', seconds=60)
+    assert DatasetLock(str(tmpdir), 5).remove('staleowner')
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_live_lock_is_not_broken(tmpdir):
+    lockfile = write_lock(str(tmpdir), 'liveowner')
+    DatasetLock(str(tmpdir), 5).breakstale()
+    assert DatasetLock.readtoken(lockfile) == 'liveowner'
+
+
+def test_broken_lock_raises_on_release(tmpdir):
+    with pytest.raises(IOError):
+        with DatasetLock(str(tmpdir), 30) as lock:
+            # broken as stale and taken by another worker
+            os.remove(lock.lockfile)
+            write_lock(str(tmpdir), 'otherowner')
+    assert DatasetLock.readtoken(os.path.join(str(tmpdir), DatasetLock.lockname)) == 'otherowner'
+
+
+def test_error_in_lock_is_not_masked(tmpdir):
+    with pytest.raises(ValueError):
+        with DatasetLock(str(tmpdir), 30) as lock:
+            os.remove(lock.lockfile)
+            raise ValueError('conversion failed')
@@ -0,0 +1,131 @@
+"""
+Tests of the dcm2niix scheduler (Dcm2niixScheduler) and of its process handles (Dcm2niixProcess).
+"""
+
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+from pyBIDSconv import Dcm2niixScheduler
+
+MB = 1024 * 1024
+
+
+class Config:
+    Dcm2niixJobs = 2
+    Dcm2niixMemoryMB = 100
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    monkeypatch.setattr(Dcm2niixScheduler, 'waiting', [])
+    monkeypatch.setattr(Dcm2niixScheduler, 'running', 0)
+    monkeypatch.setattr(Dcm2niixScheduler, 'used', 0)
+    monkeypatch.setattr(Dcm2niixScheduler, 'controller', None)
+    monkeypatch.setattr(Dcm2niixScheduler, 'budget', None)
+    monkeypatch.setattr(Dcm2niixScheduler, 'maxjobs', None)
+    Dcm2niixScheduler.configure(Config)
+    return Dcm2niixScheduler
+
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition():
+        assert time.time() < end
+        time.sleep(0.01)
+
+
+def start_jobs(scheduler, estimates, admitted, cancelled):
+    def job(estimate):
+        if scheduler.acquire(estimate, cancelled):
+            admitted.append(estimate)
+
+    threads = [threading.Thread(target=job, args=(estimate,)) for estimate in estimates]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def test_jobs_within_budget_and_maxjobs(scheduler):
+    cancelled = threading.Event()
+    admitted = []
+    threads = start_jobs(scheduler, [30 * MB, 30 * MB, 30 * MB], admitted, cancelled)
+    wait_for(lambda: len(admitted) == 2 and len(scheduler.waiting) == 1)
+    # the third job fits into the budget but maxjobs are running
+    assert scheduler.running == 2
+    scheduler.release(30 * MB)
+    wait_for(lambda: len(admitted) == 3)
+    for thread in threads:
+        thread.join()
+    scheduler.release(30 * MB)
+    scheduler.release(30 * MB)
+    assert scheduler.running == 0 and scheduler.used == 0
+
+
+def test_largest_fitting_job_first(scheduler):
+    cancelled = threading.Event()
+    assert scheduler.acquire(100 * MB, cancelled)
+    admitted = []
+    threads = start_jobs(scheduler, [10 * MB, 40 * MB, 20 * MB], admitted, cancelled)
+    wait_for(lambda: len(scheduler.waiting) == 3)
+    scheduler.release(100 * MB)
+    # the largest job that fits next to the running ones, until maxjobs run
+    wait_for(lambda: len(admitted) == 2)
+    assert admitted == [40 * MB, 20 * MB]
+    scheduler.release(40 * MB)
+    wait_for(lambda: len(admitted) == 3)
+    for thread in threads:
+        thread.join()
+    assert admitted == [40 * MB, 20 * MB, 10 * MB]
+
+
+def test_job_larger_than_budget_runs_alone(scheduler):
+    cancelled = threading.Event()
+    assert scheduler.acquire(500 * MB, cancelled)
+    admitted = []
+    threads = start_jobs(scheduler, [10 * MB], admitted, cancelled)
+    time.sleep(0.2)
+    assert admitted == []
+    scheduler.release(500 * MB)
+    for thread in threads:
+        thread.join()
+    assert admitted == [10 * MB]
+
+
+def test_cancel_while_waiting(scheduler):
+    cancelled = threading.Event()
+    assert scheduler.acquire(100 * MB, cancelled)
+    admitted = []
+    waiting = threading.Event()
+    threads = start_jobs(scheduler, [50 * MB], admitted, waiting)
+    wait_for(lambda: len(scheduler.waiting) == 1)
+    waiting.set()
+    for thread in threads:
+        thread.join(5)
+    assert admitted == [] and scheduler.waiting == [] and scheduler.running == 1
+
+
+@pytest.mark.skipif(sys.platform.startswith('win'), reason="POSIX shell")
+def test_execute_output_and_return_code():
+    output, returncode, peak = Dcm2niixScheduler.execute(['sh', '-c', 'echo converted; exit 3'])
+    assert output.strip() == b'converted'
+    assert returncode == 3
+    if hasattr(os, 'wait4'):
+        assert peak > 0
+
+
+@pytest.mark.skipif(sys.platform.startswith('win'), reason="POSIX shell")
+def test_kill_of_running_and_reaped_process():
+    processes = []
+    timer = threading.Timer(0.2, lambda: processes[0].kill())
+    timer.start()
+    started = time.time()
+    _, returncode, _ = Dcm2niixScheduler.execute(['sleep', '30'], processes.append)
+    assert time.time() - started < 10
+    assert returncode != 0
+    assert not processes[0].running()
+    # reaped: kill must not signal the pid again
+    processes[0].kill()
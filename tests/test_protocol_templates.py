@@ -0,0 +1,65 @@
+"""
+Tests of the protocol templates (ProtocolTemplates) and of the run labels of replayed decisions (format_run).
+"""
+
+import os
+
+from pyBIDSconv import ProtocolTemplates, format_run
+
+T1 = ['t1_mprage', 'tfl3d1_16ns', 176]
+BOLD = ['ep2d_bold_rest', 'epfid2d1_64', 300]
+FMAP = ['gre_field_mapping', 'fm2d2r', 2]
+
+
+def row(signature, folder, label, convert='Yes', task='', run='', ref=''):
+    return {'signature': signature, 'convert': convert, 'folder': folder, 'task': task, 'acq': '', 'rec': '',
+            'run': run, 'label': label, 'ref': ref}
+
+
+def record(outputdir):
+    ProtocolTemplates(outputdir).record([row(T1, 'anat', 'T1w'), row(BOLD, 'func', 'bold', task='rest'),
+                                         row(FMAP, 'fmap', 'phasediff', ref='1')])
+
+
+def decisions(rows):
+    return [(r['folder'], r['label'], r['task'], r['run'], r['ref']) for r in rows]
+
+
+def test_format_run():
+    assert format_run(1) == '01'
+    assert format_run('2 ') == '02'
+    assert format_run(12) == '12'
+    assert format_run('') == ''
+    assert format_run('a') == 'a'
+
+
+def test_recorded_template_matches_exactly(tmpdir):
+    record(str(tmpdir))
+    assert os.path.isfile(str(tmpdir.join('code', 'pyBIDSconv_protocols.json')))
+    rows = ProtocolTemplates(str(tmpdir)).match([T1, BOLD, FMAP])
+    assert decisions(rows) == [('anat', 'T1w', '', '', ''), ('func', 'bold', 'rest', '', ''),
+                               ('fmap', 'phasediff', '', '', '1')]
+    assert [r['signature'] for r in rows] == [T1, BOLD, FMAP]
+
+
+def test_repeated_series_is_replayed_with_runs(tmpdir):
+    record(str(tmpdir))
+    rows = ProtocolTemplates(str(tmpdir)).match([T1, BOLD, BOLD, FMAP])
+    # the repeat gets the decisions of the template series, both runs are numbered, the fmap refers to both
+    assert decisions(rows) == [('anat', 'T1w', '', '', ''), ('func', 'bold', 'rest', '01', ''),
+                               ('func', 'bold', 'rest', '02', ''), ('fmap', 'phasediff', '', '', '1 2')]
+
+
+def test_no_match_beyond_tolerance(tmpdir):
+    record(str(tmpdir))
+    templates = ProtocolTemplates(str(tmpdir))
+    assert templates.match([T1, BOLD, BOLD, BOLD, FMAP], tolerance=1) is None
+    assert templates.match([T1, BOLD, BOLD, BOLD, FMAP], tolerance=2) is not None
+    # new series that are no repeats of the template do not match
+    assert templates.match([T1, BOLD, ['t2_spc', 'spc_314ns', 176], FMAP]) is None
+    assert templates.match([T1, FMAP]) is None
+
+
+def test_rows_without_signature_are_not_recorded(tmpdir):
+    ProtocolTemplates(str(tmpdir)).record([row(T1, 'anat', 'T1w'), row(None, 'func', 'bold')])
+    assert not os.path.exists(str(tmpdir.join('code', 'pyBIDSconv_protocols.json')))
@@ -0,0 +1,139 @@
+"""
+Tests of publishing a converted subject (session) folder into the dataset (Convert2BIDS.publish), of the repair of an
+interrupted publish (Convert2BIDS.recover) and of the folder helpers they use.
+"""
+
+import os
+
+import pytest
+
+import pyBIDSconv
+from pyBIDSconv import Convert2BIDS, exchange_folders, merge_folder, merge_scans
+
+HEADER = "filename\tacq_time"
+
+
+def write(filename, data):
+    folder = os.path.dirname(filename)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    with open(filename, 'w') as f:
+        f.write(data)
+
+
+def read(filename):
+    with open(filename) as f:
+        return f.read()
+
+
+def conversion(outputdir, subjnum, session):
+    # a finished conversion in its transaction folder, as Convert2BIDS.__init__ and run leave it
+    subjectfolderrel = os.path.join("sub-" + subjnum, "ses-" + session)
+    self = object.__new__(Convert2BIDS)
+    self.outputdir = outputdir
+    self.subjnum = subjnum
+    self.targetfolder = os.path.join(outputdir, subjectfolderrel)
+    self.transaction = os.path.join(outputdir, Convert2BIDS.transactions, "sub-" + subjnum + "_ses-" + session + "_w1")
+    self.subjectfolder = os.path.join(self.transaction, subjectfolderrel)
+    self.scantsvfilename = os.path.join(self.subjectfolder, "sub-" + subjnum + "_ses-" + session + "_scans.tsv")
+    write(os.path.join(self.transaction, "target"), subjectfolderrel)
+    write(os.path.join(self.subjectfolder, "anat", "sub-" + subjnum + "_ses-" + session + "_T1w.nii.gz"), "new")
+    write(self.scantsvfilename, HEADER + "\nanat/sub-" + subjnum + "_ses-" + session + "_T1w.nii.gz\t10:00")
+    return self
+
+
+def test_exchange_folders(tmpdir):
+    write(str(tmpdir.join('a', 'file')), 'a')
+    write(str(tmpdir.join('b', 'file')), 'b')
+    if not exchange_folders(str(tmpdir.join('a')), str(tmpdir.join('b'))):
+        pytest.skip("renameat2 with RENAME_EXCHANGE is not available")
+    assert read(str(tmpdir.join('a', 'file'))) == 'b'
+    assert read(str(tmpdir.join('b', 'file'))) == 'a'
+
+
+def test_merge_scans(tmpdir):
+    existing, staged = str(tmpdir.join('existing.tsv')), str(tmpdir.join('staged.tsv'))
+    write(existing, HEADER + "\nanat/T1w.nii.gz\t09:00\nfunc/bold.nii.gz\t09:10\n")
+    write(staged, HEADER + "\nanat/T1w.nii.gz\t10:00\ndwi/dwi.nii.gz\t10:10")
+    merge_scans(existing, staged)
+    assert read(staged).splitlines() == [HEADER, "func/bold.nii.gz\t09:10", "anat/T1w.nii.gz\t10:00",
+                                         "dwi/dwi.nii.gz\t10:10"]
+
+
+def test_merge_folder(tmpdir):
+    existing, staged = str(tmpdir.join('existing')), str(tmpdir.join('staged'))
+    write(os.path.join(existing, 'anat', 'T1w.nii.gz'), 'old')
+    write(os.path.join(existing, 'func', 'bold.nii.gz'), 'bold')
+    write(os.path.join(existing, 'scans.tsv'), HEADER + "\nfunc/bold.nii.gz\t09:10")
+    write(os.path.join(staged, 'anat', 'T1w.nii.gz'), 'new')
+    write(os.path.join(staged, 'scans.tsv'), HEADER + "\nanat/T1w.nii.gz\t10:00")
+    merge_folder(existing, staged, 'scans.tsv')
+    # staged files win, the other existing files are added, the existing folder is unchanged
+    assert read(os.path.join(staged, 'anat', 'T1w.nii.gz')) == 'new'
+    assert read(os.path.join(staged, 'func', 'bold.nii.gz')) == 'bold'
+    assert read(os.path.join(staged, 'scans.tsv')).splitlines() == [HEADER, "func/bold.nii.gz\t09:10",
+                                                                    "anat/T1w.nii.gz\t10:00"]
+    assert read(os.path.join(existing, 'anat', 'T1w.nii.gz')) == 'old'
+    assert read(os.path.join(existing, 'scans.tsv')) == HEADER + "\nfunc/bold.nii.gz\t09:10"
+
+
+def test_publish_new_subject(tmpdir):
+    self = conversion(str(tmpdir), '001', '1')
+    self.publish()
+    assert read(str(tmpdir.join('sub-001', 'ses-1', 'anat', 'sub-001_ses-1_T1w.nii.gz'))) == 'new'
+    assert not os.path.exists(str(tmpdir.join(Convert2BIDS.transactions)))
+
+
+def test_publish_new_session(tmpdir):
+    write(str(tmpdir.join('sub-001', 'ses-1', 'anat', 'old.nii.gz')), 'old')
+    self = conversion(str(tmpdir), '001', '2')
+    self.publish()
+    assert read(str(tmpdir.join('sub-001', 'ses-1', 'anat', 'old.nii.gz'))) == 'old'
+    assert read(str(tmpdir.join('sub-001', 'ses-2', 'anat', 'sub-001_ses-2_T1w.nii.gz'))) == 'new'
+    assert not os.path.exists(str(tmpdir.join(Convert2BIDS.transactions)))
+
+
+@pytest.mark.parametrize('exchange', [True, False])
+def test_publish_into_existing_session(tmpdir, monkeypatch, exchange):
+    if not exchange:
+        # two renames where the system cannot swap the folders
+        monkeypatch.setattr(pyBIDSconv, 'exchange_folders', lambda source, dest: False)
+    write(str(tmpdir.join('sub-001', 'ses-1', 'func', 'sub-001_ses-1_task-rest_bold.nii.gz')), 'bold')
+    write(str(tmpdir.join('sub-001', 'ses-1', 'anat', 'sub-001_ses-1_T1w.nii.gz')), 'old')
+    write(str(tmpdir.join('sub-001', 'ses-1', 'sub-001_ses-1_scans.tsv')),
+          HEADER + "\nfunc/sub-001_ses-1_task-rest_bold.nii.gz\t09:10")
+    self = conversion(str(tmpdir), '001', '1')
+    self.publish()
+    session = tmpdir.join('sub-001', 'ses-1')
+    assert read(str(session.join('anat', 'sub-001_ses-1_T1w.nii.gz'))) == 'new'
+    assert read(str(session.join('func', 'sub-001_ses-1_task-rest_bold.nii.gz'))) == 'bold'
+    assert read(str(session.join('sub-001_ses-1_scans.tsv'))).splitlines() == [
+        HEADER, "func/sub-001_ses-1_task-rest_bold.nii.gz\t09:10", "anat/sub-001_ses-1_T1w.nii.gz\t10:00"]
+    assert not os.path.exists(str(tmpdir.join(Convert2BIDS.transactions)))
+
+
+def test_recover_puts_back_replaced_folder(tmpdir):
+    # interrupted after the first rename: the dataset lacks the session
+    self = conversion(str(tmpdir), '001', '1')
+    write(os.path.join(self.transaction, 'replaced', 'anat', 'old.nii.gz'), 'old')
+    os.makedirs(str(tmpdir.join('sub-001')))
+    Convert2BIDS.recover(str(tmpdir), 5)
+    assert read(str(tmpdir.join('sub-001', 'ses-1', 'anat', 'old.nii.gz'))) == 'old'
+    assert not os.path.exists(self.transaction)
+
+
+def test_recover_removes_leftover_of_published_folder(tmpdir):
+    # interrupted after the second rename: the new session is in place
+    self = conversion(str(tmpdir), '001', '1')
+    write(os.path.join(self.transaction, 'replaced', 'anat', 'old.nii.gz'), 'old')
+    write(str(tmpdir.join('sub-001', 'ses-1', 'anat', 'new.nii.gz')), 'new')
+    Convert2BIDS.recover(str(tmpdir), 5)
+    assert os.listdir(str(tmpdir.join('sub-001', 'ses-1', 'anat'))) == ['new.nii.gz']
+    assert not os.path.exists(self.transaction)
+
+
+def test_recover_leaves_transactions_without_replaced_folder(tmpdir):
+    # a running conversion of another worker
+    self = conversion(str(tmpdir), '001', '1')
+    Convert2BIDS.recover(str(tmpdir), 5)
+    assert os.path.isdir(self.subjectfolder)
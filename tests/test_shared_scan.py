@@ -0,0 +1,119 @@
+"""
+Tests of the parallel header scan (SharedHeaderScan) against the serial scan.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from pyBIDSconv import (DicomHeaderTable, DicomPathTable, ScanCancelled, SharedHeaderScan, pydicom,
+                        scan_dicom_headers)
+
+SERIES = [(1, 'localizer', ['ORIGINAL', 'PRIMARY', 'M', 'NORM']),
+          (2, 't1_mprage', ['ORIGINAL', 'PRIMARY', 'M', 'NORM']),
+          (3, 'ep2d_bold_rest', ['ORIGINAL', 'PRIMARY', 'M', 'MOCO']),
+          (4, 'gre_field_mapping', ['ORIGINAL', 'PRIMARY', 'P'])]
+
+
+def write_dicom(filename, seriesnumber, description, imagetype, instance):
+    meta = pydicom.dataset.Dataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    meta.MediaStorageSOPInstanceUID = '1.2.3.%d.%d' % (seriesnumber, instance)
+    meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
+    ds = pydicom.dataset.FileDataset(filename, {}, file_meta=meta, preamble=b'\0' * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.SeriesNumber = seriesnumber
+    ds.SeriesDescription = description
+    ds.ImageType = imagetype
+    ds.AcquisitionDate = '20180102'
+    ds.AcquisitionTime = '1010%02d' % seriesnumber
+    ds.EchoTime = 2.46 * seriesnumber
+    ds.SequenceName = 'seq%d' % seriesnumber
+    ds.MRAcquisitionType = '2D'
+    ds.Manufacturer = 'SIEMENS'
+    ds.PatientAge = '031Y'
+    ds.PatientSex = 'F'
+    ds.InstanceNumber = instance
+    ds.save_as(filename)
+
+
+@pytest.fixture
+def dicomfiles(tmpdir):
+    files = []
+    for seriesnumber, description, imagetype in SERIES:
+        folder = tmpdir.mkdir('S%02d' % seriesnumber)
+        for instance in range(1, 4):
+            filename = str(folder.join('IM%03d.dcm' % instance))
+            write_dicom(filename, seriesnumber, description, imagetype, instance)
+            files.append(filename)
+    return files
+
+
+@pytest.fixture
+def smallchunks(monkeypatch):
+    monkeypatch.setattr(SharedHeaderScan, 'chunksize', 2)
+
+
+def segments():
+    # shared memory segments of multiprocessing.shared_memory (none where it is not available)
+    if not os.path.isdir('/dev/shm'):
+        return set()
+    return set(name for name in os.listdir('/dev/shm') if name.startswith(('psm_', 'wnsm_')))
+
+
+def assert_same_table(shared, serial):
+    assert np.array_equal(np.asarray(shared.sn_array), np.asarray(serial.sn_array))
+    assert list(shared.seq_array) == list(serial.seq_array)
+    assert list(shared.seqname_array) == list(serial.seqname_array)
+    assert list(shared.acq_time_list) == list(serial.acq_time_list)
+    assert list(shared.acq_date_list) == list(serial.acq_date_list)
+    assert [shared.it_val_list[ii] for ii in range(len(serial.it_val_list))] == list(serial.it_val_list)
+    assert np.allclose(np.asarray(shared.echotime_array, dtype=float), np.asarray(serial.echotime_array, dtype=float))
+    assert shared.patinfo == serial.patinfo
+
+
+def test_shared_scan_matches_serial_scan(dicomfiles, smallchunks):
+    before = segments()
+    shared = SharedHeaderScan(dicomfiles, 2).run()
+    assert_same_table(shared, DicomHeaderTable(scan_dicom_headers(dicomfiles)))
+    shared.close()
+    assert segments() == before
+
+
+def test_shared_scan_of_path_table(dicomfiles, smallchunks):
+    paths = DicomPathTable.fromlist(dicomfiles)
+    assert paths[1:4] == dicomfiles[1:4]
+    shared = SharedHeaderScan(paths, 2, 'inode').run()
+    assert_same_table(shared, DicomHeaderTable(scan_dicom_headers(dicomfiles)))
+    shared.close()
+
+
+def test_progress_of_shared_scan(dicomfiles, smallchunks):
+    counts = []
+    SharedHeaderScan(dicomfiles, 2).run(lambda done, total: counts.append((done, total))).close()
+    assert counts[-1] == (len(dicomfiles), len(dicomfiles))
+    assert [done for done, _ in counts] == sorted(done for done, _ in counts)
+
+
+def test_cancelled_shared_scan_releases_memory(dicomfiles, smallchunks):
+    def progress(done, total):
+        raise ScanCancelled()
+
+    before = segments()
+    with pytest.raises(ScanCancelled):
+        SharedHeaderScan(dicomfiles * 20, 2).run(progress)
+    assert segments() == before
+
+
+def test_failed_shared_scan_releases_memory(dicomfiles, smallchunks, tmpdir):
+    broken = str(tmpdir.join('broken.dcm'))
+    with open(broken, 'w') as f:
+        f.write('no dicom')
+    before = segments()
+    with pytest.raises(IOError):
+        SharedHeaderScan(dicomfiles + [broken], 2).run()
+    assert segments() == before
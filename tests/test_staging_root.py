@@ -0,0 +1,100 @@
+"""
+Tests of the space reservations of the staging folders (StagingRoot).
+"""
+
+import os
+import threading
+import time
+
+import pytest
+
+from pyBIDSconv import StagingRoot
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def staging(monkeypatch):
+    # free space of the staging file system, set by the tests
+    free = {'bytes': 100 * MB}
+    monkeypatch.setattr(StagingRoot, 'reservations', {})
+    monkeypatch.setattr(StagingRoot, 'freespace', staticmethod(lambda folder: free['bytes']))
+    return free
+
+
+def write(folder, name, nbytes):
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    with open(os.path.join(folder, name), 'wb') as f:
+        f.write(b'\1' * nbytes)
+
+
+def test_reserve_and_release(tmpdir, staging):
+    cancelled = threading.Event()
+    first = StagingRoot.reserve(str(tmpdir), 60 * MB, [str(tmpdir.join('a'))], cancelled)
+    second = StagingRoot.reserve(str(tmpdir), 40 * MB, [str(tmpdir.join('b'))], cancelled)
+    assert first != second
+    assert StagingRoot.unwritten() == 100 * MB
+    StagingRoot.release(first)
+    assert list(StagingRoot.reservations) == [second]
+    StagingRoot.release(second)
+    StagingRoot.release(None)
+    assert StagingRoot.reservations == {}
+
+
+def test_only_unwritten_part_is_subtracted(tmpdir, staging):
+    cancelled = threading.Event()
+    folder = str(tmpdir.join('a'))
+    StagingRoot.reserve(str(tmpdir), 60 * MB, [folder], cancelled)
+    # the series has written 40 MB, which the free space already lacks
+    write(folder, 'image.nii', 40 * MB)
+    staging['bytes'] = 60 * MB
+    assert 20 * MB <= StagingRoot.unwritten() <= 20 * MB + 64 * 1024
+    assert StagingRoot.reserve(str(tmpdir), 30 * MB, [str(tmpdir.join('b'))], cancelled) is not None
+
+
+def test_written_beyond_reservation_counts_as_nothing_unwritten(tmpdir, staging):
+    folder = str(tmpdir.join('a'))
+    StagingRoot.reserve(str(tmpdir), 1 * MB, [folder], threading.Event())
+    write(folder, 'image.nii', 2 * MB)
+    assert StagingRoot.unwritten() == 0
+
+
+def test_too_large_without_running_series(tmpdir, staging):
+    with pytest.raises(IOError):
+        StagingRoot.reserve(str(tmpdir), 200 * MB, [str(tmpdir.join('a'))], threading.Event())
+    assert StagingRoot.reservations == {}
+
+
+def test_unknown_free_space(tmpdir, staging):
+    staging['bytes'] = None
+    assert StagingRoot.reserve(str(tmpdir), 200 * MB, [str(tmpdir.join('a'))], threading.Event()) is not None
+
+
+def test_waits_for_release(tmpdir, staging):
+    cancelled = threading.Event()
+    first = StagingRoot.reserve(str(tmpdir), 80 * MB, [str(tmpdir.join('a'))], cancelled)
+    keys = []
+    thread = threading.Thread(target=lambda: keys.append(
+        StagingRoot.reserve(str(tmpdir), 50 * MB, [str(tmpdir.join('b'))], cancelled)))
+    thread.start()
+    time.sleep(0.2)
+    assert keys == []
+    StagingRoot.release(first)
+    thread.join(5)
+    assert len(keys) == 1 and keys[0] is not None
+    assert list(StagingRoot.reservations) == keys
+
+
+def test_cancel_while_waiting(tmpdir, staging):
+    cancelled = threading.Event()
+    StagingRoot.reserve(str(tmpdir), 80 * MB, [str(tmpdir.join('a'))], cancelled)
+    keys = []
+    thread = threading.Thread(target=lambda: keys.append(
+        StagingRoot.reserve(str(tmpdir), 50 * MB, [str(tmpdir.join('b'))], cancelled)))
+    thread.start()
+    time.sleep(0.2)
+    cancelled.set()
+    thread.join(5)
+    assert keys == [None]
+    assert len(StagingRoot.reservations) == 1
@@ -0,0 +1,150 @@
+"""
+Tests of the shared-filesystem work queue (WorkQueue, Heartbeat, run_worker).
+"""
+
+import json
+import os
+import threading
+import time
+
+from pyBIDSconv import Heartbeat, WorkQueue
+
+import check_work_queue
+
+
+def make_plan(outputdir, nrsubjects):
+    return {'outputdir': outputdir, 'configfile': '',
+            'subjects': [{'subject': 'sub-%03d' % ii,
+                          'series': [{'index': 0, 'description': 't1_mprage', 'bytes': 1}]}
+                         for ii in range(nrsubjects)]}
+
+
+def make_queue(tmpdir, nrsubjects=2, timeout=60):
+    queuedir = str(tmpdir.join('queue'))
+    WorkQueue.submit(queuedir, make_plan(str(tmpdir.join('bids')), nrsubjects), timeout=timeout)
+    return queuedir
+
+
+def worker(queuedir, name):
+    queue = WorkQueue(queuedir)
+    queue.worker = name
+    return queue
+
+
+def age(filename, seconds):
+    mtime = time.time() - seconds
+    os.utime(filename, (mtime, mtime))
+
+
+def test_submit_keeps_queued_jobs(tmpdir):
+    queuedir = make_queue(tmpdir)
+    assert WorkQueue.submit(queuedir, make_plan(str(tmpdir.join('bids')), 3)) == ['sub-002']
+    with open(os.path.join(queuedir, 'pending', 'sub-000.json')) as f:
+        assert json.load(f)['subject']['subject'] == 'sub-000'
+
+
+def test_claim_is_exclusive(tmpdir):
+    queuedir = make_queue(tmpdir)
+    first = worker(queuedir, 'node1_1').claim()
+    second = worker(queuedir, 'node2_1').claim()
+    assert first[0] == 'sub-000'
+    assert second[0] == 'sub-001'
+    assert first[1].endswith('sub-000@node1_1')
+    assert worker(queuedir, 'node3_1').claim() is None
+    assert sorted(os.listdir(os.path.join(queuedir, 'claimed'))) == ['sub-000@node1_1', 'sub-001@node2_1']
+
+
+def test_concurrent_claims(tmpdir):
+    queuedir = make_queue(tmpdir, nrsubjects=20)
+    claims = []
+
+    def claimall(name):
+        queue = worker(queuedir, name)
+        while True:
+            claim = queue.claim()
+            if claim is None:
+                return
+            claims.append(claim[0])
+
+    threads = [threading.Thread(target=claimall, args=('node%d_1' % ii,)) for ii in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(claims) == ['sub-%03d' % ii for ii in range(20)]
+
+
+def test_stale_claim_is_given_back(tmpdir):
+    queuedir = make_queue(tmpdir, nrsubjects=1, timeout=5)
+    job, claimfile = worker(queuedir, 'deadhost_1').claim()
+    age(claimfile, 60)
+    assert worker(queuedir, 'node1_1').claim() == (job, os.path.join(queuedir, 'claimed', job + '@node1_1'))
+    assert not os.path.exists(claimfile)
+
+
+def test_fresh_claim_is_kept(tmpdir):
+    queuedir = make_queue(tmpdir, nrsubjects=1, timeout=5)
+    job, claimfile = worker(queuedir, 'node1_1').claim()
+    assert worker(queuedir, 'node2_1').claim() is None
+    assert os.path.exists(claimfile)
+
+
+def test_finish_done_and_failed(tmpdir):
+    queuedir = make_queue(tmpdir)
+    queue = worker(queuedir, 'node1_1')
+    job, claimfile = queue.claim()
+    assert queue.finish(job, claimfile, 'done')
+    job2, claimfile2 = queue.claim()
+    assert queue.finish(job2, claimfile2, 'failed', 'dcm2niix failed')
+    assert os.path.exists(os.path.join(queuedir, 'done', job + '.json'))
+    with open(os.path.join(queuedir, 'failed', job2 + '.log')) as f:
+        assert 'dcm2niix failed' in f.read()
+    assert not queue.unfinished()
+    # a failed job is queued again by the next submit
+    assert WorkQueue.submit(queuedir, make_plan(str(tmpdir.join('bids')), 2)) == [job2]
+
+
+def test_finish_of_lost_claim(tmpdir):
+    queuedir = make_queue(tmpdir, nrsubjects=1, timeout=5)
+    queue = worker(queuedir, 'node1_1')
+    job, claimfile = queue.claim()
+    age(claimfile, 60)
+    worker(queuedir, 'node2_1').claim()
+    assert not queue.finish(job, claimfile, 'done')
+    assert os.listdir(os.path.join(queuedir, 'done')) == []
+
+
+def test_status_skips_clock_and_temp_files(tmpdir):
+    queuedir = make_queue(tmpdir)
+    worker(queuedir, 'node1_1').claim()
+    for name in ('.clock_node2_7', '.tmp_sub-001.json', 'leftover'):
+        open(os.path.join(queuedir, 'claimed', name), 'w').close()
+    counts = WorkQueue(queuedir).status()
+    assert counts['pending'] == 1
+    assert counts['claimed'] == 1
+
+
+def test_heartbeat_touches_file(tmpdir):
+    filename = str(tmpdir.join('claim'))
+    open(filename, 'w').close()
+    age(filename, 60)
+    heartbeat = Heartbeat(filename, 0.05)
+    time.sleep(0.3)
+    heartbeat.stop()
+    assert time.time() - os.stat(filename).st_mtime < 10
+
+
+def test_heartbeat_reports_replaced_file(tmpdir):
+    filename = str(tmpdir.join('claim'))
+    open(filename, 'w').close()
+    lost = threading.Event()
+    heartbeat = Heartbeat(filename, 0.05, lost.set)
+    # taken over: the claim is renamed away and another file takes its name
+    os.rename(filename, filename + '.old')
+    open(filename, 'w').close()
+    assert lost.wait(5)
+    heartbeat.stop()
+
+
+def test_two_local_workers():
+    assert check_work_queue.check(2, nrsubjects=6) == []